@@ -0,0 +1,106 @@
+"""
+Helpers shared by the benchmarks: point Django at a throwaway (or reused)
+SQLite database and fill it with synthetic shelters spread over real ZIPs.
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shelter_me_project.settings')
+# Benchmark databases are throwaway files; run them like a server would
+os.environ.setdefault('SHELTERME_SQLITE_WAL', '1')
+
+# Shelters inserted per transaction while seeding
+SEED_BATCH_SIZE = 5000
+
+
+def setup_django(db_path, cache):
+    from django.conf import settings
+    # Every alias (the writer and the read-only one) is the same file
+    for database in settings.DATABASES.values():
+        database['NAME'] = db_path
+    # So does the comment queue's journal
+    settings.SHELTERME_COMMENT_QUEUE_FILE = db_path + '-comment-queue.jsonl'
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['localhost', 'testserver']
+    if not cache:
+        settings.CACHES = dict(
+            (alias, {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'})
+            for alias in settings.CACHES)
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+# Returns the real ZIPs shelters can be put in: every ZIP within spread
+# miles of center, or every known ZIP if spread is 0
+def seed_zips(center='36830', spread=50):
+    from shelterme.geo import get_zip_index, lookup_zip
+
+    index = get_zip_index()
+    if spread:
+        zips = [z for z, distance in index.zips_within_radius(center, spread)]
+    else:
+        zips = sorted(index.centroids)
+    return [z for z in zips if lookup_zip(z)]
+
+
+# Creates count synthetic shelters over the given ZIPs (see seed_zips). The
+# same rng_seed always gives the same data. Returns the number created.
+def seed(count, center='36830', spread=50, rng_seed=0, progress=None):
+    from django.db import transaction
+    from shelterme.geo import lookup_zip
+    from shelterme.models import Location, Shelter, new_version
+
+    rng = random.Random(rng_seed)
+    zips = seed_zips(center, spread)
+    locations = {}
+    created = 0
+    while created < count:
+        shelters = []
+        for i in range(created, min(count, created + SEED_BATCH_SIZE)):
+            # Every ZIP gets a shelter before any gets a second one
+            zip_code = zips[i] if i < len(zips) else rng.choice(zips)
+            place = lookup_zip(zip_code)
+            if place not in locations:
+                locations[place], new = \
+                    Location.objects.get_or_create_by_city_state(*place)
+            max_capacity = rng.randint(10, 500)
+            current_capacity = rng.randint(0, max_capacity)
+            shelter = Shelter(
+                name='Shelter %d' % i, street_addr='%d Main St' % i,
+                location=locations[place], zip=zip_code,
+                max_capacity=max_capacity,
+                current_capacity=current_capacity,
+                free_beds=max_capacity - current_capacity,
+                photo='shelterme/logo.png', owner='Benchmark',
+                version=new_version())
+            shelter.fill_coordinates()
+            shelters.append(shelter)
+        with transaction.atomic():
+            Shelter.objects.bulk_create(shelters)
+        created += len(shelters)
+        if progress:
+            progress(created)
+    return created
+
+
+# Gives each of the given shelters per_shelter comments
+def seed_comments(shelter_ids, per_shelter):
+    from django.db import transaction
+    from shelterme.models import Comment, Shelter
+
+    with transaction.atomic():
+        Comment.objects.bulk_create(
+            [Comment(author='Benchmark', content='Comment %d' % i,
+                     shelter_id=shelter_id)
+             for shelter_id in shelter_ids for i in range(per_shelter)],
+            batch_size=SEED_BATCH_SIZE)
+        # bulk_create skips Comment.save(), so keep the counts right here
+        Shelter.objects.filter(id__in=shelter_ids).update(
+            comment_count=per_shelter)
@@ -0,0 +1,72 @@
+"""
+Measures how long the index page takes to render its shelter cards with a
+cold fragment cache (every card rendered through the template engine, as
+before fragment caching) and with a warm one (cards read back from the
+cache, only the per-search distances filled in).
+
+Only the card rendering is timed; the search itself is done once up front.
+
+Usage:
+    python benchmarks/index_render.py [--shelters 500] [--rounds 20]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import seed, setup_django  # noqa: E402
+
+
+def time_rounds(rounds, prepare, render):
+    timings = []
+    for i in range(rounds):
+        prepare()
+        start = time.perf_counter()
+        render()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    print('%-5s median %8.2f ms   min %8.2f ms' % (
+        name, statistics.median(timings), min(timings)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--shelters', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'), True)
+        seed(args.shelters)
+
+        from django.core.cache import caches
+        from shelterme import fragments
+        from shelterme.models import Shelter, within_distance
+        from shelterme.geo import get_zip_index
+
+        lat, long = get_zip_index().centroid('36830')
+        shelters = within_distance(
+            Shelter.objects.select_related('location'), lat, long, 100)
+        print('Rendering %d shelter cards, %d rounds' % (
+            len(shelters), args.rounds))
+
+        cache = caches[fragments.FRAGMENT_CACHE_ALIAS]
+
+        def render():
+            return fragments.render_cards(shelters)
+
+        report('cold', time_rounds(args.rounds, cache.clear, render))
+        render()
+        report('warm', time_rounds(args.rounds, lambda: None, render))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Load test of concurrent reads against writes on SQLite.
+
+Runs the same workload twice, each in a fresh process and database:
+
+    plain   Django's stock SQLite backend: rollback journal, one alias
+    tuned   the project's settings: WAL, pragmas, single writer and
+            read-only connections for reads (shelterme.db.sqlite3)
+
+Reader processes keep loading shelter show-page data (shelter, location
+and comments) while writer processes keep running write transactions
+(check-ins and a comment for --batch shelters per transaction), like the
+workers of a multi-process server. Reports read latency percentiles and
+the worst read stall, throughput, and any "database is locked" errors.
+
+Workers are forked, so this needs a platform with fork (Linux, macOS).
+
+Usage:
+    python benchmarks/sqlite_contention.py [--readers 4] [--writers 1]
+                                           [--seconds 6] [--batch 20000]
+                                           [--shelters 30000] [--dir DIR]
+
+Big write transactions are the interesting case: once one outgrows the
+page cache, the rollback journal has to lock readers out until it commits.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import seed, setup_django  # noqa: E402
+
+MODES = ['plain', 'tuned']
+
+
+def use_plain_sqlite():
+    from django.conf import settings
+    settings.DATABASES = {'default': {
+        'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'unset'}}
+    settings.DATABASE_ROUTERS = []
+
+
+# Worker processes run until the deadline and put (kind, latencies,
+# errors) on the results queue
+def reader(shelter_ids, deadline, results):
+    from django.db import OperationalError, connections
+    from shelterme.models import Shelter
+
+    rng = random.Random()
+    latencies, errors = [], 0
+    try:
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                shelter = Shelter.objects.select_related('location').get(
+                    id=rng.choice(shelter_ids))
+                list(shelter.comment_set.order_by('id')[:20])
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+    finally:
+        connections.close_all()
+        results.put(('read', latencies, errors))
+
+
+def writer(shelter_ids, batch, deadline, results):
+    from django.db import OperationalError, connections, transaction
+    from django.db.models import F
+    from shelterme.models import Comment, Shelter
+
+    rng = random.Random()
+    durations, errors = [], 0
+    try:
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                ids = rng.sample(shelter_ids, batch)
+                with transaction.atomic():
+                    Shelter.objects.filter(id__in=ids).update(
+                        current_capacity=F('current_capacity') + 1,
+                        free_beds=F('free_beds') - 1,
+                        comment_count=F('comment_count') + 1)
+                    Comment.objects.bulk_create(
+                        [Comment(author='Load test', content='Update',
+                                 shelter_id=shelter_id)
+                         for shelter_id in ids])
+            except OperationalError:
+                errors += 1
+                continue
+            durations.append(time.perf_counter() - start)
+    finally:
+        connections.close_all()
+        results.put(('write', durations, errors))
+
+
+# Runs one mode in this process and prints its numbers as JSON
+def run_mode(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        if args.mode == 'plain':
+            use_plain_sqlite()
+        setup_django(os.path.join(tmp, 'load.sqlite3'), False)
+        seed(args.shelters)
+
+        from django.db import connections
+        from shelterme.models import Shelter
+        shelter_ids = list(Shelter.objects.values_list('id', flat=True))
+        connections.close_all()
+
+        context = get_context('fork')
+        results = context.Queue()
+        deadline = time.time() + args.seconds
+        workers = [context.Process(
+            target=reader, args=(shelter_ids, deadline, results))
+            for i in range(args.readers)]
+        workers += [context.Process(
+            target=writer, args=(shelter_ids, args.batch, deadline, results))
+            for i in range(args.writers)]
+        for worker in workers:
+            worker.start()
+        latencies, durations, errors = [], [], {'read': 0, 'write': 0}
+        for worker in workers:
+            kind, timings, failed = results.get()
+            (latencies if kind == 'read' else durations).extend(timings)
+            errors[kind] += failed
+        for worker in workers:
+            worker.join()
+
+    latencies = sorted(latency * 1000 for latency in latencies)
+    print(json.dumps({
+        'reads': len(latencies),
+        'read_p50_ms': statistics.median(latencies) if latencies else 0,
+        'read_p99_ms': latencies[int(len(latencies) * 0.99) - 1]
+        if latencies else 0,
+        'read_max_ms': latencies[-1] if latencies else 0,
+        'writes': len(durations),
+        'write_p50_ms': statistics.median(durations) * 1000
+        if durations else 0,
+        'read_errors': errors['read'],
+        'write_errors': errors['write'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=6)
+    parser.add_argument('--batch', type=int, default=20000,
+                        help='Shelters changed per write transaction')
+    parser.add_argument('--shelters', type=int, default=30000)
+    parser.add_argument('--dir',
+                        help='Where to put the database (default: the temp '
+                             'directory). Commit costs depend on the disk, '
+                             'so use the one production runs on.')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        return run_mode(args)
+
+    print('%d readers, %d writers (%d shelters per transaction), %gs each' % (
+        args.readers, args.writers, args.batch, args.seconds))
+    print('%-6s %9s %9s %9s %10s %8s %9s %7s' % (
+        'mode', 'reads/s', 'p50 ms', 'p99 ms', 'stall ms', 'writes/s',
+        'write ms', 'errors'))
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--mode', mode] +
+            sys.argv[1:], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print('%-6s %9.0f %9.2f %9.2f %10.2f %8.1f %9.2f %7d' % (
+            mode, result['reads'] / args.seconds, result['read_p50_ms'],
+            result['read_p99_ms'], result['read_max_ms'],
+            result['writes'] / args.seconds, result['write_p50_ms'],
+            result['read_errors'] + result['write_errors']))
+
+
+if __name__ == '__main__':
+    main()
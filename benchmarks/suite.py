@@ -0,0 +1,346 @@
+"""
+Benchmark suite for the search, show and write paths.
+
+Seeds a SQLite database with synthetic shelters over real ZIPs (10k by
+default, up to 1M and beyond), then measures every scenario below through
+the full Django stack (middleware, views, templates):
+
+    index        GET /shelters at each radius
+    available    GET /shelters sorted by free beds at each radius
+    api          GET /api/shelters at each radius
+    locations    get_locations_within_radius at each radius
+    validate     valid_city_state_zip, memo cleared / warm
+    show         GET /shelters/<id> of shelters with comments
+    checkin      POST check-in / check-out
+    comment      POST a new comment
+    comment queued  POST a new comment through the write-behind queue
+    text search  GET /api/search for a shelter name prefix and a comment
+
+For each one it records latency percentiles, SQL queries per request and
+peak Python memory allocated per request, writes them to a JSON file and
+compares them with a stored baseline. The exit status is 1 if anything
+regressed by more than --threshold (or runs more queries than before);
+latencies must also have grown by more than 0.05 ms.
+
+Usage:
+    python benchmarks/suite.py [--shelters 10000] [--radii 5,25,50]
+                               [--iterations 100] [--db bench.sqlite3]
+                               [--output benchmarks/results.json]
+                               [--baseline benchmarks/baseline.json]
+                               [--save-baseline] [--threshold 0.25]
+
+Generating a large database takes a while; pass --db to keep it and reuse
+it on the next run (it's only seeded when empty).
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import seed, seed_comments, setup_django  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Shelters the show scenario cycles through, and their comments each
+SHOW_SHELTERS = 20
+SHOW_COMMENTS = 50
+
+# Metrics compared against the baseline: (name, tolerance applies)
+COMPARED = [('p50_ms', True), ('p90_ms', True), ('queries', False),
+            ('peak_kib', True)]
+
+# Latency changes smaller than this are timer noise on fast scenarios
+# (0.01 ms over 0.02 ms is +50%), never regressions
+FLOOR_MS = 0.05
+
+
+# Returns the q-th percentile (0-100) of the sorted values, nearest rank
+def percentile(values, q):
+    index = max(0, min(len(values) - 1,
+                       int(round(q / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+# Runs func(i) warmup + iterations times and returns its metrics. Latency
+# comes from a plain timed pass; queries and memory from a separate, short
+# profiled pass so the profiling doesn't skew the timings.
+def measure(func, iterations, warmup, profile_iterations):
+    from contextlib import ExitStack
+    from django.db import connections
+    from django.test.utils import CaptureQueriesContext
+
+    for i in range(warmup):
+        func(i)
+
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    # Counted over every alias (reads and writes use different ones)
+    queries = []
+    for i in range(profile_iterations):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(c))
+                        for c in connections.all()]
+            func(i)
+        queries.append(sum(len(c) for c in captured))
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(profile_iterations):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            func(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'min_ms': round(latencies[0], 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'queries': max(queries),
+        'peak_kib': round(max(peaks) / 1024.0, 1),
+    }
+
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise RuntimeError('%s %s returned %d' % (
+            response.request['REQUEST_METHOD'], response.request['PATH_INFO'],
+            response.status_code))
+    return response
+
+
+# Returns [(name, func)] for every scenario
+def scenarios(zip_code, radii):
+    from django.test import Client
+    from django.urls import reverse
+    from shelterme import comment_queue, views
+    from shelterme.geo import lookup_zip
+    from shelterme.models import Shelter
+
+    client = Client()
+    index_url = reverse('shelterme:index')
+    api_url = reverse('shelterme:api_search')
+    text_url = reverse('shelterme:api_text_search')
+    city, state = lookup_zip(zip_code)
+    city = city[0].upper() + city[1:].lower()
+
+    # Shelters near the center for the show and write scenarios
+    nearby = [shelter.id for shelter in
+              Shelter.objects.near_zip(zip_code, max(radii))[:SHOW_SHELTERS]]
+    if not nearby:
+        raise RuntimeError('No shelters within %s miles of %s' % (
+            max(radii), zip_code))
+    show_urls = [reverse('shelterme:show', args=(shelter_id,))
+                 for shelter_id in nearby]
+    checkin_url = reverse('shelterme:checkin', args=(nearby[0],))
+    checkout_url = reverse('shelterme:checkout', args=(nearby[0],))
+    comment_url = reverse('shelterme:comment_create', args=(nearby[0],))
+    # Leave room to check in and out of the first shelter
+    Shelter.objects.filter(id=nearby[0]).update(
+        current_capacity=1, max_capacity=10)
+
+    result = []
+    for radius in radii:
+        params = {'zip': zip_code, 'radius': radius}
+        result.append(('index r=%d' % radius, lambda i, params=params: expect(
+            client.get(index_url, params), 200)))
+        result.append(('available r=%d' % radius,
+                       lambda i, params=params: expect(client.get(
+                           index_url, dict(params, sort='available')), 200)))
+        result.append(('api r=%d' % radius, lambda i, params=params: expect(
+            client.get(api_url, params), 200)))
+        result.append(('locations r=%d' % radius,
+                       lambda i, radius=radius:
+                       views.get_locations_within_radius(zip_code, radius)))
+
+    # Comments through the write-behind queue (written in the background)
+    def queued_comment(i):
+        comment_queue.WRITE_BEHIND = True
+        try:
+            expect(client.post(comment_url, {
+                'content': 'Benchmark comment %d' % i}), 302)
+        finally:
+            comment_queue.WRITE_BEHIND = False
+
+    def validate_cold(i):
+        views.valid_city_state_zip.cache_clear()
+        views.valid_city_state_zip(city, state, zip_code)
+
+    result += [
+        ('validate cold', validate_cold),
+        ('validate warm',
+         lambda i: views.valid_city_state_zip(city, state, zip_code)),
+        ('show', lambda i: expect(
+            client.get(show_urls[i % len(show_urls)]), 200)),
+        ('checkin', lambda i: expect(client.post(
+            checkout_url if i % 2 else checkin_url), 200)),
+        ('comment', lambda i: expect(client.post(
+            comment_url, {'content': 'Benchmark comment %d' % i}), 302)),
+        ('comment queued', queued_comment),
+        ('text search', lambda i: expect(client.get(
+            text_url, {'q': ['shelter 12', 'comment 1'][i % 2]}), 200)),
+    ]
+    return result, nearby
+
+
+# Returns [(scenario, metric, baseline, current)] for every metric that got
+# worse than the baseline by more than threshold and, for latencies, by
+# more than FLOOR_MS (any increase for query counts)
+def regressions(results, baseline, threshold):
+    worse = []
+    for name, metrics in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, tolerant in COMPARED:
+            if metric not in before:
+                continue
+            limit = before[metric] * (1 + threshold) if tolerant \
+                else before[metric]
+            if metric.endswith('_ms'):
+                limit = max(limit, before[metric] + FLOOR_MS)
+            if metrics[metric] > limit:
+                worse.append((name, metric, before[metric], metrics[metric]))
+    return worse
+
+
+def report(results, baseline):
+    print('%-16s %9s %9s %9s %8s %10s %9s' % (
+        'scenario', 'p50 ms', 'p90 ms', 'p99 ms', 'queries', 'peak KiB',
+        'vs base'))
+    for name, metrics in results.items():
+        change = ''
+        before = baseline.get(name)
+        if before and before.get('p50_ms'):
+            change = '%+.0f%%' % (
+                (metrics['p50_ms'] / before['p50_ms'] - 1) * 100)
+        print('%-16s %9.3f %9.3f %9.3f %8d %10.1f %9s' % (
+            name, metrics['p50_ms'], metrics['p90_ms'], metrics['p99_ms'],
+            metrics['queries'], metrics['peak_kib'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--shelters', type=int, default=10000)
+    parser.add_argument('--spread', type=int, default=100,
+                        help='Put shelters in ZIPs within this many miles '
+                             'of --zip, 0 for every US ZIP (default: 100)')
+    parser.add_argument('--zip', default='36830',
+                        help='Center of the searches (default: 36830)')
+    parser.add_argument('--radii', default='5,25,50',
+                        help='Search radii, at most 50 (default: 5,25,50)')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--profile-iterations', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the data generator')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep the search and fragment caches on')
+    parser.add_argument('--db', help='SQLite file to keep and reuse')
+    parser.add_argument('--only', help='Comma separated scenario prefixes')
+    parser.add_argument('--output',
+                        default=os.path.join(HERE, 'results.json'))
+    parser.add_argument('--baseline',
+                        default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Also store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown before a regression is '
+                             'reported (default: 0.25 = 25%%)')
+    args = parser.parse_args()
+    radii = [int(radius) for radius in args.radii.split(',')]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(args.db or os.path.join(tmp, 'bench.sqlite3'),
+                     args.cache)
+
+        import django
+        from shelterme.models import Shelter
+
+        existing = Shelter.objects.count()
+        shelters = existing or args.shelters
+        if existing:
+            print('Reusing %d shelters in %s' % (existing, args.db))
+        else:
+            start = time.perf_counter()
+            seed(args.shelters, args.zip, args.spread, args.seed,
+                 progress=lambda n: print('  seeded %d shelters' % n,
+                                          end='\r', flush=True))
+            print('Seeded %d shelters in %.1fs' % (
+                args.shelters, time.perf_counter() - start))
+
+        todo, nearby = scenarios(args.zip, radii)
+        if not existing:
+            seed_comments(nearby, SHOW_COMMENTS)
+        if args.only:
+            prefixes = tuple(args.only.split(','))
+            todo = [(name, func) for name, func in todo
+                    if name.startswith(prefixes)]
+
+        results = {}
+        for name, func in todo:
+            results[name] = measure(func, args.iterations, args.warmup,
+                                    args.profile_iterations)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored['results']
+        for setting, value in [('shelters', shelters), ('cache', args.cache)]:
+            if stored['meta'].get(setting) != value:
+                print('Warning: the baseline was run with %s=%s' % (
+                    setting, stored['meta'].get(setting)))
+
+    report(results, baseline)
+
+    output = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'shelters': shelters,
+            'spread': args.spread,
+            'zip': args.zip,
+            'seed': args.seed,
+            'cache': args.cache,
+            'iterations': args.iterations,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    paths = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for path in paths:
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Wrote %s' % path)
+
+    worse = regressions(results, baseline, args.threshold)
+    for name, metric, before, after in worse:
+        print('REGRESSION %s %s: %s -> %s' % (name, metric, before, after))
+    if worse:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Compares request throughput of the project served through Django's WSGI
+handler (a pool of worker threads, like a threaded WSGI server) and its ASGI
+handler (one event loop, like a single uvicorn worker) at a fixed
+concurrency.
+
+Both handlers are driven in-process against a throwaway SQLite database
+seeded with synthetic shelters, so no server or network is involved and the
+numbers only reflect Django and the views.
+
+Usage:
+    python benchmarks/wsgi_vs_asgi.py [--concurrency 16] [--requests 1000]
+                                      [--shelters 2000] [--cache]
+                                      [--path '/shelters?zip=36830&radius=25']
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import seed, setup_django  # noqa: E402
+
+
+def split_path(path):
+    path, _, query = path.partition('?')
+    return path, query
+
+
+def wsgi_request(app, path):
+    path, query = split_path(path)
+    status = []
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SCRIPT_NAME': '', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.input': io.BytesIO(b''), 'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+        'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        'wsgi.version': (1, 0),
+    }
+    start = time.perf_counter()
+    result = app(environ, lambda s, headers: status.append(s))
+    try:
+        for chunk in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return time.perf_counter() - start, int(status[0].split()[0])
+
+
+async def asgi_request(app, path):
+    path, query = split_path(path)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path,
+        'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    sent_body = False
+    done = asyncio.Event()
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    status = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    done.set()
+    return time.perf_counter() - start, status[0]
+
+
+def run_wsgi(path, concurrency, requests):
+    from django.core.handlers.wsgi import WSGIHandler
+    app = WSGIHandler()
+    wsgi_request(app, path)  # warm up
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: wsgi_request(app, path),
+                                range(requests)))
+    return time.perf_counter() - start, results
+
+
+def run_asgi(path, concurrency, requests):
+    from django.core.handlers.asgi import ASGIHandler
+    app = ASGIHandler()
+
+    async def main():
+        await asgi_request(app, path)  # warm up
+        remaining = iter(range(requests))
+        results = []
+
+        async def worker():
+            for i in remaining:
+                results.append(await asgi_request(app, path))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for i in range(concurrency)))
+        return time.perf_counter() - start, results
+
+    return asyncio.run(main())
+
+
+def report(name, elapsed, results):
+    latencies = sorted(latency * 1000 for latency, status in results)
+    errors = sum(1 for latency, status in results if status >= 400)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print('%-5s %8.1f req/s   p50 %7.2f ms   p95 %7.2f ms   errors %d' % (
+        name, len(results) / elapsed, statistics.median(latencies), p95,
+        errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--shelters', type=int, default=2000)
+    parser.add_argument('--path', default='/shelters?zip=36830&radius=25')
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep the radius search cache on')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(os.path.join(tmp, 'bench.sqlite3'), args.cache)
+        seed(args.shelters)
+        print('%d shelters, %d requests to %s at concurrency %d' % (
+            args.shelters, args.requests, args.path, args.concurrency))
+        report('WSGI', *run_wsgi(args.path, args.concurrency, args.requests))
+        report('ASGI', *run_asgi(args.path, args.concurrency, args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""
+ASGI config for shelter_me_project project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shelter_me_project.settings')
+# Don't keep connections open per executor thread (see DATABASES)
+os.environ['SHELTERME_ASGI'] = '1'
+# Put the database in WAL mode (see DATABASES)
+os.environ.setdefault('SHELTERME_SQLITE_WAL', '1')
+
+application = get_asgi_application()
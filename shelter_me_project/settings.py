@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shelterme.instrumentation.TimingMiddleware',
+    'shelterme.routers.StickyPrimaryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,7 +56,8 @@ ROOT_URLCONF = 'shelter_me_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that also times renders for TimingMiddleware
+        'BACKEND': 'shelterme.instrumentation.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -70,17 +73,162 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'shelter_me_project.wsgi.application'
 
+ASGI_APPLICATION = 'shelter_me_project.asgi.application'
+
 
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
+# One SQLite file, opened through two aliases: 'default' is the single
+# writer, 'readonly' the read-only connections reads are routed to (see
+# shelterme.routers). WAL lets those reads carry on while a write is in
+# progress. The journal mode is stored in the database file, so only
+# servers (wsgi.py and asgi.py set SHELTERME_SQLITE_WAL) switch to it:
+# management commands and runserver leave the file as they find it unless
+# SHELTERME_SQLITE_WAL is set.
+#
+# Django keeps one connection per alias per thread. Under WSGI the worker
+# threads live as long as the server, so connections are kept open between
+# requests. Under ASGI the sync parts of a request run on whichever thread
+# of the executor is free, and every one of them would keep its own
+# connections open, so there (asgi.py sets SHELTERME_ASGI) they are closed
+# at the end of each request.
+
+SQLITE_PATH = os.environ.get('SHELTERME_SQLITE_PATH',
+                             os.path.join(BASE_DIR, 'db.sqlite3'))
+
+CONN_MAX_AGE = 0 if os.environ.get('SHELTERME_ASGI') else None
+
+# Set on every new connection (see shelterme.db.sqlite3)
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -20000,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+if os.environ.get('SHELTERME_SQLITE_WAL'):
+    SQLITE_PRAGMAS['journal_mode'] = 'WAL'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'ENGINE': 'shelterme.db.sqlite3',
+        'NAME': SQLITE_PATH,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            'pragmas': SQLITE_PRAGMAS,
+            'single_writer': True,
+        },
+    },
+    'readonly': {
+        'ENGINE': 'shelterme.db.sqlite3',
+        'NAME': SQLITE_PATH,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 20,
+            'pragmas': SQLITE_PRAGMAS,
+            'read_only': True,
+        },
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+
+# Read replica for the search and show pages (see shelterme.routers). By
+# default it's the primary file itself; to try a real, lagging replica
+# locally point SHELTERME_SQLITE_REPLICA_PATH at a second file and copy
+# the primary into it with `manage.py sync_replica`.
+SQLITE_REPLICA_PATH = os.environ.get('SHELTERME_SQLITE_REPLICA_PATH',
+                                     SQLITE_PATH)
+
+DATABASES['replica'] = {
+    'ENGINE': 'shelterme.db.sqlite3',
+    'NAME': SQLITE_REPLICA_PATH,
+    'CONN_MAX_AGE': CONN_MAX_AGE,
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'timeout': 20,
+        'pragmas': SQLITE_PRAGMAS,
+        'read_only': True,
+    },
+    'TEST': {
+        'MIRROR': 'default',
+    },
+}
+
+DATABASE_ROUTERS = ['shelterme.routers.ReadWriteRouter']
+
+SHELTERME_REPLICA_DATABASES = ['replica']
+
+# Seconds a client reads from the primary after writing something
+SHELTERME_REPLICA_LAG = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'shelterme',
+        'OPTIONS': {
+            # Room for a fragment per shelter plus search results
+            'MAX_ENTRIES': 50000,
+        },
     }
 }
 
+# Cache every process (web workers, management commands) shares, on disk.
+# Holds what one process writes and the others have to see. Its writes are
+# last-writer-wins and incr isn't atomic (it's a get then a set), so don't
+# count things in it.
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.environ.get('SHELTERME_SHARED_CACHE_DIR',
+                               os.path.join(BASE_DIR, 'cache')),
+    'TIMEOUT': None,
+    'OPTIONS': {
+        'MAX_ENTRIES': 20000,
+    },
+}
+
+# Tests use a shared cache in a temporary directory instead
+TEST_RUNNER = 'shelterme.test_runner.TestRunner'
+
+# Seconds a radius search result stays cached, and the cache of the grid
+# cell versions that invalidate them (see shelterme.search_cache)
+SHELTERME_SEARCH_CACHE_TTL = 300
+SHELTERME_SEARCH_VERSION_CACHE = 'shared'
+
+# Seconds a rendered shelter card / header stays cached (see
+# shelterme.fragments)
+SHELTERME_FRAGMENT_CACHE_TTL = 3600
+
+# Number of city/state/ZIP validation results kept in memory
+SHELTERME_ZIP_CACHE_SIZE = 4096
+
+# Requests per view kept for the timings API, and whether responses get a
+# Server-Timing header (see shelterme.instrumentation)
+SHELTERME_TIMING_WINDOW = 1000
+SHELTERME_SERVER_TIMING = True
+
+# Where shelter photo thumbnails are stored and how many photos are
+# processed at once (see shelterme.thumbnails). Needs Pillow.
+SHELTERME_THUMBNAIL_ROOT = os.path.join(BASE_DIR, 'thumbnails')
+SHELTERME_THUMBNAIL_WORKERS = 2
+
+# Queue comment writes and commit them in batches in the background, how
+# queued changes are applied ('fifo' or 'coalesce') and kept until then
+# ('memory', 'file' or 'fsync'), and the journal file of 'file' / 'fsync'
+# (see shelterme.comment_queue)
+SHELTERME_COMMENT_WRITE_BEHIND = False
+SHELTERME_COMMENT_QUEUE_ORDERING = 'fifo'
+SHELTERME_COMMENT_QUEUE_DURABILITY = 'file'
+SHELTERME_COMMENT_QUEUE_FILE = os.path.join(BASE_DIR, 'comment_queue.jsonl')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -119,3 +267,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Built (minified, hashed and precompressed) assets, made by
+# 'manage.py collectstatic' (see shelterme.assets)
+STATIC_ROOT = os.environ.get('SHELTERME_STATIC_ROOT',
+                             os.path.join(BASE_DIR, 'staticfiles'))
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'shelterme.assets.AssetStorage',
+    },
+}
@@ -13,12 +13,17 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+from django.conf import settings
 from django.contrib import admin
-from django.urls import include, path
-from django.contrib.staticfiles.urls import staticfiles_urlpatterns
+from django.urls import include, path, re_path
+from shelterme import assets
 
 urlpatterns = [
     path('', include("shelterme.urls")),
     path('admin/', admin.site.urls),
+    # Built assets with immutable caching (source files while DEBUG and
+    # not built)
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.STATIC_URL.lstrip('/')),
+            assets.serve),
 ]
-urlpatterns += staticfiles_urlpatterns()
@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shelter_me_project.settings')
+# Put the database in WAL mode (see DATABASES)
+os.environ.setdefault('SHELTERME_SQLITE_WAL', '1')
 
 application = get_wsgi_application()
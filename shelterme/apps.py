@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class SheltermeConfig(AppConfig):
     name = 'shelterme'
+
+    def ready(self):
+        # Connect the model signal receivers
+        from shelterme import signals  # noqa: F401
+        # Time the SQL of every database connection
+        from shelterme import instrumentation  # noqa: F401
+        # Load the ZIP index now rather than on the first search, which
+        # would block the event loop of an async view while it loads
+        from shelterme.geo import get_zip_index
+        get_zip_index()
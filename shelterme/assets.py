@@ -0,0 +1,169 @@
+import gzip
+import mimetypes
+import os
+from django.conf import settings
+from django.contrib.staticfiles import views as staticfiles_views
+from django.contrib.staticfiles.storage import (ManifestStaticFilesStorage,
+                                                staticfiles_storage)
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.views.decorators.http import require_safe
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static assets, built by collectstatic into STATIC_ROOT:
+#
+# - CSS and JS are minified (with rcssmin / rjsmin when installed; license
+#   /*! comments are kept)
+# - every file gets a content-hashed copy (Django's manifest storage, which
+#   also rewrites the url()s between them) and the templates' {% static %}
+#   point at those
+# - text files get .gz and, with the brotli package, .br copies next to
+#   them, made once at build time at the highest levels
+#
+# serve() sends the hashed files with far-future, immutable cache headers
+# and picks the precompressed copy the client accepts. Until collectstatic
+# has been run there's no manifest: {% static %} falls back to the plain
+# names and, with DEBUG on, serve() to the source files.
+
+# Extensions of the files worth compressing (fonts like woff/woff2 and
+# images are compressed already)
+COMPRESSIBLE = ['.css', '.js', '.svg', '.ttf', '.eot', '.txt', '.json',
+                '.map', '.html', '.xml']
+
+# Precompressed copies, in order of preference: (suffix, Content-Encoding)
+ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def minify(name, content):
+    if name.endswith('.css') and rcssmin is not None:
+        return rcssmin.cssmin(content.decode('utf-8'),
+                              keep_bang_comments=True).encode('utf-8')
+    if name.endswith('.js') and rjsmin is not None:
+        return rjsmin.jsmin(content.decode('utf-8'),
+                            keep_bang_comments=True).encode('utf-8')
+    return content
+
+
+# Returns {suffix: bytes} of the copies of content worth keeping (the ones
+# that came out smaller)
+def compress(content):
+    copies = {'.gz': gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        copies['.br'] = brotli.compress(content, quality=11)
+    return dict((suffix, data) for suffix, data in copies.items()
+                if len(data) < len(content))
+
+
+class AssetStorage(ManifestStaticFilesStorage):
+
+    # Files are minified as collectstatic copies them in, before they're
+    # hashed
+    def _save(self, name, content):
+        if name.endswith(('.css', '.js')):
+            content = ContentFile(minify(name, b''.join(content.chunks())))
+        return super()._save(name, content)
+
+    # Hashes (and rewrites the references in) the minified copies rather
+    # than the sources, then compresses the results
+    def post_process(self, paths, dry_run=False, **options):
+        paths = dict((path, (self, path)) for path in paths)
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        self.hashed_names = set(self.hashed_files.values())
+        for name in self.hashed_names:
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            with self.open(name) as file:
+                content = file.read()
+            for suffix, data in compress(content).items():
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(data))
+
+    # Not built yet: use the source files as they are
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    # Also keeps the set of hashed names, so telling them from the rest
+    # doesn't scan the manifest
+    def load_manifest(self):
+        hashed_files, manifest_hash = super().load_manifest()
+        self.hashed_names = set(hashed_files.values())
+        return hashed_files, manifest_hash
+
+    def is_hashed(self, name):
+        return name in self.hashed_names
+
+
+# Returns the Content-Encoding values the client accepts
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.partition(';')
+        params = params.replace(' ', '').lower()
+        try:
+            weight = float(params[2:]) if params.startswith('q=') else 1
+        except ValueError:
+            weight = 1
+        if weight > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+# Static files view (GET / HEAD)
+# Behind a web server, serve STATIC_ROOT directly with the same headers
+# (e.g. nginx's gzip_static / brotli_static) instead.
+@require_safe
+def serve(request, path):
+    storage = staticfiles_storage
+    if not getattr(storage, 'hashed_files', None):
+        if settings.DEBUG:
+            return staticfiles_views.serve(request, path)
+        raise Http404
+
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    content_type = mimetypes.guess_type(full_path)[0]
+    accepted = accepted_encodings(request)
+    file_path, content_encoding = full_path, None
+    for suffix, coding in ENCODINGS:
+        if coding in accepted and os.path.isfile(full_path + suffix):
+            file_path, content_encoding = full_path + suffix, coding
+            break
+
+    response = FileResponse(open(file_path, 'rb'),
+                            filename=os.path.basename(full_path),
+                            content_type=content_type or
+                            'application/octet-stream')
+    if content_encoding:
+        response['Content-Encoding'] = content_encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = (IMMUTABLE if storage.is_hashed(path)
+                                 else 'no-cache')
+    return response
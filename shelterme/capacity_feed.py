@@ -0,0 +1,79 @@
+import asyncio
+from threading import Lock
+
+# In-process change feed of shelter capacities.
+#
+# Writers call publish() with the shelter's new numbers (they already have
+# them, so publishing costs no extra query). Every stream watching that
+# shelter gets the change pushed to it, so N watchers cost nothing more
+# than one.
+#
+# Only writes made by this process are seen. Run the streaming endpoint in
+# the same process as the writers (e.g. one ASGI worker) or accept that
+# changes from other workers show up on the next page load.
+
+
+# One watcher. Keeps only the latest change per shelter, so a slow client
+# gets coalesced updates instead of an ever growing backlog.
+class Subscription:
+
+    def __init__(self, shelter_ids, loop):
+        self.shelter_ids = frozenset(shelter_ids)
+        self.loop = loop
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    # Runs on the subscriber's event loop
+    def push(self, change):
+        self.pending[change['id']] = change
+        self.ready.set()
+
+    # Waits up to timeout seconds for changes and returns them (possibly
+    # none)
+    async def changes(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.ready.clear()
+        changes = list(self.pending.values())
+        self.pending.clear()
+        return changes
+
+
+class CapacityFeed:
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = Lock()
+
+    # Must be called from the event loop that will read the subscription
+    def subscribe(self, shelter_ids):
+        subscription = Subscription(shelter_ids, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    # Pushes a shelter's new capacity to everyone watching it. Safe to call
+    # from any thread.
+    def publish(self, shelter_id, current_capacity, max_capacity):
+        change = {'id': shelter_id,
+                  'current_capacity': current_capacity,
+                  'max_capacity': max_capacity}
+        with self.lock:
+            watchers = [s for s in self.subscriptions
+                        if shelter_id in s.shelter_ids]
+        for subscription in watchers:
+            try:
+                subscription.loop.call_soon_threadsafe(
+                    subscription.push, change)
+            except RuntimeError:
+                # The watcher's loop is gone; its stream is over
+                self.unsubscribe(subscription)
+
+
+feed = CapacityFeed()
@@ -0,0 +1,443 @@
+import atexit
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from threading import Condition, Lock, Thread
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from shelterme.models import Comment, Shelter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Write-behind queue for comment writes.
+#
+# With WRITE_BEHIND on, creating, editing and deleting a comment only
+# queues the change and redirects. A background thread applies the queue
+# in batches: it lets a burst gather for DELAY seconds, then writes up to
+# BATCH_SIZE changes in one transaction, so a burst of comments takes the
+# write lock and commits once instead of once per comment. Until a change
+# is committed, the show page of the client that made it (recognized by
+# the CLIENT_COOKIE it was given) shows it on top of the stored comments.
+# A view that finds MAX_LENGTH changes queued writes the queue itself
+# before queuing its change, so changes are never written out of order.
+#
+# ORDERING
+# 'fifo'      changes are applied one at a time in the order they were
+#             queued, each exactly as the synchronous views make it
+# 'coalesce'  new comments are inserted together, only the last edit of a
+#             comment is written and every shelter's count is updated
+#             once. The stored comments end up the same (new comments
+#             still get ids in the order they were queued) with fewer
+#             writes, but edit times are the batch's.
+#
+# DURABILITY
+# 'memory'    queued changes live only in this process: they're written
+#             on a clean exit and lost if the process dies
+# 'file'      every change is appended to the journal FILE before the view
+#             answers and replayed when the process starts again, so it
+#             survives the process dying (not the machine)
+# 'fsync'     same, and the journal is fsynced before answering, so
+#             changes survive a power cut too
+#
+# Replays apply every change once: a new comment records the id of the
+# change that made it (Comment.queue_id) and is skipped if it's already
+# stored; edits and deletes can be applied twice.
+#
+# Every process needs a journal of its own. Each one takes the first of
+# FILE, FILE.1, FILE.2, ... (up to JOURNALS) that no other process holds,
+# and holds it with an exclusive lock (on FILE.lock, FILE.1.lock, ...)
+# until it exits. A restarted process takes a journal a dead one left and
+# replays it. Without fcntl (on Windows) nothing is locked and every
+# process has to be given its own FILE.
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND = getattr(settings, 'SHELTERME_COMMENT_WRITE_BEHIND', False)
+
+ORDERINGS = ['fifo', 'coalesce']
+DURABILITIES = ['memory', 'file', 'fsync']
+
+ORDERING = getattr(settings, 'SHELTERME_COMMENT_QUEUE_ORDERING', 'fifo')
+DURABILITY = getattr(settings, 'SHELTERME_COMMENT_QUEUE_DURABILITY', 'file')
+FILE = getattr(settings, 'SHELTERME_COMMENT_QUEUE_FILE', os.path.join(
+    settings.BASE_DIR, 'comment_queue.jsonl'))
+
+# Apply the queue on a background thread (False: only when flush() is
+# called)
+BACKGROUND = getattr(settings, 'SHELTERME_COMMENT_QUEUE_BACKGROUND', True)
+
+# Seconds a burst gathers before it's written, the most changes written
+# per transaction and the most changes queued at once
+DELAY = getattr(settings, 'SHELTERME_COMMENT_QUEUE_DELAY', 0.2)
+BATCH_SIZE = getattr(settings, 'SHELTERME_COMMENT_QUEUE_BATCH_SIZE', 500)
+MAX_LENGTH = getattr(settings, 'SHELTERME_COMMENT_QUEUE_MAX_LENGTH', 10000)
+
+# Most journals (so processes) sharing FILE
+JOURNALS = getattr(settings, 'SHELTERME_COMMENT_QUEUE_JOURNALS', 64)
+
+# Seconds before a batch that failed to commit is tried again
+RETRY_DELAY = 1
+
+CLIENT_COOKIE = 'shelterme_client'
+
+CREATE, UPDATE, DELETE = 'create', 'update', 'delete'
+
+
+def new_client():
+    return uuid.uuid4().hex
+
+
+# Path of the slot-th journal sharing path
+def journal_path(path, slot):
+    return path if slot == 0 else '%s.%d' % (path, slot)
+
+
+# One queued change of a comment. Creates have no comment_id yet.
+class Operation:
+    FIELDS = ['id', 'kind', 'shelter_id', 'comment_id', 'author', 'content',
+              'client']
+
+    def __init__(self, kind, shelter_id, comment_id=None, author='',
+                 content='', client=None, id=None):
+        self.id = id or uuid.uuid4().hex
+        self.kind = kind
+        self.shelter_id = shelter_id
+        self.comment_id = comment_id
+        self.author = author
+        self.content = content
+        self.client = client
+
+    def to_json(self):
+        return json.dumps(dict((field, getattr(self, field))
+                               for field in self.FIELDS))
+
+    @classmethod
+    def from_json(cls, line):
+        return cls(**json.loads(line))
+
+
+class CommentQueue:
+
+    def __init__(self, ordering=ORDERING, durability=DURABILITY, path=FILE,
+                 batch_size=BATCH_SIZE, max_length=MAX_LENGTH,
+                 background=BACKGROUND, delay=DELAY, journals=JOURNALS):
+        if ordering not in ORDERINGS:
+            raise ImproperlyConfigured(
+                'Comment queue ordering must be one of %s' % ORDERINGS)
+        if durability not in DURABILITIES:
+            raise ImproperlyConfigured(
+                'Comment queue durability must be one of %s' % DURABILITIES)
+        self.ordering = ordering
+        self.durability = durability
+        self.path = path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.background = background
+        self.delay = delay
+        self.journals = journals
+
+        # Every change not committed yet, oldest first (the batch being
+        # applied included)
+        self.operations = []
+        self.condition = Condition()
+        # Held while a batch is applied, so batches never overlap
+        self.apply_lock = Lock()
+        # The journal this process holds (see claim_journal), its lock and
+        # the file changes are appended to
+        self.journal_path = None
+        self.lock = None
+        self.journal = None
+        self.recovered = False
+        self.thread = None
+
+    # Queues a change. If the queue is full, first writes it (in this
+    # thread), so the change never overtakes the ones queued before it.
+    # Safe to call from any thread.
+    def put(self, operation):
+        self.recover()
+        while True:
+            with self.condition:
+                if len(self.operations) < self.max_length:
+                    if self.journal is not None:
+                        self.journal.write(operation.to_json() + '\n')
+                        self.journal.flush()
+                        if self.durability == 'fsync':
+                            os.fsync(self.journal.fileno())
+                    self.operations.append(operation)
+                    self.condition.notify()
+                    break
+            self.flush()
+        if self.background:
+            self.start()
+
+    # Returns the changes the client queued to the shelter's comments,
+    # oldest first
+    def pending(self, client, shelter_id):
+        if not client:
+            return []
+        with self.condition:
+            return [operation for operation in self.operations
+                    if operation.client == client and
+                    operation.shelter_id == shelter_id]
+
+    def __len__(self):
+        with self.condition:
+            return len(self.operations)
+
+    # Loads the changes a previous run left in the journal and opens it for
+    # appending. Only does anything the first time.
+    def recover(self):
+        with self.condition:
+            if self.recovered:
+                return
+            self.recovered = True
+            if self.durability == 'memory':
+                return
+            self.journal_path = self.claim_journal()
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, encoding='utf-8') as file:
+                    for line in file:
+                        try:
+                            self.operations.append(
+                                Operation.from_json(line))
+                        except (ValueError, TypeError):
+                            # Torn by a crash halfway through the write
+                            logger.warning('Skipped a broken line in %s',
+                                           self.journal_path)
+                if self.operations:
+                    logger.info('Recovered %d queued comment changes',
+                                len(self.operations))
+            self._rewrite_journal()
+
+    # Returns the first journal no other process holds, and keeps it
+    # locked. Raises ImproperlyConfigured if every one is held.
+    def claim_journal(self):
+        if fcntl is None:
+            return self.path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        for slot in range(self.journals):
+            path = journal_path(self.path, slot)
+            lock = open(path + '.lock', 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            self.lock = lock
+            return path
+        raise ImproperlyConfigured(
+            'Every comment queue journal at %s is held by another process '
+            '(raise SHELTERME_COMMENT_QUEUE_JOURNALS)' % self.path)
+
+    # Lets go of the journal, leaving whatever is still queued in it
+    def close(self):
+        with self.condition:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.lock is not None:
+                self.lock.close()
+                self.lock = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self._run, name='comment-queue',
+                                 daemon=True)
+            self.thread.start()
+        # Write what's left when the process exits cleanly
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.operations)
+            # Let the rest of the burst arrive
+            time.sleep(self.delay)
+            close_old_connections()
+            try:
+                self.flush()
+            except DatabaseError:
+                logger.exception('Writing queued comments failed')
+                time.sleep(RETRY_DELAY)
+            finally:
+                close_old_connections()
+
+    # Applies every queued change, in batches of up to batch_size, one
+    # transaction each. Returns the number of changes applied.
+    def flush(self):
+        self.recover()
+        applied = 0
+        with self.apply_lock:
+            while True:
+                with self.condition:
+                    batch = self.operations[:self.batch_size]
+                if not batch:
+                    return applied
+                self.apply(batch)
+                with self.condition:
+                    del self.operations[:len(batch)]
+                    self._rewrite_journal()
+                applied += len(batch)
+
+    def apply(self, batch):
+        with transaction.atomic():
+            batch = self._new_changes(batch)
+            if self.ordering == 'fifo':
+                for operation in batch:
+                    apply_operation(operation)
+            else:
+                apply_coalesced(batch)
+
+    # Drops the creates that were already stored (by the run that crashed
+    # before it could rewrite the journal) or whose shelter is gone
+    def _new_changes(self, batch):
+        creates = [operation for operation in batch
+                   if operation.kind == CREATE]
+        if not creates:
+            return batch
+        stored = set(Comment.objects.filter(
+            queue_id__in=[operation.id for operation in creates]
+        ).values_list('queue_id', flat=True))
+        shelters = set(Shelter.objects.filter(
+            pk__in=set(operation.shelter_id for operation in creates)
+        ).values_list('id', flat=True))
+        changes = []
+        for operation in batch:
+            if operation.kind == CREATE:
+                if operation.id in stored:
+                    continue
+                if operation.shelter_id not in shelters:
+                    logger.warning('Dropped a comment on deleted shelter %s',
+                                   operation.shelter_id)
+                    continue
+            changes.append(operation)
+        return changes
+
+    # Replaces the journal with the changes still queued. Called with the
+    # condition held.
+    def _rewrite_journal(self):
+        if self.durability == 'memory':
+            return
+        directory = os.path.dirname(os.path.abspath(self.journal_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                for operation in self.operations:
+                    file.write(operation.to_json() + '\n')
+                file.flush()
+                if self.durability == 'fsync':
+                    os.fsync(file.fileno())
+            os.replace(tmp, self.journal_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        if self.durability == 'fsync':
+            fsync_directory(directory)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+
+
+# Makes a rename in the directory survive a power cut
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Applies one change the way the synchronous views do
+def apply_operation(operation):
+    if operation.kind == CREATE:
+        Comment(author=operation.author, content=operation.content,
+                shelter_id=operation.shelter_id,
+                queue_id=operation.id).save()
+    elif operation.kind == UPDATE:
+        now = timezone.now()
+        if Comment.objects.filter(pk=operation.comment_id).update(
+                content=operation.content, updated_at=now):
+            Shelter.objects.filter(pk=operation.shelter_id).update(
+                updated_at=now)
+    else:
+        comment = Comment.objects.filter(pk=operation.comment_id).first()
+        if comment is not None:
+            comment.delete()
+
+
+# Applies a batch with as few statements as possible: one insert of all
+# the new comments, one update of all the edited ones, one delete, then
+# one update of the count and updated_at of each shelter
+def apply_coalesced(batch):
+    creates, edits, deletes, counts = [], {}, set(), {}
+    for operation in batch:
+        if operation.kind == CREATE:
+            creates.append(Comment(
+                author=operation.author, content=operation.content,
+                shelter_id=operation.shelter_id, queue_id=operation.id))
+        elif operation.kind == UPDATE:
+            edits[operation.comment_id] = operation.content
+            counts.setdefault(operation.shelter_id, 0)
+        else:
+            deletes.add(operation.comment_id)
+    for comment_id in deletes:
+        edits.pop(comment_id, None)
+
+    for comment in creates:
+        counts[comment.shelter_id] = counts.get(comment.shelter_id, 0) + 1
+    Comment.objects.bulk_create(creates)
+    if edits:
+        Comment.objects.filter(pk__in=edits).update(
+            content=Case(*[When(pk=comment_id, then=Value(content))
+                           for comment_id, content in edits.items()]),
+            updated_at=timezone.now())
+    if deletes:
+        deleted = Comment.objects.filter(pk__in=deletes)
+        for shelter_id in deleted.values_list('shelter_id', flat=True):
+            counts[shelter_id] = counts.get(shelter_id, 0) - 1
+        deleted.delete()
+
+    now = timezone.now()
+    for shelter_id, count in counts.items():
+        Shelter.objects.filter(pk=shelter_id).update(
+            comment_count=F('comment_count') + count, updated_at=now)
+
+
+# Returns the comments of a show page with the client's queued changes to
+# them applied, and the change in the number of comments. New comments are
+# unsaved Comment instances, added at the end of the last page.
+def overlay(comments, operations, last_page):
+    comments = list(comments)
+    created, deleted = 0, set()
+    for operation in operations:
+        if operation.kind == CREATE:
+            created += 1
+            if last_page:
+                comments.append(Comment(
+                    author=operation.author, content=operation.content,
+                    shelter_id=operation.shelter_id))
+        elif operation.kind == UPDATE:
+            for comment in comments:
+                if comment.id == operation.comment_id:
+                    comment.content = operation.content
+        else:
+            deleted.add(operation.comment_id)
+            comments = [comment for comment in comments
+                        if comment.id != operation.comment_id]
+    return comments, created - len(deleted)
+
+
+queue = CommentQueue()
@@ -0,0 +1,110 @@
+import os
+from threading import Lock
+from urllib.parse import quote
+from django.db.backends.sqlite3 import base
+from django.db.utils import OperationalError
+
+# SQLite backend for serving traffic: Django's, plus these OPTIONS
+# (everything else still goes to sqlite3.connect()):
+#
+# 'pragmas'        {name: value} set on every new connection, e.g.
+#                  {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+# 'read_only'      open the database read-only (mode=ro plus query_only),
+#                  for the connection reads are routed to
+# 'single_writer'  transactions take SQLite's write lock up front (BEGIN
+#                  IMMEDIATE) and this process's threads queue for it on a
+#                  lock, instead of failing or spinning on SQLITE_BUSY
+#                  halfway through
+
+EXTRA_OPTIONS = ['pragmas', 'read_only', 'single_writer']
+
+_writer_locks = {}
+_writer_locks_lock = Lock()
+
+
+# Returns the process-wide writer lock of a database file
+def writer_lock(name):
+    with _writer_locks_lock:
+        return _writer_locks.setdefault(name, Lock())
+
+
+# Returns the URI that opens the given database read-only. URIs that
+# already pick a mode (like in-memory test databases) are left alone.
+def read_only_uri(name):
+    if name.startswith('file:'):
+        if 'mode=' in name:
+            return name
+        return name + ('&' if '?' in name else '?') + 'mode=ro'
+    return 'file:%s?mode=ro' % quote(os.path.abspath(name))
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        options = self.settings_dict['OPTIONS']
+        self.pragmas = options.get('pragmas', {})
+        self.read_only = options.get('read_only', False)
+        self.single_writer = options.get('single_writer', False)
+        self.holds_writer_lock = False
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        for option in EXTRA_OPTIONS:
+            kwargs.pop(option, None)
+        if self.read_only:
+            kwargs['database'] = read_only_uri(kwargs['database'])
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            # The journal mode is stored in the file; only writers set it
+            if self.read_only and name == 'journal_mode':
+                continue
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if not self.single_writer:
+            return super()._start_transaction_under_autocommit()
+        self.acquire_writer_lock()
+        try:
+            self.cursor().execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self.release_writer_lock()
+            raise
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self.release_writer_lock()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self.release_writer_lock()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self.release_writer_lock()
+
+    # Waits as long as SQLite itself would (the 'timeout' option) before
+    # giving up with the same error SQLite gives
+    def acquire_writer_lock(self):
+        timeout = self.settings_dict['OPTIONS'].get('timeout', 5)
+        lock = writer_lock(self.settings_dict['NAME'])
+        if not lock.acquire(timeout=timeout):
+            raise OperationalError('database is locked')
+        self.holds_writer_lock = True
+
+    def release_writer_lock(self):
+        if self.holds_writer_lock:
+            self.holds_writer_lock = False
+            writer_lock(self.settings_dict['NAME']).release()
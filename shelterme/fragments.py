@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+# Rendered HTML of the shelter card (index page) and shelter header (show
+# page), cached per shelter id and row version. Every write to a shelter
+# gives it a new version (see Shelter.save and adjust_occupancy), so stale
+# fragments are never looked up again and simply age out of the cache.
+
+FRAGMENT_CACHE_ALIAS = getattr(settings, 'SHELTERME_FRAGMENT_CACHE',
+                               'default')
+FRAGMENT_CACHE_TTL = getattr(settings, 'SHELTERME_FRAGMENT_CACHE_TTL',
+                             3600)
+
+# Stand-in for the per-search distance on cached cards, swapped for the
+# real value when the page is assembled
+DISTANCE_TOKEN = '@@distance@@'
+
+
+def _cache():
+    return caches[FRAGMENT_CACHE_ALIAS]
+
+
+def _key(kind, shelter):
+    return 'shelterme:%s:%d:%d' % (kind, shelter.id, shelter.version)
+
+
+# Returns the cached fragments of the given shelters, rendering (and
+# caching) only the ones that aren't cached yet
+def _fragments(kind, template, shelters, context):
+    cache = _cache()
+    keys = [_key(kind, shelter) for shelter in shelters]
+    fragments = cache.get_many(keys)
+
+    rendered = {}
+    for key, shelter in zip(keys, shelters):
+        if key not in fragments:
+            rendered[key] = render_to_string(
+                template, dict(context, shelter=shelter))
+    if rendered:
+        cache.set_many(rendered, FRAGMENT_CACHE_TTL)
+        fragments.update(rendered)
+    return [fragments[key] for key in keys]
+
+
+# Returns the HTML of the index page's shelter cards. The shelters need
+# their location loaded and a distance attribute.
+def render_cards(shelters):
+    cards = _fragments('card', 'shelterme/shelter_card.html', shelters,
+                       {'distance_placeholder': DISTANCE_TOKEN})
+    html = []
+    for card, shelter in zip(cards, shelters):
+        before, token, after = card.rpartition(DISTANCE_TOKEN)
+        html.append(before + '%.1f' % shelter.distance + after)
+    return mark_safe(''.join(html))
+
+
+# Returns the HTML of the show page's shelter header. The shelter needs its
+# location loaded.
+def render_header(shelter):
+    return mark_safe(_fragments('header', 'shelterme/shelter_header.html',
+                                [shelter], {})[0])
@@ -0,0 +1,176 @@
+import re
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+from shelterme.models import Comment, Shelter
+
+# Full-text search over shelter names and street addresses and comment
+# contents.
+#
+# On SQLite it queries the FTS5 indexes made by migration 0008, which
+# triggers keep in sync with every write to the shelter and comment
+# tables. Results are ranked by bm25, with matches in a shelter's name
+# counting NAME_WEIGHT times as much as matches in its address, and the
+# last word of a query matches as a prefix so results show up while
+# typing. Scoring a match costs as much as reading it, so of the comments
+# only the newest RANK_WINDOW matches (by id) are ranked: queries for words
+# in most of a million comments still take milliseconds instead of half a
+# second. There are far fewer shelters and an old shelter is as good a
+# match as a new one, so every matching shelter is ranked. Other databases
+# fall back to unranked icontains filters.
+#
+# The triggers live on the tables themselves: a migration that makes
+# Django rebuild the shelter or comment table on SQLite (adding a NOT NULL
+# column does) drops them, and has to create_triggers() again.
+
+NAME_WEIGHT = 10.0
+
+# Matching comments ranked per query, newest first
+RANK_WINDOW = getattr(settings, 'SHELTERME_FULLTEXT_RANK_WINDOW', 1000)
+
+# Longest query accepted, in characters
+MAX_QUERY_LENGTH = 200
+
+# "quoted phrases" and bare words of a query
+_TERMS = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r'\w+')
+
+
+# Returns the FTS5 MATCH expression of a user's query: every word or
+# "quoted phrase" must match, and the last bare word matches as a prefix.
+# Words are quoted, so nothing the user types is FTS5 syntax. Returns ''
+# if the query has no words.
+def match_expression(query):
+    terms = []
+    prefix = False
+    for phrase, word in _TERMS.findall(query):
+        words = _WORD.findall(phrase or word)
+        if words:
+            terms.append('"%s"' % ' '.join(words))
+            prefix = not phrase
+    if terms and prefix:
+        terms[-1] += ' *'
+    return ' '.join(terms)
+
+
+def _connection(model):
+    return connections[router.db_for_read(model)]
+
+
+# Returns the rowids of the limit best matches of the query in the FTS5
+# table, by the rank expression. With a window, only the newest window
+# matches are ranked.
+def _fts_ids(model, table, query, limit, rank, window=None):
+    with _connection(model).cursor() as cursor:
+        if window is None:
+            cursor.execute(
+                'SELECT rowid FROM %s WHERE %s MATCH %%s '
+                'ORDER BY %s, rowid DESC LIMIT %%s' % (table, table, rank),
+                [match_expression(query), limit])
+        else:
+            cursor.execute(
+                'SELECT rowid FROM (SELECT rowid, %s AS score FROM %s '
+                'WHERE %s MATCH %%s ORDER BY rowid DESC LIMIT %%s) '
+                'ORDER BY score, rowid DESC LIMIT %%s' % (rank, table, table),
+                [match_expression(query), max(window, limit), limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _in_order(queryset, ids):
+    rows = queryset.in_bulk(ids)
+    return [rows[id] for id in ids if id in rows]
+
+
+# Returns up to limit shelters whose name or street address matches the
+# query, best match first
+def search_shelters(query, limit):
+    queryset = Shelter.objects.select_related('location')
+    if _connection(Shelter).vendor == 'sqlite':
+        ids = _fts_ids(Shelter, 'shelterme_shelter_fts', query, limit,
+                       'bm25(shelterme_shelter_fts, %s, 1.0)' % NAME_WEIGHT)
+        return _in_order(queryset, ids)
+    for word in _WORD.findall(query):
+        queryset = queryset.filter(
+            Q(name__icontains=word) | Q(street_addr__icontains=word))
+    return list(queryset.order_by('id')[:limit])
+
+
+# Returns up to limit comments whose content matches the query, best
+# match first
+def search_comments(query, limit):
+    queryset = Comment.objects.all()
+    if _connection(Comment).vendor == 'sqlite':
+        ids = _fts_ids(Comment, 'shelterme_comment_fts', query, limit,
+                       'rank', RANK_WINDOW)
+        return _in_order(queryset, ids)
+    for word in _WORD.findall(query):
+        queryset = queryset.filter(content__icontains=word)
+    return list(queryset.order_by('-id')[:limit])
+
+
+# Same triggers as migration 0008 makes. Check-ins and comment counts don't
+# touch the indexed columns, so they don't touch the indexes either.
+TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS shelterme_shelter_fts_insert
+        AFTER INSERT ON shelterme_shelter BEGIN
+        INSERT INTO shelterme_shelter_fts (rowid, name, street_addr)
+        VALUES (new.id, new.name, new.street_addr);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shelterme_shelter_fts_delete
+        AFTER DELETE ON shelterme_shelter BEGIN
+        INSERT INTO shelterme_shelter_fts
+            (shelterme_shelter_fts, rowid, name, street_addr)
+        VALUES ('delete', old.id, old.name, old.street_addr);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shelterme_shelter_fts_update
+        AFTER UPDATE OF name, street_addr ON shelterme_shelter
+        WHEN old.name IS NOT new.name
+            OR old.street_addr IS NOT new.street_addr BEGIN
+        INSERT INTO shelterme_shelter_fts
+            (shelterme_shelter_fts, rowid, name, street_addr)
+        VALUES ('delete', old.id, old.name, old.street_addr);
+        INSERT INTO shelterme_shelter_fts (rowid, name, street_addr)
+        VALUES (new.id, new.name, new.street_addr);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shelterme_comment_fts_insert
+        AFTER INSERT ON shelterme_comment BEGIN
+        INSERT INTO shelterme_comment_fts (rowid, content)
+        VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shelterme_comment_fts_delete
+        AFTER DELETE ON shelterme_comment BEGIN
+        INSERT INTO shelterme_comment_fts
+            (shelterme_comment_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS shelterme_comment_fts_update
+        AFTER UPDATE OF content ON shelterme_comment
+        WHEN old.content IS NOT new.content BEGIN
+        INSERT INTO shelterme_comment_fts
+            (shelterme_comment_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO shelterme_comment_fts (rowid, content)
+        VALUES (new.id, new.content);
+    END""",
+]
+
+
+# Creates whichever of the sync triggers are missing
+def create_triggers(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in TRIGGERS:
+            cursor.execute(statement)
+
+
+# Puts back any missing sync triggers and rebuilds both indexes from the
+# shelter and comment tables
+def rebuild(using='default'):
+    if connections[using].vendor != 'sqlite':
+        return
+    create_triggers(connections[using])
+    with connections[using].cursor() as cursor:
+        for table in ['shelterme_shelter_fts', 'shelterme_comment_fts']:
+            cursor.execute(
+                "INSERT INTO %s (%s) VALUES ('rebuild')" % (table, table))
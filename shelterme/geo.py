@@ -0,0 +1,151 @@
+from math import asin, cos, floor, radians, sin, sqrt
+from threading import Lock
+from pyzipcode import ZipCodeDatabase
+from zipcodes import list_all, matching
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+
+# Size (in degrees) of one grid cell. Half a degree is ~35 miles of latitude,
+# so a 50 mile search only ever has to look at a handful of cells.
+CELL_SIZE = 0.5
+
+
+# Returns the great-circle distance in miles between two lat/long points
+def haversine(lat1, long1, lat2, long2):
+    lat1, long1, lat2, long2 = map(radians, (lat1, long1, lat2, long2))
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * asin(sqrt(a))
+
+
+# Returns the (lat, long) deltas in degrees that cover radius miles around
+# the given latitude
+def bounding_deltas(lat, radius):
+    lat_delta = radius / MILES_PER_DEGREE_LAT
+    # Longitude degrees shrink towards the poles; clamp so we never divide by
+    # (almost) zero
+    long_scale = max(cos(radians(lat)), 0.01)
+    long_delta = radius / (MILES_PER_DEGREE_LAT * long_scale)
+    return lat_delta, long_delta
+
+
+# In-memory spatial index over ZIP centroids.
+#
+# ZIPs are bucketed into a fixed lat/long grid. A radius query only visits
+# the cells overlapping the search's bounding box and then does an exact
+# haversine check on the ZIPs found there.
+class ZipIndex:
+
+    def __init__(self, rows, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.centroids = {}
+        self.cells = {}
+        for zip_code, lat, long in rows:
+            self.centroids[zip_code] = (lat, long)
+            self.cells.setdefault(self._cell(lat, long), []).append(
+                (zip_code, lat, long))
+
+    def _cell(self, lat, long):
+        return (floor(lat / self.cell_size), floor(long / self.cell_size))
+
+    def __contains__(self, zip_code):
+        return zip_code in self.centroids
+
+    def __len__(self):
+        return len(self.centroids)
+
+    # Returns the (lat, long) centroid of the zip, or None if unknown
+    def centroid(self, zip_code):
+        return self.centroids.get(zip_code)
+
+    # Returns a list of (zip, distance) tuples for every ZIP whose centroid
+    # lies within radius miles of the given zip, nearest first. Unknown zips
+    # return an empty list.
+    def zips_within_radius(self, zip_code, radius):
+        center = self.centroids.get(zip_code)
+        if center is None:
+            return []
+        return self.zips_near(center[0], center[1], radius)
+
+    # Same as zips_within_radius but centered on an arbitrary point
+    def zips_near(self, lat, long, radius):
+        radius = float(radius)
+        lat_delta, long_delta = bounding_deltas(lat, radius)
+        min_row, min_col = self._cell(lat - lat_delta, long - long_delta)
+        max_row, max_col = self._cell(lat + lat_delta, long + long_delta)
+
+        results = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for zip_code, z_lat, z_long in self.cells.get((row, col), ()):
+                    distance = haversine(lat, long, z_lat, z_long)
+                    if distance <= radius:
+                        results.append((zip_code, distance))
+        results.sort(key=lambda result: result[1])
+        return results
+
+
+_zip_index = None
+_zip_index_lock = Lock()
+
+
+# Returns the process-wide ZipIndex, loading it from pyzipcode's bundled
+# database on first use
+def get_zip_index():
+    global _zip_index
+    if _zip_index is None:
+        with _zip_index_lock:
+            if _zip_index is None:
+                rows = ZipCodeDatabase().conn_manager.query(
+                    'SELECT zip, latitude, longitude FROM ZipCodes')
+                _zip_index = ZipIndex(rows)
+    return _zip_index
+
+
+# Title-cases every word of a city name the way the index displays them
+# ("AUBURN UNIVERSITY" -> "Auburn University")
+def normalize_city(city):
+    normalized = ''
+    for word in str(city).split(' '):
+        normalized += word[0].upper() + word[1:len(word)].lower() + ' '
+    return normalized.strip()
+
+
+def normalize_place(zip_info):
+    return (normalize_city(zip_info['city']),
+            str(zip_info['state']).upper())
+
+
+_zip_places = None
+_zip_places_lock = Lock()
+
+
+# Returns the process-wide ZIP -> (city, state) table, built from the
+# zipcodes dataset on first use
+def get_zip_places():
+    global _zip_places
+    if _zip_places is None:
+        with _zip_places_lock:
+            if _zip_places is None:
+                places = {}
+                for zip_info in list_all():
+                    places.setdefault(zip_info['zip_code'],
+                                      normalize_place(zip_info))
+                _zip_places = places
+    return _zip_places
+
+
+# Returns the normalized (city, state) of the given zip, or None if the zip
+# isn't real. Raises ValueError for malformed zips, same as zipcodes.matching
+def lookup_zip(zip_code):
+    zip_code = str(zip_code)
+
+    # Plain 5-digit ZIPs are answered from the table. Anything else (ZIP+4,
+    # junk) goes through zipcodes so validation and errors stay identical.
+    if len(zip_code) == 5 and zip_code.isascii() and zip_code.isdigit():
+        return get_zip_places().get(zip_code)
+    zip_info = matching(zip_code)
+    if not zip_info:
+        return None
+    return normalize_place(zip_info[0])
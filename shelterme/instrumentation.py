@@ -0,0 +1,219 @@
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates
+
+# Per-request timings: how many SQL queries a request ran and how long it
+# spent in SQL, ZIP lookups and template rendering.
+#
+# TimingMiddleware starts a Timings for every request in a context
+# variable, so the numbers follow the request into sync_to_async threads.
+# SQL is timed by an execute wrapper put on every new database connection,
+# rendering by the TimedDjangoTemplates backend and ZIP lookups by timed()
+# blocks in the views. Everything is a couple of perf_counter() calls, so
+# it can stay on in production.
+#
+# The totals go out in a Server-Timing header and into a rolling window of
+# recent requests per view, read by the admin-only api/timings endpoint.
+
+# Recent requests kept per view
+TIMING_WINDOW = getattr(settings, 'SHELTERME_TIMING_WINDOW', 1000)
+
+# Whether responses get a Server-Timing header
+SERVER_TIMING = getattr(settings, 'SHELTERME_SERVER_TIMING', True)
+
+# Upper bounds (ms) of the histogram buckets; the last bucket is open
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Timed parts of a request, in Server-Timing order
+PARTS = ['sql', 'zip', 'render']
+
+_current = ContextVar('shelterme_timings', default=None)
+
+
+class Timings:
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = dict.fromkeys(PARTS, 0.0)
+
+    def add(self, part, seconds):
+        self.seconds[part] += seconds
+
+
+# Times the enclosed block as the given part of the current request. Does
+# nothing outside of a request.
+@contextmanager
+def timed(part):
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(part, perf_counter() - start)
+
+
+def time_sql(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.add('sql', perf_counter() - start)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if time_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_sql)
+
+
+# Django template backend that times every render
+class TimedDjangoTemplates(DjangoTemplates):
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    @property
+    def origin(self):
+        return self.template.origin
+
+    def render(self, context=None, request=None):
+        with timed('render'):
+            return self.template.render(context, request)
+
+
+# Rolling window of the last TIMING_WINDOW requests of every view
+class Histogram:
+
+    def __init__(self, window=TIMING_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = Lock()
+
+    def record(self, view, total, timings):
+        sample = (total, timings.queries,
+                  *(timings.seconds[part] for part in PARTS))
+        with self.lock:
+            samples = self.samples.get(view)
+            if samples is None:
+                samples = self.samples[view] = deque(maxlen=self.window)
+            samples.append(sample)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    # Returns, per view, the number of requests in the window and the
+    # percentiles and histogram of each measurement
+    def snapshot(self):
+        with self.lock:
+            samples = dict((view, list(window))
+                           for view, window in self.samples.items())
+        names = ['total_ms', 'queries'] + [part + '_ms' for part in PARTS]
+        views = {}
+        for view, window in samples.items():
+            stats = {'requests': len(window)}
+            for i, name in enumerate(names):
+                values = sorted(sample[i] for sample in window)
+                if name != 'queries':
+                    values = [value * 1000 for value in values]
+                stats[name] = summarize(values, name != 'queries')
+            views[view] = stats
+        return views
+
+
+def summarize(values, bucketed):
+    def percentile(q):
+        return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+    summary = {'mean': round(sum(values) / len(values), 3),
+               'p50': round(percentile(50), 3),
+               'p90': round(percentile(90), 3),
+               'p99': round(percentile(99), 3),
+               'max': round(values[-1], 3)}
+    if bucketed:
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for value in values:
+            counts[bisect_left(BUCKETS_MS, value)] += 1
+        labels = ['<=%g' % bound for bound in BUCKETS_MS]
+        labels.append('>%g' % BUCKETS_MS[-1])
+        summary['buckets'] = dict(zip(labels, counts))
+    return summary
+
+
+histogram = Histogram()
+
+
+# Returns the Server-Timing header value of a request
+def server_timing(total, timings):
+    entries = ['%s;dur=%.2f' % (part, timings.seconds[part] * 1000)
+               for part in PARTS]
+    entries[0] += ';desc="%d queries"' % timings.queries
+    entries.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(entries)
+
+
+class TimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = Timings()
+        token = _current.set(timings)
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, perf_counter() - start, timings)
+        return response
+
+    async def __acall__(self, request):
+        timings = Timings()
+        token = _current.set(timings)
+        start = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, perf_counter() - start, timings)
+        return response
+
+    # Streaming responses (e.g. capacity streams) are timed up to their
+    # first byte
+    def finish(self, request, response, total, timings):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        histogram.record(view, total, timings)
+        if SERVER_TIMING:
+            response['Server-Timing'] = server_timing(total, timings)
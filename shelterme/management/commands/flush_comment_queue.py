@@ -0,0 +1,33 @@
+import os
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from shelterme import comment_queue
+
+
+class Command(BaseCommand):
+    help = ('Writes the comment changes left in the write-behind queue '
+            'journals, e.g. after the server crashed or write-behind was '
+            'turned off. Run it while the server is stopped.')
+
+    def handle(self, *args, **options):
+        if comment_queue.DURABILITY == 'memory':
+            raise CommandError('The comment queue keeps no journal '
+                               '(SHELTERME_COMMENT_QUEUE_DURABILITY is '
+                               "'memory').")
+        applied = 0
+        for slot in range(comment_queue.JOURNALS):
+            path = comment_queue.journal_path(comment_queue.FILE, slot)
+            if not os.path.exists(path):
+                continue
+            # Only this journal, and only if no server holds it
+            queue = comment_queue.CommentQueue(
+                durability=comment_queue.DURABILITY, path=path,
+                background=False, journals=1)
+            try:
+                applied += queue.flush()
+            except ImproperlyConfigured:
+                raise CommandError('%s is held by a running server.' % path)
+            finally:
+                queue.close()
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote %d queued comment changes.' % applied))
@@ -0,0 +1,227 @@
+import csv
+import json
+import time
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from shelterme import search_cache
+from shelterme.models import Location, Shelter, location_key, new_version
+from shelterme.views import valid_city_state_zip
+
+# Accepted column names for each Shelter field, first match wins
+COLUMNS = {
+    'name': ['name', 'shelter_name'],
+    'street_addr': ['street_addr', 'street_address', 'address'],
+    'city': ['city'],
+    'state': ['state'],
+    'zip': ['zip', 'zip_code'],
+    'max_capacity': ['max_capacity', 'capacity'],
+    'current_capacity': ['current_capacity'],
+    'photo': ['photo', 'photourl'],
+}
+
+
+# Yields row dicts from a CSV file with a header row
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield row
+
+
+# Yields rows from a JSON Lines file, one object per line. Lines that
+# aren't valid JSON are yielded as-is so they get rejected like any other
+# bad row.
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line
+
+
+# Yields rows from a file holding a single JSON array. The array is parsed
+# in one go, so prefer JSON Lines for very large feeds.
+def read_json(f):
+    rows = json.load(f)
+    if not isinstance(rows, list):
+        raise CommandError('JSON input must be an array of objects.')
+    for row in rows:
+        yield row
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'json': read_json}
+
+
+def column(row, field):
+    for name in COLUMNS[field]:
+        value = row.get(name)
+        if value not in (None, ''):
+            return str(value).strip()
+    return ''
+
+
+# Returns the cleaned shelter fields of a row. Raises ValueError with the
+# reason if the row is rejected.
+def clean_row(row):
+    if not isinstance(row, dict):
+        raise ValueError('row is not an object')
+
+    name = column(row, 'name')
+    if not name or len(name) > 50:
+        raise ValueError('name must be 1-50 characters')
+
+    street_addr = column(row, 'street_addr')
+    if not street_addr or len(street_addr) > 100:
+        raise ValueError('street address must be 1-100 characters')
+
+    # Normalize city and state the same way the create view does
+    city = column(row, 'city')
+    state = column(row, 'state').upper()
+    zip = column(row, 'zip')
+    if city:
+        city = city[0].upper() + city[1:len(city)].lower()
+    if not valid_city_state_zip(city, state, zip):
+        raise ValueError('city, state and ZIP do not match')
+
+    try:
+        max_capacity = int(column(row, 'max_capacity'))
+        current_capacity = int(column(row, 'current_capacity') or 0)
+    except ValueError:
+        raise ValueError('capacity must be a whole number')
+    if max_capacity <= 0 or max_capacity > 10000:
+        raise ValueError('max capacity must be between 1 and 10,000')
+    if current_capacity < 0 or current_capacity > max_capacity:
+        raise ValueError('current capacity must be between 0 and max')
+
+    photo = column(row, 'photo')
+    if not photo:
+        photo = 'shelterme/logo.png'
+    elif photo[0:7] != 'http://' and photo[0:8] != 'https://':
+        raise ValueError('invalid photo URL')
+
+    return {'name': name, 'street_addr': street_addr, 'city': city,
+            'state': state, 'zip': zip, 'max_capacity': max_capacity,
+            'current_capacity': current_capacity, 'photo': photo}
+
+
+class Command(BaseCommand):
+    help = 'Bulk imports shelters from a CSV, JSON Lines or JSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='Input format (default: from the file extension)')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Shelters inserted per transaction (default: 500)')
+        parser.add_argument(
+            '--owner', default='Import',
+            help='Owner recorded on imported shelters (default: Import)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if input_format not in READERS:
+            raise CommandError(
+                'Unknown format %r, use --format.' % input_format)
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        # Locations seen so far, by lookup key
+        self.locations = {}
+        self.owner = options['owner']
+        imported = 0
+        rejected = 0
+        start = time.monotonic()
+
+        try:
+            f = open(path, newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(str(error))
+
+        with f:
+            rows = enumerate(READERS[input_format](f), start=1)
+            while True:
+                batch = []
+                for number, row in islice(rows, batch_size):
+                    try:
+                        batch.append(clean_row(row))
+                    except ValueError as error:
+                        rejected += 1
+                        self.stderr.write('Rejected row %d: %s' % (
+                            number, error))
+                if not batch:
+                    break
+                imported += self.import_batch(batch)
+
+        if imported and not search_cache.versions_shared():
+            self.stderr.write(
+                'The search cache versions are kept per process, so running '
+                'servers may not list the new shelters for up to %d '
+                'seconds.' % search_cache.SEARCH_CACHE_TTL)
+
+        elapsed = time.monotonic() - start
+        rate = imported / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            'Imported %d shelters, rejected %d rows in %.2fs (%.0f rows/s)'
+            % (imported, rejected, elapsed, rate)))
+
+    # Inserts one batch of cleaned rows in a single transaction and returns
+    # how many shelters were created
+    def import_batch(self, batch):
+        with transaction.atomic():
+            self.resolve_locations(batch)
+            shelters = []
+            for fields in batch:
+                key = (location_key(fields['city']),
+                       location_key(fields['state']))
+                shelter = Shelter(
+                    name=fields['name'], street_addr=fields['street_addr'],
+                    location=self.locations[key], zip=fields['zip'],
+                    max_capacity=fields['max_capacity'],
+                    current_capacity=fields['current_capacity'],
+                    free_beds=(fields['max_capacity'] -
+                               fields['current_capacity']),
+                    photo=fields['photo'], owner=self.owner,
+                    version=new_version())
+                shelter.fill_coordinates()
+                shelters.append(shelter)
+            Shelter.objects.bulk_create(shelters)
+
+        # bulk_create skips the model signals, so invalidate the search
+        # cache ourselves (once per distinct point). The running servers
+        # see it through the shared version cache.
+        points = set((s.latitude, s.longitude) for s in shelters)
+        for lat, long in points:
+            search_cache.invalidate_point(lat, long)
+        return len(shelters)
+
+    # Makes sure every location the batch needs is in self.locations,
+    # fetching existing ones and creating missing ones in bulk
+    def resolve_locations(self, batch):
+        missing = {}
+        for fields in batch:
+            key = (location_key(fields['city']),
+                   location_key(fields['state']))
+            if key not in self.locations:
+                missing[key] = (fields['city'], fields['state'])
+        if not missing:
+            return
+
+        new = []
+        for city, state in missing.values():
+            location = Location(city=city, state=state)
+            location.fill_keys()
+            new.append(location)
+        # Rows created concurrently by someone else are skipped here and
+        # picked up by the query below
+        Location.objects.bulk_create(new, ignore_conflicts=True)
+
+        found = Location.objects.filter(
+            city_key__in=set(city for city, state in missing),
+            state_key__in=set(state for city, state in missing))
+        for location in found:
+            self.locations[(location.city_key, location.state_key)] = location
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from shelterme import thumbnails
+from shelterme.models import Shelter
+
+
+class Command(BaseCommand):
+    help = ('Makes the thumbnails of every shelter photo that has none yet, '
+            'e.g. photos that failed or were queued when the server '
+            'stopped.')
+
+    def handle(self, *args, **options):
+        if not thumbnails.available():
+            raise CommandError('Making thumbnails needs Pillow.')
+
+        ids = Shelter.objects.exclude(thumbnail_source=F('photo')).filter(
+            photo__regex=r'^https?://').values_list('id', flat=True)
+        made = failed = 0
+        for shelter_id in ids.iterator():
+            if thumbnails.process(shelter_id):
+                made += 1
+            else:
+                failed += 1
+        self.stdout.write(self.style.SUCCESS(
+            'Made thumbnails for %d shelters, %d failed.' % (made, failed)))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from shelterme import fulltext
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the full-text indexes of shelters and comments from '
+            'their tables, putting back any missing sync triggers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        fulltext.rebuild(options['database'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt the full-text indexes.'))
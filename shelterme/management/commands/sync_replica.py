@@ -0,0 +1,37 @@
+import os
+import sqlite3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from shelterme.routers import REPLICA_DATABASES
+
+
+class Command(BaseCommand):
+    help = ('Copies the primary SQLite database into the replica files, '
+            'for trying out read replicas locally.')
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]['NAME']
+        if not os.path.exists(primary):
+            raise CommandError('%s does not exist, run migrate first.'
+                               % primary)
+
+        for alias in REPLICA_DATABASES:
+            path = settings.DATABASES[alias]['NAME']
+            if os.path.abspath(path) == os.path.abspath(primary):
+                self.stdout.write('%s is the primary itself, skipped.'
+                                  % alias)
+                continue
+
+            # The backup API copies a consistent snapshot, even while the
+            # primary is being written to
+            source = sqlite3.connect(primary)
+            target = sqlite3.connect(path)
+            try:
+                source.backup(target)
+                target.execute('PRAGMA journal_mode = WAL')
+            finally:
+                target.close()
+                source.close()
+            self.stdout.write(self.style.SUCCESS(
+                'Copied %s to %s (%s)' % (primary, path, alias)))
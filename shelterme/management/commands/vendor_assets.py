@@ -0,0 +1,93 @@
+import io
+import os
+import tarfile
+import zipfile
+from hashlib import sha256
+from urllib.request import urlopen
+from django.core.management.base import BaseCommand, CommandError
+
+# Front-end libraries served from our own static files instead of CDNs,
+# taken from pinned (by sha256) release archives on PyPI. Bootstrap and
+# jQuery are byte for byte the files the CDNs served (same SRI hashes).
+# Font Awesome 5.3.1 isn't published there; the pages only use two of its
+# solid icons, which 6.2.1's solid subset still has under the same names.
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'static', 'shelterme', 'vendor')
+
+PACKAGES = 'https://files.pythonhosted.org/packages/'
+
+LIBRARIES = [
+    {
+        'name': 'bootstrap-3.3.7',
+        'url': PACKAGES + 'eb/c6/430b58138a36afbe435f3aa07456380b065d7f3d29'
+                          '964b4ad7406e2dfe20/XStatic-Bootstrap-3.3.7.1'
+                          '.tar.gz',
+        'sha256': '0c949e78e8cd77983fd803a68a98df0124e0c3a872fddb9ac8e6e5b4'
+                  'a487f131',
+        'root': 'XStatic-Bootstrap-3.3.7.1/xstatic/pkg/bootstrap/data/',
+        'files': ['css/bootstrap.min.css', 'js/bootstrap.min.js',
+                  'fonts/glyphicons-halflings-regular.eot',
+                  'fonts/glyphicons-halflings-regular.svg',
+                  'fonts/glyphicons-halflings-regular.ttf',
+                  'fonts/glyphicons-halflings-regular.woff',
+                  'fonts/glyphicons-halflings-regular.woff2'],
+    },
+    {
+        'name': 'jquery-3.3.1',
+        'url': PACKAGES + 'b5/c8/b254c4b7b9421086bbb00cc04fa13d002db206dd83'
+                          '2940864cc54723453c/XStatic-jQuery-3.3.1.1.tar.gz',
+        'sha256': '12590eddfc279a0331f1f8ccec65038b7949f5e5577f71d165ee2f45'
+                  '33d18f76',
+        'root': 'XStatic-jQuery-3.3.1.1/xstatic/pkg/jquery/data/',
+        'files': ['jquery.min.js'],
+    },
+    {
+        'name': 'fontawesome-6.2.1',
+        'url': PACKAGES + 'bc/9f/d510c7b3b0204fdb704b65c7a263cc3b8abef9dca2'
+                          'cae9bc795c050803f3/xstatic_font_awesome-6.2.1.2-'
+                          'py3-none-any.whl',
+        'sha256': '3a72f8ba064a15585efe57f8f032b4c63eeb60b188304990021023'
+                  '053a29aafc',
+        'root': 'xstatic/pkg/font_awesome/data/',
+        'files': ['css/fontawesome.min.css', 'css/solid.min.css',
+                  'webfonts/fa-solid-900.woff2',
+                  'webfonts/fa-solid-900.ttf', 'LICENSE.txt'],
+    },
+]
+
+
+# Returns {member name: bytes} of a .tar.gz or .whl (zip) archive
+def read_archive(data):
+    if data[:2] == b'\x1f\x8b':
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as archive:
+            return dict((member.name, archive.extractfile(member).read())
+                        for member in archive.getmembers()
+                        if member.isfile())
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return dict((name, archive.read(name))
+                    for name in archive.namelist())
+
+
+class Command(BaseCommand):
+    help = ('Downloads the pinned front-end libraries into '
+            'shelterme/static/shelterme/vendor. The result is committed; '
+            'run this only to change versions.')
+
+    def handle(self, *args, **options):
+        for library in LIBRARIES:
+            with urlopen(library['url'], timeout=60) as response:
+                data = response.read()
+            if sha256(data).hexdigest() != library['sha256']:
+                raise CommandError('%s: checksum mismatch, not using %s'
+                                   % (library['name'], library['url']))
+            members = read_archive(data)
+
+            target = os.path.join(VENDOR_DIR, library['name'])
+            for name in library['files']:
+                path = os.path.join(target, *name.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as file:
+                    file.write(members[library['root'] + name])
+            self.stdout.write(self.style.SUCCESS(
+                'Vendored %s (%d files)' % (library['name'],
+                                            len(library['files']))))
@@ -0,0 +1,49 @@
+from django.db import migrations, models
+
+
+def location_key(value):
+    return ' '.join(str(value).split()).casefold()
+
+
+# Fill in the lookup keys and merge duplicate locations into the oldest row
+# so the unique constraint can be added
+def populate_location_keys(apps, schema_editor):
+    Location = apps.get_model('shelterme', 'Location')
+    Shelter = apps.get_model('shelterme', 'Shelter')
+    kept = {}
+    for location in Location.objects.order_by('id'):
+        key = (location_key(location.city), location_key(location.state))
+        if key in kept:
+            Shelter.objects.filter(location=location).update(
+                location=kept[key])
+            location.delete()
+            continue
+        location.city_key, location.state_key = key
+        location.save(update_fields=['city_key', 'state_key'])
+        kept[key] = location
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='city_key',
+            field=models.CharField(default='', editable=False, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='state_key',
+            field=models.CharField(default='', editable=False, max_length=2),
+        ),
+        migrations.RunPython(populate_location_keys,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='location',
+            constraint=models.UniqueConstraint(fields=('city_key', 'state_key'), name='unique_location_key'),
+        ),
+    ]
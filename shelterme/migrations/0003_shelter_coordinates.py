@@ -0,0 +1,39 @@
+from django.db import migrations, models
+from shelterme.geo import get_zip_index
+
+
+# Fill in coordinates for shelters saved before they were tracked
+def populate_coordinates(apps, schema_editor):
+    Shelter = apps.get_model('shelterme', 'Shelter')
+    index = get_zip_index()
+    for shelter in Shelter.objects.all():
+        centroid = index.centroid(shelter.zip)
+        if centroid:
+            shelter.latitude, shelter.longitude = centroid
+            shelter.save(update_fields=['latitude', 'longitude'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0002_location_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shelter',
+            name='latitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='shelter',
+            name='longitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='shelter',
+            index=models.Index(fields=['latitude', 'longitude'], name='shelter_lat_long_idx'),
+        ),
+        migrations.RunPython(populate_coordinates,
+                             migrations.RunPython.noop),
+    ]
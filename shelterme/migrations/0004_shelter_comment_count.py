@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+# Count the comments of shelters that existed before the counter did
+def populate_comment_counts(apps, schema_editor):
+    Shelter = apps.get_model('shelterme', 'Shelter')
+    shelters = Shelter.objects.annotate(
+        comments=models.Count('comment')).filter(comments__gt=0)
+    for shelter in shelters:
+        Shelter.objects.filter(pk=shelter.pk).update(
+            comment_count=shelter.comments)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0003_shelter_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shelter',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_comment_counts,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0004_shelter_comment_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shelter',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def populate_free_beds(apps, schema_editor):
+    Shelter = apps.get_model('shelterme', 'Shelter')
+    Shelter.objects.update(
+        free_beds=F('max_capacity') - F('current_capacity'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0006_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shelter',
+            name='free_beds',
+            field=models.IntegerField(default=10, editable=False),
+        ),
+        migrations.RunPython(populate_free_beds,
+                             migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='shelter',
+            name='shelter_lat_long_idx',
+        ),
+        migrations.AddIndex(
+            model_name='shelter',
+            index=models.Index(fields=['latitude', 'longitude', 'free_beds'],
+                               name='shelter_lat_long_free_idx'),
+        ),
+    ]
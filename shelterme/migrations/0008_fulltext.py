@@ -0,0 +1,97 @@
+from django.db import migrations
+
+# FTS5 indexes over shelter names / street addresses and comment contents.
+# They are external content tables: the text stays in the shelter and
+# comment tables and triggers keep the indexes in sync with every insert,
+# update and delete, whatever code path (views, bulk imports, cascades)
+# makes it. Words are stemmed (porter) and 2 and 3 letter prefixes are
+# indexed so prefix queries don't have to scan the term list.
+
+CREATE = [
+    """CREATE VIRTUAL TABLE shelterme_shelter_fts USING fts5(
+        name, street_addr, content='shelterme_shelter', content_rowid='id',
+        tokenize='porter unicode61', prefix='2 3')""",
+    """CREATE TRIGGER shelterme_shelter_fts_insert
+        AFTER INSERT ON shelterme_shelter BEGIN
+        INSERT INTO shelterme_shelter_fts (rowid, name, street_addr)
+        VALUES (new.id, new.name, new.street_addr);
+    END""",
+    """CREATE TRIGGER shelterme_shelter_fts_delete
+        AFTER DELETE ON shelterme_shelter BEGIN
+        INSERT INTO shelterme_shelter_fts
+            (shelterme_shelter_fts, rowid, name, street_addr)
+        VALUES ('delete', old.id, old.name, old.street_addr);
+    END""",
+    # Check-ins and comment counts don't touch the indexed columns, so
+    # they don't touch the index either
+    """CREATE TRIGGER shelterme_shelter_fts_update
+        AFTER UPDATE OF name, street_addr ON shelterme_shelter
+        WHEN old.name IS NOT new.name
+            OR old.street_addr IS NOT new.street_addr BEGIN
+        INSERT INTO shelterme_shelter_fts
+            (shelterme_shelter_fts, rowid, name, street_addr)
+        VALUES ('delete', old.id, old.name, old.street_addr);
+        INSERT INTO shelterme_shelter_fts (rowid, name, street_addr)
+        VALUES (new.id, new.name, new.street_addr);
+    END""",
+    """CREATE VIRTUAL TABLE shelterme_comment_fts USING fts5(
+        content, content='shelterme_comment', content_rowid='id',
+        tokenize='porter unicode61', prefix='2 3')""",
+    """CREATE TRIGGER shelterme_comment_fts_insert
+        AFTER INSERT ON shelterme_comment BEGIN
+        INSERT INTO shelterme_comment_fts (rowid, content)
+        VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER shelterme_comment_fts_delete
+        AFTER DELETE ON shelterme_comment BEGIN
+        INSERT INTO shelterme_comment_fts
+            (shelterme_comment_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER shelterme_comment_fts_update
+        AFTER UPDATE OF content ON shelterme_comment
+        WHEN old.content IS NOT new.content BEGIN
+        INSERT INTO shelterme_comment_fts
+            (shelterme_comment_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO shelterme_comment_fts (rowid, content)
+        VALUES (new.id, new.content);
+    END""",
+    # Index the rows that are already there
+    "INSERT INTO shelterme_shelter_fts (shelterme_shelter_fts) "
+    "VALUES ('rebuild')",
+    "INSERT INTO shelterme_comment_fts (shelterme_comment_fts) "
+    "VALUES ('rebuild')",
+]
+
+DROP = [
+    'DROP TRIGGER IF EXISTS shelterme_shelter_fts_insert',
+    'DROP TRIGGER IF EXISTS shelterme_shelter_fts_delete',
+    'DROP TRIGGER IF EXISTS shelterme_shelter_fts_update',
+    'DROP TABLE IF EXISTS shelterme_shelter_fts',
+    'DROP TRIGGER IF EXISTS shelterme_comment_fts_insert',
+    'DROP TRIGGER IF EXISTS shelterme_comment_fts_delete',
+    'DROP TRIGGER IF EXISTS shelterme_comment_fts_update',
+    'DROP TABLE IF EXISTS shelterme_comment_fts',
+]
+
+
+# Other databases search with shelterme.fulltext's fallback instead
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0007_shelter_free_beds'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE), run_on_sqlite(DROP)),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from shelterme import fulltext
+
+
+# Adding the columns makes Django rebuild the shelter table on SQLite,
+# which drops the full-text sync triggers on it. So does removing them when
+# the migration is reversed, hence the first operation, which only runs
+# backwards, last.
+def create_fulltext_triggers(apps, schema_editor):
+    fulltext.create_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0008_fulltext'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop,
+                             create_fulltext_triggers),
+        migrations.AddField(
+            model_name='shelter',
+            name='thumbnail',
+            field=models.CharField(default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='shelter',
+            name='thumbnail_source',
+            field=models.URLField(default='', editable=False),
+        ),
+        migrations.RunPython(create_fulltext_triggers,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.db.models import Q
+from shelterme import fulltext
+
+
+def create_fulltext_triggers(apps, schema_editor):
+    fulltext.create_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shelterme', '0009_shelter_thumbnail'),
+    ]
+
+    # A nullable column and a partial index: SQLite adds both in place,
+    # without rebuilding the comment table (and dropping its full-text
+    # triggers). SQLite before 3.35.5 does rebuild it to remove the column
+    # when the migration is reversed, hence the first operation, which only
+    # runs backwards, last.
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop,
+                             create_fulltext_triggers),
+        migrations.AddField(
+            model_name='comment',
+            name='queue_id',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='comment',
+            constraint=models.UniqueConstraint(
+                condition=Q(queue_id__isnull=False), fields=('queue_id',),
+                name='unique_comment_queue_id'),
+        ),
+    ]
@@ -1,16 +1,160 @@
-from django.db import models
+from time import time_ns
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.urls import reverse
+from django.utils import timezone
+from shelterme.geo import bounding_deltas, get_zip_index, haversine
 # from django.contrib.auth.models import User
 
 
+# Returns the case-folded form of a city or state used for lookups
+def location_key(value):
+    return ' '.join(str(value).split()).casefold()
+
+
+class LocationManager(models.Manager):
+
+    # Returns the location matching city and state (case-insensitively),
+    # or None if there isn't one
+    def get_by_city_state(self, city, state):
+        return self.filter(city_key=location_key(city),
+                           state_key=location_key(state)).first()
+
+    # Returns (location, created). Safe against concurrent creates: the
+    # unique constraint on the lookup key makes the loser of a race fetch
+    # the winner's row instead of inserting a duplicate.
+    def get_or_create_by_city_state(self, city, state):
+        return self.get_or_create(
+            city_key=location_key(city), state_key=location_key(state),
+            defaults={'city': city, 'state': state})
+
+
 # Create your models here.
 class Location(models.Model):
     city = models.CharField(max_length=50, default='')
     state = models.CharField(max_length=2, default='')
 
+    # Normalized copies of city and state, kept in sync on save
+    city_key = models.CharField(max_length=50, default='', editable=False)
+    state_key = models.CharField(max_length=2, default='', editable=False)
+
+    objects = LocationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city_key', 'state_key'],
+                                    name='unique_location_key'),
+        ]
+
+    # Sets the lookup keys from city and state. Called by save(); call it
+    # yourself before bulk_create.
+    def fill_keys(self):
+        self.city_key = location_key(self.city)
+        self.state_key = location_key(self.state)
+
+    def save(self, *args, **kwargs):
+        self.fill_keys()
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.city + ', ' + self.state
 
 
+# Returns a fresh version stamp for a shelter row
+def new_version():
+    return time_ns()
+
+
+# Returns the given shelters that are within radius miles of (lat, long),
+# nearest first (ties broken by id). Each shelter gets a distance attribute
+# in miles. Pure Python, so async callers can run it in an executor.
+def within_distance(shelters, lat, long, radius):
+    results = []
+    for shelter in shelters:
+        shelter.distance = haversine(lat, long, shelter.latitude,
+                                     shelter.longitude)
+        if shelter.distance <= radius:
+            results.append(shelter)
+    results.sort(key=lambda shelter: (shelter.distance, shelter.id))
+    return results
+
+
+class ShelterQuerySet(models.QuerySet):
+
+    # Returns the shelters in the bounding box of a radius search. Cheap
+    # prefilter in SQL that uses the lat/long index.
+    def in_bounding_box(self, lat, long, radius):
+        lat_delta, long_delta = bounding_deltas(lat, radius)
+        return self.filter(
+            latitude__range=(lat - lat_delta, lat + lat_delta),
+            longitude__range=(long - long_delta, long + long_delta))
+
+    # Returns a list of the shelters within radius miles of (lat, long),
+    # nearest first (ties broken by id). Each shelter gets a distance
+    # attribute in miles.
+    def within_radius(self, lat, long, radius):
+        return within_distance(self.in_bounding_box(lat, long, radius),
+                               lat, long, radius)
+
+    # Same as within_radius, centered on the given zip. Unknown zips return
+    # an empty list.
+    def near_zip(self, zip_code, radius):
+        center = get_zip_index().centroid(zip_code)
+        if center is None:
+            return []
+        return self.within_radius(center[0], center[1], radius)
+
+    # Adds delta people (negative to remove them) to the shelter's
+    # current_capacity with a single conditional UPDATE, so concurrent
+    # check-ins can never push it past max_capacity or below zero and no
+    # row is read first. Returns True if the change was applied, False if
+    # it didn't fit (or the shelter doesn't exist).
+    def adjust_occupancy(self, shelter_id, delta):
+        shelters = self.filter(pk=shelter_id)
+        if delta > 0:
+            shelters = shelters.filter(
+                current_capacity__lte=F('max_capacity') - delta)
+        elif delta < 0:
+            shelters = shelters.filter(current_capacity__gte=-delta)
+        else:
+            return shelters.exists()
+        updated = shelters.update(
+            current_capacity=F('current_capacity') + delta,
+            free_beds=F('free_beds') - delta,
+            version=new_version(), updated_at=timezone.now())
+        return updated == 1
+
+    # Returns up to limit (id, free beds, distance) triples of the shelters
+    # within radius miles of (lat, long) with at least min_free_beds free
+    # beds, most free beds first (ties broken by id), starting after the
+    # (free beds, id) key in after. SQLite answers from the lat/long/free_beds
+    # covering index without reading table rows, but it reads and sorts
+    # every shelter in the bounding box before returning the first one. Only
+    # fetching the sorted rows and computing distances stop once limit
+    # shelters are found.
+    def most_available(self, lat, long, radius, limit, min_free_beds=0,
+                       after=None):
+        shelters = self.in_bounding_box(lat, long, radius).filter(
+            free_beds__gte=min_free_beds)
+        if after is not None:
+            free_beds, shelter_id = after
+            shelters = shelters.filter(
+                Q(free_beds__lt=free_beds) |
+                Q(free_beds=free_beds, id__gt=shelter_id))
+        rows = shelters.order_by('-free_beds', 'id').values_list(
+            'id', 'free_beds', 'latitude', 'longitude')
+
+        results = []
+        for shelter_id, free_beds, latitude, longitude in rows.iterator(
+                chunk_size=max(limit, 100)):
+            distance = haversine(lat, long, latitude, longitude)
+            if distance <= radius:
+                results.append((shelter_id, free_beds, distance))
+                if len(results) == limit:
+                    break
+        return results
+
+
 class Shelter(models.Model):
     name = models.CharField(max_length=50, default='')
     street_addr = models.CharField(max_length=100, default='')
@@ -24,6 +168,80 @@ class Shelter(models.Model):
     #                           default='') # TODO
     owner = models.CharField(max_length=50, default='')
 
+    # Number of comments, kept up to date by Comment.save() / delete() so
+    # the show page doesn't need a COUNT(*)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Changes on every write (save or occupancy change); cached fragments
+    # of the shelter are keyed on it
+    version = models.BigIntegerField(default=0, editable=False)
+
+    # Last time the shelter or one of its comments changed; conditional
+    # GETs of the index and show pages are validated against it
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # max_capacity - current_capacity, kept in step by save() and
+    # adjust_occupancy so searches can filter and sort on it in SQL
+    free_beds = models.IntegerField(default=10, editable=False)
+
+    # Content hash of the photo the thumbnails were made from and the URL
+    # it was fetched from, set by shelterme.thumbnails. Until the current
+    # photo is processed the pages show the logo.
+    thumbnail = models.CharField(max_length=20, default='', editable=False)
+    thumbnail_source = models.URLField(default='', editable=False)
+
+    # Centroid of the shelter's ZIP, filled in on save
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+
+    objects = ShelterQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Covers the bounding box prefilter and the free beds
+            # filter / sort of availability searches
+            models.Index(fields=['latitude', 'longitude', 'free_beds'],
+                         name='shelter_lat_long_free_idx'),
+        ]
+
+    # Sets latitude and longitude from the zip. Called by save(); call it
+    # yourself before bulk_create.
+    def fill_coordinates(self):
+        self.latitude, self.longitude = (
+            get_zip_index().centroid(self.zip) or (None, None))
+
+    def save(self, *args, **kwargs):
+        self.fill_coordinates()
+        self.version = new_version()
+        # The views set the capacities straight from the form, as strings
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and \
+                'current_capacity' not in update_fields:
+            # current_capacity isn't written (check-ins may have changed
+            # it since it was read), so work from the stored value
+            self.free_beds = int(self.max_capacity) - F('current_capacity')
+        else:
+            self.free_beds = (int(self.max_capacity) -
+                              int(self.current_capacity))
+        super().save(*args, **kwargs)
+
+    # URLs of the thumbnails of the current photo in the given size, as
+    # {'webp': url, 'jpg': url}, or None if they aren't made yet
+    def thumbnail_urls(self, size):
+        if not self.thumbnail or self.thumbnail_source != self.photo:
+            return None
+        return dict((ext, reverse('shelterme:thumbnail', args=(
+            '%s-%s.%s' % (self.thumbnail, size, ext),)))
+            for ext in ['webp', 'jpg'])
+
+    @property
+    def card_thumbnails(self):
+        return self.thumbnail_urls('card')
+
+    @property
+    def header_thumbnails(self):
+        return self.thumbnail_urls('header')
+
     def __str__(self):
         return (
             self.name +
@@ -39,6 +257,42 @@ class Comment(models.Model):
     author = models.CharField(max_length=50, default='')
     content = models.TextField(default='')
     shelter = models.ForeignKey(Shelter, on_delete=models.CASCADE, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Id of the queued change that made the comment, so replaying the
+    # queue's journal never stores it twice (see shelterme.comment_queue)
+    queue_id = models.CharField(max_length=32, null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['queue_id'], condition=Q(queue_id__isnull=False),
+                name='unique_comment_queue_id'),
+        ]
+
+    # Saving a comment touches its shelter's updated_at (which validates
+    # the show page), and new comments bump its comment_count, in the same
+    # transaction
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            changes = {'updated_at': timezone.now()}
+            if adding:
+                changes['comment_count'] = F('comment_count') + 1
+            Shelter.objects.filter(pk=self.shelter_id).update(**changes)
+
+    # Only a delete that removed the row takes it off comment_count: a stale
+    # copy of an already deleted comment deletes nothing
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            deleted = result[1].get(self._meta.label, 0)
+            if deleted:
+                Shelter.objects.filter(pk=self.shelter_id).update(
+                    comment_count=F('comment_count') - deleted,
+                    updated_at=timezone.now())
+        return result
 
     def __str__(self):
         return self.author + ' -- ' + self.content
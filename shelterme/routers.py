@@ -0,0 +1,139 @@
+import random
+from contextvars import ContextVar
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Alias of the read-only connection reads go to (see DATABASES)
+READ_DATABASE = getattr(settings, 'SHELTERME_READ_DATABASE', 'readonly')
+
+# Aliases of the read replicas views decorated with replica_reads read
+# from. Replicas may lag behind the primary.
+REPLICA_DATABASES = getattr(settings, 'SHELTERME_REPLICA_DATABASES', [])
+
+# Seconds a client that just wrote keeps reading from the primary, so it
+# sees its own writes however far the replicas lag (up to this long)
+REPLICA_LAG = getattr(settings, 'SHELTERME_REPLICA_LAG', 5)
+
+STICKY_COOKIE = 'shelterme_primary'
+
+
+# Database choices of the current request
+class RequestDatabases:
+
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+_current = ContextVar('shelterme_databases', default=None)
+
+
+# Sends writes to the default (primary) database and reads to the
+# read-only connection of the same database, or to a replica for views
+# decorated with replica_reads. Reads made inside a transaction on the
+# primary, or after the request wrote anything, stay on the primary.
+class ReadWriteRouter:
+
+    def db_for_read(self, model, **hints):
+        if READ_DATABASE not in settings.DATABASES:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        databases = _current.get()
+        if databases is not None and databases.replica \
+                and not databases.wrote:
+            return databases.replica
+        return READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        databases = _current.get()
+        if databases is not None:
+            databases.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    # Every alias is a copy of the same database
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = [DEFAULT_DB_ALIAS, READ_DATABASE] + REPLICA_DATABASES
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    # Only the primary is migrated; the rest are copies of it
+    def allow_migrate(self, db, app_label, **hints):
+        if db == READ_DATABASE or db in REPLICA_DATABASES:
+            return False
+        return None
+
+
+# Lets the view read from a randomly picked replica on GET and HEAD
+# requests, unless the client wrote something in the last REPLICA_LAG
+# seconds
+def replica_reads(view):
+    def choose_replica(request):
+        databases = _current.get()
+        if (databases is not None and REPLICA_DATABASES
+                and request.method in ('GET', 'HEAD')
+                and STICKY_COOKIE not in request.COOKIES):
+            databases.replica = random.choice(REPLICA_DATABASES)
+
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            choose_replica(request)
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            choose_replica(request)
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+# Counts the current request as a write: it reads from the primary from
+# now on and the client sticks to it for the next REPLICA_LAG seconds. For
+# writes made later on the client's behalf (see shelterme.comment_queue).
+def stick_to_primary():
+    databases = _current.get()
+    if databases is not None:
+        databases.wrote = True
+
+
+# Tracks the database choices of every request and, when a request wrote,
+# tells the client to stick to the primary for the next REPLICA_LAG
+# seconds
+class StickyPrimaryMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        databases = RequestDatabases()
+        token = _current.set(databases)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(databases, response)
+
+    async def __acall__(self, request):
+        databases = RequestDatabases()
+        token = _current.set(databases)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(databases, response)
+
+    def finish(self, databases, response):
+        if databases.wrote and REPLICA_DATABASES:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=REPLICA_LAG,
+                                httponly=True, samesite='Lax')
+        return response
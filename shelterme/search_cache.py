@@ -0,0 +1,220 @@
+import asyncio
+from hashlib import md5
+from threading import Lock
+from time import time_ns
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from shelterme.geo import CELL_SIZE, bounding_deltas, get_zip_index
+from shelterme.instrumentation import timed
+from shelterme.models import Shelter, within_distance
+
+# Radius search results are cached per (zip, radius) as a list of
+# (shelter id, distance) pairs.
+#
+# Invalidation uses versioned keys: the map is split into the same grid
+# cells the ZIP index uses and every cell has a version number. A search's
+# cache key includes the versions of every cell its bounding box touches,
+# and writing a shelter bumps the version of the cell(s) it's in, so only
+# the searches that could see that shelter miss afterwards.
+#
+# Writes bump versions in whichever process they happen (a web worker, or
+# import_shelters run from a shell), so the versions live in a cache every
+# process shares (VERSION_CACHE_ALIAS, files on disk by default). Results
+# may stay in a per-process cache: a bump anywhere changes their keys
+# everywhere.
+#
+# The ZIP centroid lookup and the exact distance filter are timed as the
+# request's 'zip' part; the bounding box query stays out of it (it's SQL).
+
+SEARCH_CACHE_ALIAS = getattr(settings, 'SHELTERME_SEARCH_CACHE', 'default')
+SEARCH_CACHE_TTL = getattr(settings, 'SHELTERME_SEARCH_CACHE_TTL', 300)
+VERSION_CACHE_ALIAS = getattr(settings, 'SHELTERME_SEARCH_VERSION_CACHE',
+                              SEARCH_CACHE_ALIAS)
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = Lock()
+
+
+def _cache():
+    return caches[SEARCH_CACHE_ALIAS]
+
+
+def _version_cache():
+    return caches[VERSION_CACHE_ALIAS]
+
+
+def _count(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+# Returns a copy of this process's hit/miss/invalidation counters
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+def _cell(lat, long):
+    return (int(lat // CELL_SIZE), int(long // CELL_SIZE))
+
+
+# Returns every grid cell overlapping the bounding box of the search
+def _cells_for(lat, long, radius):
+    lat_delta, long_delta = bounding_deltas(lat, radius)
+    min_row, min_col = _cell(lat - lat_delta, long - long_delta)
+    max_row, max_col = _cell(lat + lat_delta, long + long_delta)
+    return [(row, col)
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)]
+
+
+def _version_key(cell):
+    return 'shelterme:search:cell:%d:%d' % cell
+
+
+# Returns the current version of every given cell. Cells without a
+# version yet (or whose version was evicted) get a fresh, never before
+# used one so stale entries can't be picked back up.
+def _versions(cells):
+    cache = _version_cache()
+    keys = [_version_key(cell) for cell in cells]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _search_key(zip_code, radius, versions):
+    digest = md5(repr(versions).encode()).hexdigest()
+    return 'shelterme:search:%s:%s:%s' % (zip_code, radius, digest)
+
+
+# Returns (entry, shelters). On a hit shelters is None; on a miss the search
+# runs against queryset and shelters is its result.
+def _lookup(zip_code, radius, queryset):
+    with timed('zip'):
+        center = get_zip_index().centroid(zip_code)
+    if center is None:
+        return [], []
+    lat, long = center
+
+    cache = _cache()
+    key = _search_key(zip_code, radius,
+                      _versions(_cells_for(lat, long, radius)))
+    entry = cache.get(key)
+    if entry is not None:
+        _count('hits')
+        return entry, None
+
+    # Miss -- run the search and remember the ids
+    _count('misses')
+    candidates = list(queryset.in_bounding_box(lat, long, radius))
+    with timed('zip'):
+        shelters = within_distance(candidates, lat, long, radius)
+    entry = [(shelter.id, shelter.distance) for shelter in shelters]
+    cache.set(key, entry, SEARCH_CACHE_TTL)
+    return entry, shelters
+
+
+# Loads the shelters for the given (id, distance) pairs, in order, with
+# distance set. Anything deleted outside of the model signals is skipped.
+def load(entry, queryset=None):
+    if queryset is None:
+        queryset = Shelter.objects.select_related('location')
+    rows = queryset.in_bulk([shelter_id for shelter_id, distance in entry])
+    return _ordered(entry, rows)
+
+
+def _ordered(entry, rows):
+    results = []
+    for shelter_id, distance in entry:
+        shelter = rows.get(shelter_id)
+        if shelter is not None:
+            shelter.distance = distance
+            results.append(shelter)
+    return results
+
+
+# Cached version of Shelter.objects.near_zip. Returns the same list of
+# shelters (nearest first, with location loaded and distance set).
+def near_zip(zip_code, radius):
+    queryset = Shelter.objects.select_related('location')
+    entry, shelters = _lookup(zip_code, radius, queryset)
+    if shelters is not None:
+        return shelters
+    return load(entry, queryset)
+
+
+# Returns the cached search as a list of (shelter id, distance) pairs,
+# nearest first, without loading any shelter rows on a hit
+def near_zip_ids(zip_code, radius):
+    queryset = Shelter.objects.only('id', 'latitude', 'longitude')
+    entry, shelters = _lookup(zip_code, radius, queryset)
+    return entry
+
+
+# Async version of near_zip, for async views. Queries go through the async
+# ORM and the distance math runs in the default executor so it doesn't
+# block the event loop.
+async def anear_zip(zip_code, radius):
+    with timed('zip'):
+        center = get_zip_index().centroid(zip_code)
+    if center is None:
+        return []
+    lat, long = center
+
+    loop = asyncio.get_running_loop()
+    cache = _cache()
+    # The version cache may be on disk: read it off the loop, in one go
+    versions = await sync_to_async(_versions)(_cells_for(lat, long, radius))
+    key = _search_key(zip_code, radius, versions)
+    entry = await cache.aget(key)
+    queryset = Shelter.objects.select_related('location')
+
+    # Hit -- load the rows by id
+    if entry is not None:
+        _count('hits')
+        rows = await queryset.ain_bulk(
+            [shelter_id for shelter_id, distance in entry])
+        return _ordered(entry, rows)
+
+    # Miss -- prefilter in SQL, exact distances off the loop
+    _count('misses')
+    candidates = [shelter async for shelter
+                  in queryset.in_bounding_box(lat, long, radius)]
+    with timed('zip'):
+        shelters = await loop.run_in_executor(
+            None, within_distance, candidates, lat, long, radius)
+    await cache.aset(key, [(shelter.id, shelter.distance)
+                           for shelter in shelters], SEARCH_CACHE_TTL)
+    return shelters
+
+
+# Returns whether other processes see the versions this one bumps
+def versions_shared():
+    return not isinstance(_version_cache(), LocMemCache)
+
+
+# Invalidates every cached search that could include a shelter at the
+# given coordinates. The cell gets a new version rather than an incremented
+# one: incr is a get then a set in the file cache, so two processes bumping
+# the same cell at once could both write the same version and a search
+# cached between their writes would survive the second one.
+def invalidate_point(lat, long):
+    if lat is None or long is None:
+        return
+    _version_cache().set(_version_key(_cell(lat, long)), time_ns(), None)
+    _count('invalidations')
@@ -0,0 +1,58 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from shelterme import search_cache, thumbnails
+from shelterme.capacity_feed import feed
+from shelterme.models import Shelter
+
+
+# Remember where the shelter was before the write so moving it
+# invalidates both its old and new cells
+@receiver(pre_save, sender=Shelter)
+def remember_shelter_coordinates(sender, instance, **kwargs):
+    instance._old_coordinates = None
+    if instance.pk is not None:
+        instance._old_coordinates = Shelter.objects.filter(
+            pk=instance.pk).values_list('latitude', 'longitude').first()
+
+
+@receiver(post_save, sender=Shelter)
+def invalidate_saved_shelter(sender, instance, **kwargs):
+    old = getattr(instance, '_old_coordinates', None)
+    if old and old != (instance.latitude, instance.longitude):
+        search_cache.invalidate_point(*old)
+    search_cache.invalidate_point(instance.latitude, instance.longitude)
+
+
+# New photos get their thumbnails made in the background
+@receiver(post_save, sender=Shelter)
+def queue_thumbnails(sender, instance, **kwargs):
+    if thumbnails.pending(instance):
+        thumbnails.schedule(instance.id)
+
+
+# Let capacity streams know once the write is committed. Saves that
+# leave current_capacity alone (it's changed atomically elsewhere) read it
+# back so watchers never see a stale value.
+@receiver(post_save, sender=Shelter)
+def publish_saved_shelter(sender, instance, update_fields=None, **kwargs):
+    shelter_id = instance.id
+    if update_fields is None or 'current_capacity' in update_fields:
+        current, maximum = instance.current_capacity, instance.max_capacity
+        transaction.on_commit(
+            lambda: feed.publish(shelter_id, current, maximum))
+    elif 'max_capacity' in update_fields:
+        transaction.on_commit(lambda: publish_from_db(shelter_id))
+
+
+def publish_from_db(shelter_id):
+    row = Shelter.objects.filter(pk=shelter_id).values_list(
+        'current_capacity', 'max_capacity').first()
+    if row:
+        feed.publish(shelter_id, *row)
+
+
+# Also fires for shelters deleted through a Location cascade
+@receiver(post_delete, sender=Shelter)
+def invalidate_deleted_shelter(sender, instance, **kwargs):
+    search_cache.invalidate_point(instance.latitude, instance.longitude)
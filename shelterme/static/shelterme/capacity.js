@@ -0,0 +1,71 @@
+// Keeps every element with a data-capacity-id attribute showing the
+// shelter's live "current / max" capacity, and every element with a
+// data-free-beds-id attribute its free beds, pushed from the capacity stream.
+// Servers that don't stream (WSGI) answer the stream with 204, which closes
+// it; the capacities are then polled every POLL_MS instead.
+(function () {
+  // Shelters per stream (the server's MAX_STREAM_SHELTERS) and streams per
+  // page: browsers only open a few connections per host, so the shelters
+  // past MAX_STREAMS * MAX_IDS (the farthest ones) aren't kept live.
+  var MAX_IDS = 200;
+  var MAX_STREAMS = 2;
+  var POLL_MS = 30000;
+
+  var script = document.currentScript;
+  var elements = document.querySelectorAll('[data-capacity-id]');
+  if (!elements.length) {
+    return;
+  }
+
+  var ids = [];
+  Array.prototype.forEach.call(elements, function (element) {
+    var id = element.getAttribute('data-capacity-id');
+    if (ids.indexOf(id) === -1) {
+      ids.push(id);
+    }
+  });
+
+  function show(change) {
+    var targets = document.querySelectorAll('[data-capacity-id="' + change.id + '"]');
+    Array.prototype.forEach.call(targets, function (element) {
+      element.textContent = change.current_capacity + ' / ' + change.max_capacity;
+    });
+    targets = document.querySelectorAll('[data-free-beds-id="' + change.id + '"]');
+    Array.prototype.forEach.call(targets, function (element) {
+      element.textContent = change.max_capacity - change.current_capacity;
+    });
+  }
+
+  function poll(chunk) {
+    var url = script.getAttribute('data-poll-url') + '?ids=' + chunk.join(',');
+    setInterval(function () {
+      fetch(url).then(function (response) {
+        return response.ok ? response.json() : {shelters: []};
+      }).then(function (data) {
+        data.shelters.forEach(show);
+      }).catch(function () {});
+    }, POLL_MS);
+  }
+
+  function stream(chunk) {
+    if (!window.EventSource) {
+      return poll(chunk);
+    }
+    var source = new EventSource(script.getAttribute('data-stream-url') +
+                                 '?ids=' + chunk.join(','));
+    source.addEventListener('capacity', function (event) {
+      show(JSON.parse(event.data));
+    });
+    // Streams end after a while and EventSource reconnects by itself; it
+    // only gives up (CLOSED) when the server won't stream
+    source.addEventListener('error', function () {
+      if (source.readyState === EventSource.CLOSED) {
+        poll(chunk);
+      }
+    });
+  }
+
+  for (var i = 0; i < ids.length && i < MAX_IDS * MAX_STREAMS; i += MAX_IDS) {
+    stream(ids.slice(i, i + MAX_IDS));
+  }
+})();
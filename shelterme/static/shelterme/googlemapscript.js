@@ -1,28 +1,28 @@
+// Past this many markers, nearby markers are grouped into clusters
+var CLUSTER_THRESHOLD = 50;
+
+// Size (in screen pixels) of the grid markers are clustered on
+var CLUSTER_GRID_SIZE = 60;
+
+function escapeHtml(text) {
+	return String(text)
+		.replace(/&/g, '&amp;')
+		.replace(/</g, '&lt;')
+		.replace(/>/g, '&gt;')
+		.replace(/"/g, '&quot;');
+}
+
+function shelterInfo(shelter) {
+	return '<strong><a href="' + escapeHtml(shelter.url) + '">' + escapeHtml(shelter.name) + '</a></strong>' +
+		'<br>' + escapeHtml(shelter.address) +
+		'<br><a href="https://www.google.com/maps/search/?api=1&query=' +
+		encodeURIComponent(shelter.address) + '">Get Directions</a>';
+}
+
 function initMap() {
 
-	var rbd = {
-		info: '<strong>Ralph Brown Draughon Library</strong><br>231 Mell St<br>Auburn, AL 36849<br><a href="https://www.google.com/maps/place/231+Mell+St,+Auburn,+AL+36849/@32.6029548,-85.4849207,17z/data=!3m1!4b1!4m5!3m4!1s0x888cf3034a1ce893:0xabaf3db7e9ed3f25!8m2!3d32.6029548!4d-85.4827267">Get Directions</a>',
-		lat: 32.603025,
-		long: -85.4828133
-	};
-
-	var greene = {
-		info: '<strong>Greene Hall, College of Veterinary Medicine</strong><br>1130 Wire Road<br>Auburn, AL 36832<br><a href="https://www.google.com/maps/place/1130+Wire+Rd,+Auburn,+AL+36832/data=!4m2!3m1!1s0x888cf382dbed6e1d:0x6d8f926e25989339?ved=2ahUKEwjNpJnz25_gAhVudt8KHZr0AJIQ8gEwAHoECAAQAQ">Get Directions</a>',
-		lat: 32.599305,
-		long: -85.4971808
-	};
-
-	var hunters = {
-		info: '<strong>Hunter\'s First Floor Shelter</strong><br>211 W Longleaf Drive<br>Auburn, AL 36832<br><a href="https://www.google.com/maps/place/211+W+Longleaf+Dr,+Auburn,+AL+36832/@32.5725727,-85.5050344,17z/data=!3m1!4b1!4m5!3m4!1s0x888cf394f6b651b9:0xf9403c470fa4c622!8m2!3d32.5725727!4d-85.5028404">Get Directions</a>',
-		lat: 32.572604,
-		long: -85.502795
-	};
-
-	var locations = [
-      [rbd.info, rbd.lat, rbd.long, 0],
-      [greene.info, greene.lat, greene.long, 1],
-      [hunters.info, hunters.lat, hunters.long, 2],
-    ];
+	// Shelters found by the search, inlined by the index view
+	var shelters = JSON.parse(document.getElementById('shelter-markers').textContent);
 
 	var map = new google.maps.Map(document.getElementById('map'), {
 		zoom: 13,
@@ -31,20 +31,103 @@ function initMap() {
 	});
 
 	var infowindow = new google.maps.InfoWindow({});
+	var bounds = new google.maps.LatLngBounds();
+	var markers = [];
 
-	var marker, i;
+	shelters.forEach(function (shelter) {
+		if (shelter.lat === null || shelter.lng === null) {
+			return;
+		}
+		var position = new google.maps.LatLng(shelter.lat, shelter.lng);
+		var marker = new google.maps.Marker({
+			position: position,
+			title: shelter.name
+		});
+		marker.addListener('click', function () {
+			infowindow.setContent(shelterInfo(shelter));
+			infowindow.open(map, marker);
+		});
+		bounds.extend(position);
+		markers.push(marker);
+	});
 
-	for (i = 0; i < locations.length; i++) {
-		marker = new google.maps.Marker({
-			position: new google.maps.LatLng(locations[i][1], locations[i][2]),
-			map: map
+	if (!markers.length) {
+		return;
+	}
+	if (markers.length === 1) {
+		map.setCenter(bounds.getCenter());
+	} else {
+		map.fitBounds(bounds);
+	}
+
+	// Few enough markers to just show them all
+	if (markers.length <= CLUSTER_THRESHOLD) {
+		markers.forEach(function (marker) {
+			marker.setMap(map);
 		});
+		return;
+	}
+
+	// Otherwise re-cluster whenever the map settles after a pan or zoom
+	var clusters = [];
+	map.addListener('idle', function () {
+		clusters = renderClusters(map, markers, clusters);
+	});
+}
+
+// Groups the markers in view by screen grid cell. Cells with one marker
+// show it; cells with more show a single numbered marker that zooms in on
+// click. Returns the cluster markers so the next render can remove them.
+function renderClusters(map, markers, oldClusters) {
+	oldClusters.forEach(function (cluster) {
+		cluster.setMap(null);
+	});
+
+	var projection = map.getProjection();
+	var view = map.getBounds();
+	var scale = Math.pow(2, map.getZoom());
+	var cells = {};
+
+	markers.forEach(function (marker) {
+		var position = marker.getPosition();
+		if (!view.contains(position)) {
+			marker.setMap(null);
+			return;
+		}
+		var point = projection.fromLatLngToPoint(position);
+		var key = Math.floor(point.x * scale / CLUSTER_GRID_SIZE) + ':' +
+			Math.floor(point.y * scale / CLUSTER_GRID_SIZE);
+		(cells[key] = cells[key] || []).push(marker);
+	});
+
+	var clusters = [];
+	Object.keys(cells).forEach(function (key) {
+		var members = cells[key];
+		if (members.length === 1) {
+			members[0].setMap(map);
+			return;
+		}
 
-		google.maps.event.addListener(marker, 'click', (function (marker, i) {
-			return function () {
-				infowindow.setContent(locations[i][0]);
-				infowindow.open(map, marker);
+		var cellBounds = new google.maps.LatLngBounds();
+		members.forEach(function (marker) {
+			marker.setMap(null);
+			cellBounds.extend(marker.getPosition());
+		});
+		var cluster = new google.maps.Marker({
+			position: cellBounds.getCenter(),
+			label: String(members.length),
+			map: map
+		});
+		cluster.addListener('click', function () {
+			// Markers sharing a ZIP centroid can't be split by zooming
+			if (cellBounds.getNorthEast().equals(cellBounds.getSouthWest())) {
+				map.setZoom(map.getZoom() + 2);
+				map.setCenter(cellBounds.getCenter());
+			} else {
+				map.fitBounds(cellBounds);
 			}
-		})(marker, i));
-	}
-}
\ No newline at end of file
+		});
+		clusters.push(cluster);
+	});
+	return clusters;
+}
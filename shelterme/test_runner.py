@@ -0,0 +1,33 @@
+import os
+import tempfile
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+# Runs the tests against a shared cache (see CACHES['shared']) in a
+# temporary directory, so clearing it doesn't wipe the real one. The
+# directory is also exported to the processes the tests start.
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.shared_cache_dir = tempfile.TemporaryDirectory()
+        self.saved_shared_cache_env = os.environ.get(
+            'SHELTERME_SHARED_CACHE_DIR')
+        os.environ['SHELTERME_SHARED_CACHE_DIR'] = self.shared_cache_dir.name
+        shared = dict(settings.CACHES['shared'],
+                      LOCATION=self.shared_cache_dir.name)
+        self.shared_cache = override_settings(
+            CACHES=dict(settings.CACHES, shared=shared))
+        self.shared_cache.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.shared_cache.disable()
+        if self.saved_shared_cache_env is None:
+            del os.environ['SHELTERME_SHARED_CACHE_DIR']
+        else:
+            os.environ['SHELTERME_SHARED_CACHE_DIR'] = \
+                self.saved_shared_cache_env
+        self.shared_cache_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
@@ -1,9 +1,41 @@
-from shelterme.views import valid_city_state_zip
-from shelterme.models import Location, Shelter
+from shelterme.views import valid_city_state_zip, get_locations_within_radius
+from shelterme.geo import ZipIndex, get_zip_index, haversine, lookup_zip
+from zipcodes import matching
+from shelterme.models import Comment, Location, Shelter
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from threading import Event, Thread
+from django.core.management import call_command
+from io import BytesIO, StringIO
+import json
+import os
+import tempfile
 from django.shortcuts import get_object_or_404
 from django.http import Http404
+from django.db import IntegrityError, OperationalError, connection, \
+    connections, transaction
+from django.core.cache import cache, caches
+from shelterme import comment_queue, fragments, fulltext, instrumentation, \
+    search_cache, thumbnails
+from django.contrib.auth.models import User
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.conf import settings
+from shelterme import assets, routers
+import sqlite3
+from unittest import mock, skipUnless
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shelterme.capacity_feed import CapacityFeed, feed
+from shelterme.views import capacity_events
+import asyncio
+import itertools
+import subprocess
+import sys
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+import gzip
+from django.template import Context, Template
+from django.contrib.staticfiles import finders
 
 
 # Analysis -- shelterme.views.index
@@ -49,6 +81,7 @@ from django.http import Http404
 class IndexViewTests(TestCase):
 
     def setUp(self):
+        cache.clear()
 
         self.locations = []
         self.shelters = []
@@ -115,6 +148,41 @@ class IndexViewTests(TestCase):
             for shelter in location.shelter_set.all():
                 self.assertContains(response, shelter.name)
 
+    def test_query_count_is_independent_of_radius(self):
+        for city, zip in [("Opelika", "36801"), ("Montgomery", "36104")]:
+            Shelter.objects.create(
+                name="Test Shelter " + city, street_addr="1 Test Street",
+                location=Location.objects.create(city=city, state="AL"),
+                zip=zip)
+        self.get_form['zip'] = '36830'
+        for radius in [5, 10, 50]:
+            self.get_form['radius'] = radius
+            # Validation aggregate + search
+            with self.assertNumQueries(2):
+                response = self.client.get(self.url, self.get_form)
+            self.assertEqual(response.status_code, 200)
+
+    def test_shelters_sorted_by_distance(self):
+        self.get_form['zip'] = '36849'
+        self.get_form['radius'] = 10
+        response = self.client.get(self.url, self.get_form)
+        shelters = response.context['shelters']
+        self.assertEqual(shelters[0], self.shelters[1])
+        self.assertEqual(
+            [s.distance for s in shelters],
+            sorted(s.distance for s in shelters))
+
+    def test_map_markers_come_from_search(self):
+        self.get_form['zip'] = '36830'
+        response = self.client.get(self.url, self.get_form)
+        markers = response.context['markers']
+        self.assertEqual(len(markers), len(self.shelters))
+        for marker in markers:
+            shelter = Shelter.objects.get(name=marker['name'])
+            self.assertEqual((marker['lat'], marker['lng']),
+                             (shelter.latitude, shelter.longitude))
+        self.assertContains(response, 'id="shelter-markers"')
+
     def test_when_blank_zip_then_return_splash_with_error_msg(self):
         self.get_form['zip'] = ''
         self.get_form['radius'] = 5
@@ -180,6 +248,52 @@ class IndexViewTests(TestCase):
         self.assertRedirects(response, reverse('shelterme:splash'))
 
 
+# Analysis -- shelterme.views.create
+# Creates a shelter from the new view's form (POST /shelters)
+# Parameters
+# shelter_name, street_address, city, state, zip_code, photourl   strings
+# max_capacity      string of an integer                mandatory
+#
+# Happy Path:
+# valid city/state/zip not in db -> location created, shelter saved with
+# integer free beds, redirect to its show page
+# location already in db (any case) -> reused
+#
+# Sad Path:
+# city/state/zip that don't match -> nothing saved, splash with an error
+class CreateViewTests(TestCase):
+
+    def setUp(self):
+        self.url = reverse('shelterme:create')
+        self.form = {'shelter_name': 'New Shelter',
+                     'street_address': '1 New St', 'city': 'auburn',
+                     'state': 'al', 'zip_code': '36830',
+                     'max_capacity': '25', 'photourl': ''}
+
+    # Happy path
+    def test_create(self):
+        response = self.client.post(self.url, self.form)
+        shelter = Shelter.objects.get(name='New Shelter')
+        self.assertRedirects(response, reverse('shelterme:show',
+                                               args=(shelter.id,)))
+        self.assertEqual(str(shelter.location), 'Auburn, AL')
+        self.assertEqual(shelter.max_capacity, 25)
+        self.assertEqual(shelter.free_beds, 25)
+
+    def test_create_in_existing_location(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.client.post(self.url, self.form)
+        self.assertEqual(Shelter.objects.get().location, loc)
+        self.assertEqual(Location.objects.count(), 1)
+
+    # Sad path
+    def test_create_with_mismatched_location(self):
+        self.form['zip_code'] = '90210'
+        response = self.client.post(self.url, self.form)
+        self.assertRedirects(response, reverse('shelterme:splash'))
+        self.assertFalse(Shelter.objects.exists())
+
+
 # Analysis -- shelterme.views.edit
 # Happy: Render the edit form populated with the data from the given 'id'
 # Parameters
@@ -775,6 +889,23 @@ class DeleteViewTests(TestCase):
 # not int zip
 class ValidateCityStateZIPTests(TestCase):
 
+    def setUp(self):
+        valid_city_state_zip.cache_clear()
+
+    def test_results_are_memoized(self):
+        for i in range(3):
+            self.assertIs(valid_city_state_zip("Auburn", "AL", "36830"), True)
+            self.assertIs(valid_city_state_zip("Auburn", "AL", "00000"), False)
+            self.assertIs(valid_city_state_zip("Auburn", "AL", "abcde"), False)
+        info = valid_city_state_zip.cache_info()
+        self.assertEqual((info.misses, info.hits), (3, 6))
+
+    def test_cache_is_bounded(self):
+        maxsize = valid_city_state_zip.cache_info().maxsize
+        for i in range(maxsize + 10):
+            valid_city_state_zip("Auburn", "AL", str(i).zfill(5))
+        self.assertEqual(valid_city_state_zip.cache_info().currsize, maxsize)
+
     # Happy path:
     def test_good_city_state_zip(self):
         city = "Auburn"
@@ -904,3 +1035,2339 @@ class ValidateCityStateZIPTests(TestCase):
         expected = False
         actual = valid_city_state_zip(city, state, zip)
         self.assertIs(expected, actual)
+
+
+# Analysis -- shelterme.geo.ZipIndex
+# Returns every ZIP whose centroid is within radius miles of a ZIP
+# Parameters
+#       zip_code    string      5-digit #           mandatory
+#       radius      number      .GT 0, .LE 50       mandatory
+#
+# Happy Path:
+# zip in index, small radius -> nearby zips, nearest first
+# zip in index, max radius -> every zip the brute force check finds
+# points in neighbouring grid cells are found
+# shared index already loaded when the app is ready
+#
+# Sad Path:
+# zip not in index -> empty list
+class ZipIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = ZipIndex([
+            ('00001', 32.5, -85.5),
+            ('00002', 32.51, -85.49),
+            # Same point as 00001 but across a cell boundary
+            ('00003', 32.49, -85.51),
+            ('00004', 40.0, -100.0),
+        ])
+
+    # Happy path
+    def test_zips_within_radius_nearest_first(self):
+        actual = [z for z, d in self.index.zips_within_radius('00001', 5)]
+        self.assertEqual(actual[0], '00001')
+        self.assertEqual(set(actual), {'00001', '00002', '00003'})
+
+    def test_far_zip_excluded(self):
+        actual = [z for z, d in self.index.zips_within_radius('00001', 50)]
+        self.assertNotIn('00004', actual)
+
+    def test_loaded_when_app_ready(self):
+        from shelterme import geo
+        self.assertIsNotNone(geo._zip_index)
+
+    def test_matches_brute_force_at_max_radius(self):
+        index = get_zip_index()
+        center = index.centroid('36830')
+        expected = set()
+        for zip_code, (lat, long) in index.centroids.items():
+            if haversine(center[0], center[1], lat, long) <= 50:
+                expected.add(zip_code)
+        actual = {z for z, d in index.zips_within_radius('36830', 50)}
+        self.assertEqual(expected, actual)
+
+    def test_locations_within_radius(self):
+        locations = get_locations_within_radius('36830', 5)
+        self.assertIn({'city': 'Auburn', 'state': 'AL'}, locations)
+        self.assertIn({'city': 'Auburn University', 'state': 'AL'}, locations)
+
+    # Sad path
+    def test_unknown_zip(self):
+        self.assertEqual(self.index.zips_within_radius('99999', 10), [])
+
+
+# Analysis -- shelterme.geo.lookup_zip
+# Returns the normalized (city, state) of a zip from the precomputed table
+#
+# Happy Path:
+# real zip -> title-cased city, upper-case state
+# zip+4 -> same place as the 5-digit zip
+# every zip in the table agrees with zipcodes.matching
+#
+# Sad Path:
+# unknown zip -> None
+# malformed zip -> ValueError
+class LookupZIPTests(TestCase):
+
+    # Happy path
+    def test_real_zip(self):
+        self.assertEqual(lookup_zip('36849'), ('Auburn University', 'AL'))
+
+    def test_zip_plus_four(self):
+        self.assertEqual(lookup_zip('36830-1234'), ('Auburn', 'AL'))
+
+    def test_agrees_with_matching(self):
+        for zip_code in ['36830', '35004', '10001', '99501', '00501']:
+            zip_info = matching(zip_code)[0]
+            city, state = lookup_zip(zip_code)
+            self.assertEqual(city.lower(), zip_info['city'].lower())
+            self.assertEqual(state, zip_info['state'].upper())
+
+    # Sad path
+    def test_unknown_zip(self):
+        self.assertIsNone(lookup_zip('00000'))
+
+    def test_malformed_zip(self):
+        with self.assertRaises(ValueError):
+            lookup_zip('abcde')
+
+
+# Analysis -- shelterme.models.LocationManager
+# Looks up and creates locations by their case-folded city/state key
+#
+# Happy Path:
+# existing location, different case -> existing row
+# get or create twice -> one row
+#
+# Sad Path:
+# nonexistent location -> None
+# inserting a duplicate key directly -> IntegrityError
+class LocationManagerTests(TestCase):
+
+    def setUp(self):
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+
+    # Happy path
+    def test_get_by_city_state_ignores_case(self):
+        self.assertEqual(
+            Location.objects.get_by_city_state('AUBURN', 'al'), self.loc)
+
+    def test_get_or_create_does_not_duplicate(self):
+        loc, created = Location.objects.get_or_create_by_city_state(
+            'Opelika', 'AL')
+        self.assertTrue(created)
+        again, created = Location.objects.get_or_create_by_city_state(
+            'opelika', 'al')
+        self.assertFalse(created)
+        self.assertEqual(loc, again)
+
+    # Sad path
+    def test_get_by_city_state_nonexistent(self):
+        self.assertIsNone(
+            Location.objects.get_by_city_state('Nowhere', 'AL'))
+
+    def test_duplicate_key_rejected(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Location.objects.create(city="auburn", state="al")
+
+
+# Analysis -- shelterme.models.ShelterQuerySet.within_radius
+# Returns shelters within radius miles of a point, nearest first
+#
+# Happy Path:
+# shelter saved with a real zip -> coordinates filled in
+# shelters inside the radius -> returned nearest first with distance
+#
+# Sad Path:
+# shelter in the bounding box corner but outside the radius -> excluded
+# shelter with an unknown zip -> no coordinates, never returned
+class ShelterRadiusTests(TestCase):
+
+    def setUp(self):
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+
+    def create_shelter(self, name, zip):
+        return Shelter.objects.create(name=name, street_addr="1 Test St",
+                                      location=self.loc, zip=zip)
+
+    # Happy path
+    def test_coordinates_filled_in_from_zip(self):
+        shelter = self.create_shelter("Near", "36830")
+        self.assertEqual((shelter.latitude, shelter.longitude),
+                         get_zip_index().centroid('36830'))
+
+    def test_within_radius_sorted(self):
+        far = self.create_shelter("Far", "36801")
+        near = self.create_shelter("Near", "36830")
+        lat, long = get_zip_index().centroid('36830')
+        shelters = Shelter.objects.within_radius(lat, long, 20)
+        self.assertEqual(shelters, [near, far])
+        self.assertEqual(shelters[0].distance, 0)
+
+    # Sad path
+    def test_bounding_box_corner_excluded(self):
+        shelter = self.create_shelter("Corner", "36830")
+        lat, long = shelter.latitude, shelter.longitude
+        # 10 miles north and 10 miles east is ~14 miles away
+        self.assertEqual(
+            Shelter.objects.within_radius(lat + 10 / 69.0,
+                                          long + 10 / 58.0, 10), [])
+
+    def test_unknown_zip_has_no_coordinates(self):
+        shelter = self.create_shelter("Nowhere", "00000")
+        self.assertIsNone(shelter.latitude)
+        self.assertEqual(Shelter.objects.near_zip('36830', 50), [])
+
+
+# Analysis -- shelterme.search_cache.near_zip
+# Caches radius search results per (zip, radius)
+#
+# Happy Path:
+# same search twice -> miss then hit, same shelters
+# shelter added inside the radius -> cached search invalidated
+# shelter moved out of the radius -> cached search invalidated
+# shelter deleted -> cached search invalidated
+# shelter written by another process -> cached search invalidated
+#
+# Sad Path:
+# shelter added far away -> unrelated cached search stays a hit
+class SearchCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caches[search_cache.VERSION_CACHE_ALIAS].clear()
+        search_cache.reset_stats()
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = self.create_shelter("Near", "36830")
+
+    def create_shelter(self, name, zip):
+        return Shelter.objects.create(name=name, street_addr="1 Test St",
+                                      location=self.loc, zip=zip)
+
+    def search(self):
+        return search_cache.near_zip('36830', 10)
+
+    # Happy path
+    def test_second_search_is_a_hit(self):
+        first = self.search()
+        second = self.search()
+        self.assertEqual(first, second)
+        self.assertEqual([s.distance for s in first],
+                         [s.distance for s in second])
+        stats = search_cache.get_stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 1))
+
+    def test_new_nearby_shelter_invalidates(self):
+        self.search()
+        other = self.create_shelter("Also Near", "36832")
+        self.assertIn(other, self.search())
+        self.assertEqual(search_cache.get_stats()['misses'], 2)
+
+    def test_moved_shelter_invalidates(self):
+        self.search()
+        self.shelter.zip = '99501'
+        self.shelter.save()
+        self.assertEqual(self.search(), [])
+
+    def test_deleted_shelter_invalidates(self):
+        self.search()
+        self.shelter.delete()
+        self.assertEqual(self.search(), [])
+        self.assertEqual(search_cache.get_stats()['misses'], 2)
+
+    def test_write_in_another_process_invalidates(self):
+        self.search()
+        # Like import_shelters: no signals, then an invalidation made by
+        # another process
+        other = Shelter(name="Also Near", street_addr="1 Test St",
+                        location=self.loc, zip="36832")
+        other.fill_coordinates()
+        Shelter.objects.bulk_create([other])
+        subprocess.run([
+            sys.executable, '-c',
+            'import django; django.setup(); '
+            'from shelterme import search_cache; '
+            'search_cache.invalidate_point(%r, %r)' % (
+                other.latitude, other.longitude)],
+            check=True, cwd=settings.BASE_DIR,
+            env=dict(os.environ,
+                     DJANGO_SETTINGS_MODULE='shelter_me_project.settings'))
+        self.assertEqual(len(self.search()), 2)
+        self.assertEqual(search_cache.get_stats()['misses'], 2)
+
+    # Sad path
+    def test_far_away_shelter_keeps_entry(self):
+        self.search()
+        self.create_shelter("Anchorage", "99501")
+        self.search()
+        self.assertEqual(search_cache.get_stats()['hits'], 1)
+
+
+# Analysis -- shelterme.views.api_search
+# Returns pages of shelters within radius of zip as JSON, nearest first
+# Parameters
+# zip       string      len == 5, numeric       optional    default='36830'
+# radius    integer     .GE 1, .LE 50           optional    default=10
+# limit     integer     .GE 1, .LE 100          optional    default=20
+# cursor    string      from a previous 'next'  optional
+#
+# Happy Path:
+# walking every page returns every shelter once, nearest first
+# results only carry id, name, capacity, free_beds, distance, photo and
+# thumbnails
+# zip with no shelters -> empty page
+#
+# Sad Path:
+# invalid zip, radius, limit or cursor -> 400
+# POST -> 405
+class SearchAPITests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelters = []
+        for i, zip in enumerate(['36830', '36832', '36849', '36801'] * 2):
+            self.shelters.append(Shelter.objects.create(
+                name="Test Shelter %d" % i, street_addr="1 Test St",
+                location=loc, zip=zip, max_capacity=10 + i,
+                photo='https://example.com/%d.jpg' % i))
+        self.url = reverse('shelterme:api_search')
+
+    # Happy path
+    def test_pages_cover_every_shelter_in_order(self):
+        params = {'zip': '36830', 'radius': 20, 'limit': 3}
+        seen = []
+        distances = []
+        while True:
+            data = self.client.get(self.url, params).json()
+            self.assertLessEqual(len(data['results']), 3)
+            seen += [result['id'] for result in data['results']]
+            distances += [result['distance'] for result in data['results']]
+            if not data['next']:
+                break
+            params['cursor'] = data['next']
+        self.assertEqual(sorted(seen), sorted(s.id for s in self.shelters))
+        self.assertEqual(distances, sorted(distances))
+
+    def test_result_fields(self):
+        data = self.client.get(self.url, {'zip': '36830'}).json()
+        self.assertEqual(set(data['results'][0]),
+                         {'id', 'name', 'capacity', 'free_beds', 'distance',
+                          'photo', 'thumbnails'})
+
+    def test_no_shelters_nearby(self):
+        data = self.client.get(self.url, {'zip': '99501'}).json()
+        self.assertEqual(data, {'results': [], 'next': None})
+
+    # Sad path
+    def test_bad_params(self):
+        for params in [{'zip': '00000'}, {'zip': 'abc'}, {'radius': 51},
+                       {'limit': 0}, {'limit': 'x'}, {'cursor': 'nope'}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+    def test_post(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 405)
+
+
+# Analysis -- availability filter and sort of shelterme.views.index_or_create
+# and api_search
+# Parameters
+# min_beds  integer     .GE 0, .LE 10000        optional    default=0
+# sort      string      distance / available    optional    default=distance
+#
+# Happy Path:
+# min_beds -> only shelters with that many free beds, nearest first
+# sort=available -> most free beds first, ties broken by id
+# walking every sort=available page returns every match once, in order
+# free_beds follows saves, the update view and check-ins / check-outs
+# availability search reads the lat/long/free_beds index
+#
+# Sad Path:
+# no shelter with enough free beds -> splash page with a message
+# invalid min_beds or sort -> splash page (index) / 400 (api)
+class AvailabilitySearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelters = []
+        for i, zip in enumerate(['36830', '36832', '36849', '36801'] * 2):
+            self.shelters.append(Shelter.objects.create(
+                name="Test Shelter %d" % i, street_addr="1 Test St",
+                location=loc, zip=zip, max_capacity=10,
+                current_capacity=i % 4 * 3))
+        self.index_url = reverse('shelterme:index')
+        self.api_url = reverse('shelterme:api_search')
+
+    # Happy path
+    def test_min_beds(self):
+        data = self.client.get(self.api_url, {
+            'zip': '36830', 'radius': 20, 'min_beds': 7}).json()
+        ids = [result['id'] for result in data['results']]
+        self.assertEqual(sorted(ids), sorted(
+            s.id for s in self.shelters if s.free_beds >= 7))
+        distances = [result['distance'] for result in data['results']]
+        self.assertEqual(distances, sorted(distances))
+
+        response = self.client.get(self.index_url, {
+            'zip': '36830', 'radius': 20, 'min_beds': 7})
+        self.assertEqual(
+            [s.id for s in response.context['shelters']],
+            [s.id for s in Shelter.objects.near_zip('36830', 20)
+             if s.free_beds >= 7])
+
+    def test_sort_available(self):
+        expected = [s.id for s in sorted(
+            self.shelters, key=lambda s: (-s.free_beds, s.id))]
+        response = self.client.get(self.index_url, {
+            'zip': '36830', 'radius': 20, 'sort': 'available'})
+        self.assertEqual([s.id for s in response.context['shelters']],
+                         expected)
+        self.assertContains(response, 'data-free-beds-id')
+
+    def test_sort_available_pages(self):
+        params = {'zip': '36830', 'radius': 20, 'limit': 3,
+                  'sort': 'available', 'min_beds': 1}
+        results = []
+        while True:
+            data = self.client.get(self.api_url, params).json()
+            self.assertLessEqual(len(data['results']), 3)
+            results += data['results']
+            if not data['next']:
+                break
+            params['cursor'] = data['next']
+        expected = sorted(((s.free_beds, s.id) for s in self.shelters
+                           if s.free_beds >= 1),
+                          key=lambda key: (-key[0], key[1]))
+        self.assertEqual(
+            [(result['free_beds'], result['id']) for result in results],
+            expected)
+
+    def test_free_beds_kept_in_sync(self):
+        shelter = self.shelters[0]
+        self.assertEqual(shelter.free_beds, 10)
+
+        shelter.current_capacity = 4
+        shelter.save()
+        shelter.refresh_from_db()
+        self.assertEqual(shelter.free_beds, 6)
+
+        self.client.post(reverse('shelterme:checkin', args=(shelter.id,)),
+                         {'count': 2})
+        shelter.refresh_from_db()
+        self.assertEqual(shelter.free_beds, 4)
+
+        self.client.post(reverse('shelterme:update', args=(shelter.id,)), {
+            'shelter_name': shelter.name, 'street_address': '1 Test St',
+            'city': 'Auburn', 'state': 'AL', 'zip_code': '36830',
+            'max_cap': 20, 'photourl': 'https://example.com/a.jpg'})
+        shelter.refresh_from_db()
+        self.assertEqual((shelter.current_capacity, shelter.free_beds),
+                         (6, 14))
+
+    def test_uses_covering_index(self):
+        queryset = Shelter.objects.in_bounding_box(32.6, -85.5, 20).filter(
+            free_beds__gte=1).order_by('-free_beds', 'id').values_list(
+            'id', 'free_beds', 'latitude', 'longitude')
+        with connections['default'].cursor() as cursor:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('shelter_lat_long_free_idx', plan)
+
+    # Sad path
+    def test_no_shelter_with_enough_beds(self):
+        response = self.client.get(self.index_url, {
+            'zip': '36830', 'radius': 20, 'min_beds': 11}, follow=True)
+        self.assertRedirects(response, reverse('shelterme:splash'))
+        self.assertContains(response, 'No shelters with 11 or more')
+
+    def test_bad_params(self):
+        for params in [{'min_beds': 'x'}, {'min_beds': -1},
+                       {'min_beds': 10001}, {'sort': 'name'}]:
+            response = self.client.get(self.api_url, params)
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(self.index_url, params)
+            self.assertRedirects(response, reverse('shelterme:splash'))
+
+
+# Analysis -- shelterme.fulltext and shelterme.views.api_text_search
+# Full-text search over shelter names / addresses and comment contents
+# Parameters
+# q         string      has a word, .LE 200     mandatory
+# limit     integer     .GE 1, .LE 100          optional    default=20
+#
+# Happy Path:
+# words match shelter names, addresses and comments, stemmed
+# last word matches as a prefix, "quoted phrases" as phrases
+# name matches rank above address matches, however old the shelter
+# comments ranked among the newest matches only
+# creating, updating and deleting shelters and comments through the views
+# keeps the index in sync
+# FTS5 syntax in the query is searched for, not interpreted
+# migrations reversed to 0009 / 0008 -> sync triggers still there
+#
+# Sad Path:
+# missing / wordless / too long q -> 400
+# POST -> 405
+class FullTextSearchTests(TestCase):
+
+    def setUp(self):
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Harbor House", street_addr="12 Magnolia Ave",
+            location=self.loc, zip="36830")
+        self.other = Shelter.objects.create(
+            name="Magnolia Shelter", street_addr="4 Harbor Rd",
+            location=self.loc, zip="36832")
+        self.comment = Comment.objects.create(
+            author="Sam", content="Pets allowed, bring a crate",
+            shelter=self.shelter)
+        self.url = reverse('shelterme:api_text_search')
+
+    def search(self, q):
+        data = self.client.get(self.url, {'q': q}).json()
+        return ([shelter['id'] for shelter in data['shelters']],
+                [comment['id'] for comment in data['comments']])
+
+    # Happy path
+    def test_match_expression(self):
+        self.assertEqual(fulltext.match_expression('pets allowed'),
+                         '"pets" "allowed" *')
+        self.assertEqual(fulltext.match_expression('"pets allowed" ok'),
+                         '"pets allowed" "ok" *')
+        self.assertEqual(fulltext.match_expression('"pets allowed"'),
+                         '"pets allowed"')
+        self.assertEqual(fulltext.match_expression('a* OR "b -c:'),
+                         '"a" "OR" "b" "c" *')
+        self.assertEqual(fulltext.match_expression('*()'), '')
+
+    def test_ranked_by_name_then_address(self):
+        self.assertEqual(self.search('magnolia')[0],
+                         [self.other.id, self.shelter.id])
+        self.assertEqual(self.search('harbor')[0],
+                         [self.shelter.id, self.other.id])
+
+    def test_every_shelter_ranked(self):
+        # Harbor House ranks first although Magnolia Shelter is newer
+        with mock.patch.object(fulltext, 'RANK_WINDOW', 1):
+            data = self.client.get(self.url, {'q': 'harbor', 'limit': 1})
+        self.assertEqual(data.json()['shelters'][0]['id'], self.shelter.id)
+
+    def test_only_newest_comments_ranked(self):
+        newer = Comment.objects.create(
+            author="Sam", content="No pets inside, pets outside in crates",
+            shelter=self.other)
+        self.assertEqual(self.search('crate')[1], [self.comment.id, newer.id])
+        with mock.patch.object(fulltext, 'RANK_WINDOW', 1):
+            data = self.client.get(self.url, {'q': 'crate', 'limit': 1})
+        self.assertEqual(data.json()['comments'][0]['id'], newer.id)
+
+    def test_prefix_phrase_and_stemming(self):
+        self.assertEqual(self.search('magno')[0],
+                         [self.other.id, self.shelter.id])
+        self.assertEqual(self.search('pet allow')[1], [self.comment.id])
+        self.assertEqual(self.search('"pets allowed"')[1], [self.comment.id])
+        self.assertEqual(self.search('"allowed pets"')[1], [])
+
+    def test_triggers_survive_reversed_migrations(self):
+        # SQLite before 3.35.5 can't drop columns in place, and Django
+        # rebuilds the table instead
+        script = (
+            'import django; django.setup(); '
+            'from django.core.management import call_command; '
+            'from django.db import connection; '
+            'connection.features.can_alter_table_drop_column = False; '
+            'call_command("migrate", verbosity=0); '
+            'call_command("migrate", "shelterme", "%s", verbosity=0)')
+        for target in ['0009', '0008']:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'test.sqlite3')
+                subprocess.run(
+                    [sys.executable, '-c', script % target], check=True,
+                    cwd=settings.BASE_DIR, env=dict(
+                        os.environ, SHELTERME_SQLITE_PATH=path,
+                        SHELTERME_SQLITE_REPLICA_PATH=path,
+                        DJANGO_SETTINGS_MODULE='shelter_me_project.settings'))
+                db = sqlite3.connect(path)
+                triggers = {row[0] for row in db.execute(
+                    "SELECT name FROM sqlite_master WHERE type='trigger'")}
+                db.close()
+            self.assertEqual(len(triggers), len(fulltext.TRIGGERS))
+
+    def test_syntax_is_searched_for(self):
+        response = self.client.get(self.url, {'q': 'pets" OR NEAR(*'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_index_follows_shelter_views(self):
+        self.client.post(reverse('shelterme:create'), {
+            'shelter_name': 'Riverside Refuge', 'street_address': '9 Oak St',
+            'city': 'Auburn', 'state': 'AL', 'zip_code': '36830',
+            'max_capacity': 10, 'photourl': 'https://example.com/a.jpg'})
+        created = Shelter.objects.get(name='Riverside Refuge')
+        self.assertEqual(self.search('riverside')[0], [created.id])
+
+        self.client.post(reverse('shelterme:update', args=(created.id,)), {
+            'shelter_name': 'Lakeside Refuge', 'street_address': '9 Oak St',
+            'city': 'Auburn', 'state': 'AL', 'zip_code': '36830',
+            'max_cap': 10, 'photourl': 'https://example.com/a.jpg'})
+        self.assertEqual(self.search('riverside')[0], [])
+        self.assertEqual(self.search('lakeside')[0], [created.id])
+
+        # Check-ins don't touch the indexed columns
+        Shelter.objects.adjust_occupancy(created.id, 1)
+        self.assertEqual(self.search('lakeside')[0], [created.id])
+
+        self.client.post(reverse('shelterme:delete', args=(created.id,)))
+        self.assertEqual(self.search('lakeside')[0], [])
+
+    def test_index_follows_comment_views(self):
+        self.client.post(
+            reverse('shelterme:comment_create', args=(self.other.id,)),
+            {'content': 'Wheelchair ramp at the side door'})
+        created = Comment.objects.get(shelter=self.other)
+        self.assertEqual(self.search('wheelchair')[1], [created.id])
+
+        self.client.post(reverse('shelterme:comment_update',
+                                 args=(self.other.id, created.id)),
+                         {'content': 'Ramp is closed'})
+        self.assertEqual(self.search('wheelchair')[1], [])
+        self.assertEqual(self.search('closed')[1], [created.id])
+
+        self.client.post(reverse('shelterme:comment_delete',
+                                 args=(self.other.id, created.id)))
+        self.assertEqual(self.search('closed')[1], [])
+
+    def test_rebuild(self):
+        Comment.objects.bulk_create([Comment(
+            author='Sam', content='Generator on site', shelter=self.other)])
+        call_command('rebuild_fulltext', stdout=StringIO())
+        self.assertEqual(len(self.search('generator')[1]), 1)
+        self.assertEqual(self.search('pets')[1], [self.comment.id])
+
+    # Sad path
+    def test_bad_query(self):
+        for params in [{}, {'q': ''}, {'q': '*** ()'}, {'q': 'a' * 201},
+                       {'q': 'pets', 'limit': 0}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+    def test_post(self):
+        response = self.client.post(self.url, {'q': 'pets'})
+        self.assertEqual(response.status_code, 405)
+
+
+# Serves canned responses ({path: (status, content type, body)}) and
+# redirects ({path: location}) on a local port and counts the requests for
+# every path
+class StubHTTPServer:
+
+    def __init__(self, responses, redirects=None):
+        self.responses = responses
+        self.redirects = redirects or {}
+        self.hits = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                if self.path in stub.redirects:
+                    self.send_response(302)
+                    self.send_header('Location', stub.redirects[self.path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status, content_type, body = stub.responses.get(
+                    self.path, (404, 'text/plain', b'Not found'))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def png(width, height, color):
+    output = BytesIO()
+    thumbnails.Image.new('RGB', (width, height), color).save(output, 'PNG')
+    return output.getvalue()
+
+
+# Analysis -- shelterme.thumbnails and shelterme.views.thumbnail
+# Makes and serves fixed-size thumbnails of shelter photos
+# Parameters
+# name      string      <hash>-<size>.<ext>     mandatory
+#
+# Happy Path:
+# saved shelter -> photo fetched once after commit, every size made as
+# WebP and JPEG under its content hash, cards and header switch to them
+# until then -> logo
+# shelters sharing a photo share its thumbnails
+# changed photo -> logo until the new thumbnails are made
+# thumbnails served with far-future, immutable cache headers
+# make_thumbnails retries photos that failed
+#
+# Sad Path:
+# photo missing, not an image or too big -> logo stays
+# photo on a non-public address, or redirected to one -> not fetched
+# photo URL or redirect not http(s) -> not fetched
+# malformed or unknown thumbnail name -> 404
+# POST -> 405
+@skipUnless(thumbnails.available(), 'Making thumbnails needs Pillow')
+class ThumbnailTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StubHTTPServer({
+            '/red.png': (200, 'image/png', png(800, 600, 'red')),
+            '/blue.png': (200, 'image/png', png(300, 900, 'blue')),
+            '/text': (200, 'text/plain', b'Not an image'),
+        }, {
+            '/moved.png': '/red.png',
+            '/ftp.png': 'ftp://127.0.0.1/red.png',
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.stub.hits.clear()
+        self.root = tempfile.TemporaryDirectory()
+        patches = [mock.patch.object(thumbnails, 'THUMBNAIL_ROOT',
+                                     self.root.name),
+                   mock.patch.object(thumbnails, 'BACKGROUND', False),
+                   # The stub server is on the loopback address
+                   mock.patch.object(thumbnails, 'ALLOW_PRIVATE', True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.root.cleanup)
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+
+    def create(self, photo, process=True):
+        with self.captureOnCommitCallbacks(execute=process):
+            return Shelter.objects.create(
+                name="Test Shelter", street_addr="1 Test St",
+                location=self.loc, zip="36830",
+                photo=self.stub.url(photo))
+
+    def fetch(self, shelter):
+        shelter.refresh_from_db()
+        return shelter
+
+    # Happy path
+    def test_thumbnails_made_and_used(self):
+        shelter = self.create('/red.png', process=False)
+        version = shelter.version
+        response = self.client.get(reverse('shelterme:index'),
+                                   {'zip': '36830', 'radius': 5})
+        self.assertContains(response, 'shelterme/logo.png')
+        self.assertNotContains(response, 'red.png')
+        self.assertIsNone(shelter.card_thumbnails)
+
+        self.assertTrue(thumbnails.process(shelter.id))
+        shelter = self.fetch(shelter)
+        self.assertNotEqual(shelter.version, version)
+        self.assertEqual(sorted(os.listdir(self.root.name)), sorted(
+            '%s-%s.%s' % (shelter.thumbnail, size, ext)
+            for size in ['card', 'header'] for ext in ['webp', 'jpg']))
+
+        response = self.client.get(reverse('shelterme:index'),
+                                   {'zip': '36830', 'radius': 5})
+        self.assertContains(response, shelter.card_thumbnails['webp'])
+        self.assertContains(response, shelter.card_thumbnails['jpg'])
+        response = self.client.get(reverse('shelterme:show',
+                                           args=(shelter.id,)))
+        self.assertContains(response, shelter.header_thumbnails['webp'])
+        self.assertNotContains(response, 'red.png')
+
+    def test_fixed_sizes(self):
+        shelter = self.fetch(self.create('/blue.png'))
+        for size, dimensions in thumbnails.SIZES.items():
+            for ext in ['webp', 'jpg']:
+                path = os.path.join(self.root.name, '%s-%s.%s' % (
+                    shelter.thumbnail, size, ext))
+                with thumbnails.Image.open(path) as image:
+                    self.assertEqual(image.size, dimensions)
+
+    def test_photo_fetched_once(self):
+        shelter = self.fetch(self.create('/red.png'))
+        with self.captureOnCommitCallbacks(execute=True):
+            shelter.name = "Renamed Shelter"
+            shelter.save()
+        self.assertEqual(self.stub.hits, {'/red.png': 1})
+
+        # Another shelter with the same photo gets the same files
+        other = self.fetch(self.create('/red.png'))
+        self.assertEqual(other.thumbnail, shelter.thumbnail)
+        self.assertEqual(len(os.listdir(self.root.name)), 4)
+
+    def test_changed_photo(self):
+        shelter = self.fetch(self.create('/red.png'))
+        red = shelter.thumbnail
+        shelter.photo = self.stub.url('/blue.png')
+        with self.captureOnCommitCallbacks(execute=False):
+            shelter.save()
+        self.assertIsNone(self.fetch(shelter).card_thumbnails)
+
+        thumbnails.process(shelter.id)
+        shelter = self.fetch(shelter)
+        self.assertNotEqual(shelter.thumbnail, red)
+        self.assertIn(shelter.thumbnail, shelter.card_thumbnails['jpg'])
+
+    def test_served_immutable(self):
+        shelter = self.fetch(self.create('/red.png'))
+        response = self.client.get(shelter.card_thumbnails['webp'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertEqual(b''.join(response.streaming_content)[:4], b'RIFF')
+        response.close()
+
+    def test_make_thumbnails_retries(self):
+        with self.assertLogs('shelterme.thumbnails', 'WARNING'):
+            shelter = self.create('/later.png')
+        self.assertEqual(self.fetch(shelter).thumbnail, '')
+
+        self.stub.responses['/later.png'] = (200, 'image/png',
+                                             png(400, 400, 'green'))
+        self.addCleanup(self.stub.responses.pop, '/later.png')
+        out = StringIO()
+        call_command('make_thumbnails', stdout=out)
+        self.assertIn('Made thumbnails for 1 shelters, 0 failed.',
+                      out.getvalue())
+        self.assertIsNotNone(self.fetch(shelter).card_thumbnails)
+
+    # Sad path
+    def test_bad_photos_keep_the_logo(self):
+        with self.assertLogs('shelterme.thumbnails', 'WARNING') as logs:
+            for photo in ['/missing.png', '/text']:
+                shelter = self.create(photo)
+                self.assertFalse(thumbnails.process(shelter.id))
+                self.assertIsNone(self.fetch(shelter).card_thumbnails)
+            with mock.patch.object(thumbnails, 'MAX_PHOTO_BYTES', 1000):
+                shelter = self.create('/red.png')
+            self.assertIsNone(self.fetch(shelter).card_thumbnails)
+        self.assertIn('photo is over 1000 bytes', logs.output[-1])
+        self.assertEqual(os.listdir(self.root.name), [])
+
+    def test_private_addresses_refused(self):
+        for address in ['127.0.0.1', '10.0.0.1', '169.254.169.254',
+                        '::1', 'fd00::1', '224.0.0.1']:
+            with mock.patch.object(thumbnails, 'ALLOW_PRIVATE', False):
+                self.assertFalse(thumbnails.allowed(address))
+        self.assertTrue(thumbnails.allowed('93.184.216.34'))
+
+        with mock.patch.object(thumbnails, 'ALLOW_PRIVATE', False):
+            with self.assertLogs('shelterme.thumbnails', 'WARNING') as logs:
+                shelter = self.create('/red.png')
+        self.assertIn('is not a public address', logs.output[0])
+        self.assertEqual(self.stub.hits, {})
+        self.assertEqual(self.fetch(shelter).thumbnail, '')
+
+    def test_redirects_checked(self):
+        self.assertEqual(thumbnails.fetch(self.stub.url('/moved.png')),
+                         self.stub.responses['/red.png'][2])
+        # The first connection is let through, the redirect's isn't
+        self.stub.hits.clear()
+        with mock.patch.object(thumbnails, 'allowed',
+                               side_effect=[True, False]):
+            with self.assertRaisesRegex(OSError, 'not a public address'):
+                thumbnails.fetch(self.stub.url('/moved.png'))
+        self.assertEqual(self.stub.hits, {'/moved.png': 1})
+
+    def test_only_http(self):
+        with self.assertRaisesRegex(ValueError, 'not http'):
+            thumbnails.fetch('file:///etc/passwd')
+        with self.assertRaisesRegex(OSError, 'not http'):
+            thumbnails.fetch(self.stub.url('/ftp.png'))
+
+    def test_bad_thumbnail_names(self):
+        for name in ['nope.jpg', '0' * 20 + '-card.gif',
+                     '0' * 20 + '-huge.jpg', '0' * 20 + '-card.jpg']:
+            response = self.client.get(reverse('shelterme:thumbnail',
+                                               args=(name,)))
+            self.assertEqual(response.status_code, 404)
+
+    def test_post(self):
+        shelter = self.fetch(self.create('/red.png'))
+        response = self.client.post(shelter.card_thumbnails['jpg'])
+        self.assertEqual(response.status_code, 405)
+
+
+# Analysis -- shelterme.management.commands.import_shelters
+# Bulk imports shelters from CSV / JSON Lines / JSON files
+#
+# Happy Path:
+# valid csv rows -> shelters and locations created, coordinates set
+# rows for an existing location -> existing location reused
+# more rows than the batch size -> every row imported
+# json lines input
+# cached searches around the new shelters invalidated
+#
+# Sad Path:
+# city/state/zip mismatch, bad capacity, malformed line -> row rejected
+# version cache not shared with the servers -> warning
+class ImportSheltersCommandTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.existing = Location.objects.create(city="Auburn", state="AL")
+
+    def write(self, suffix, content):
+        f = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def run_import(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_shelters', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    # Happy path
+    def test_csv_import(self):
+        rows = ['name,street_address,city,state,zip,max_capacity']
+        for i in range(7):
+            rows.append('Shelter %d,%d Main St,auburn,al,36830,50' % (i, i))
+        rows.append('Moody Shelter,1 Main St,Moody,AL,35004,20')
+        path = self.write('.csv', '\n'.join(rows) + '\n')
+        out, err = self.run_import(path, '--batch-size', '3')
+        self.assertIn('Imported 8 shelters, rejected 0 rows', out)
+        self.assertEqual(
+            Shelter.objects.filter(location=self.existing).count(), 7)
+        moody = Shelter.objects.get(name='Moody Shelter')
+        self.assertEqual(moody.location.city, 'Moody')
+        self.assertIsNotNone(moody.latitude)
+
+    def test_jsonl_import(self):
+        path = self.write('.jsonl', json.dumps({
+            'name': 'JSON Shelter', 'street_addr': '1 Main St',
+            'city': 'Auburn', 'state': 'AL', 'zip': '36830',
+            'max_capacity': 5}) + '\n')
+        out, err = self.run_import(path)
+        self.assertIn('Imported 1 shelters', out)
+        self.assertTrue(Shelter.objects.filter(name='JSON Shelter').exists())
+
+    def test_import_invalidates_searches(self):
+        Shelter.objects.create(name="Old Shelter", street_addr="1 Test St",
+                               location=self.existing, zip="36830")
+        self.assertEqual(len(search_cache.near_zip('36830', 10)), 1)
+        path = self.write('.csv', 'name,street_address,city,state,zip,'
+                                  'max_capacity\nNew,1 Main St,Auburn,AL,'
+                                  '36830,50\n')
+        out, err = self.run_import(path)
+        self.assertEqual(err, '')
+        self.assertEqual(len(search_cache.near_zip('36830', 10)), 2)
+
+    # Sad path
+    def test_unshared_versions_warn(self):
+        path = self.write('.csv', 'name,street_address,city,state,zip,'
+                                  'max_capacity\nNew,1 Main St,Auburn,AL,'
+                                  '36830,50\n')
+        with mock.patch.object(search_cache, 'VERSION_CACHE_ALIAS',
+                               'default'):
+            out, err = self.run_import(path)
+        self.assertIn('may not list the new shelters', err)
+
+    def test_bad_rows_rejected(self):
+        path = self.write('.jsonl', '\n'.join([
+            json.dumps({'name': 'Wrong City', 'street_addr': '1 Main St',
+                        'city': 'Birmingham', 'state': 'AL', 'zip': '36830',
+                        'max_capacity': 5}),
+            json.dumps({'name': 'Bad Cap', 'street_addr': '1 Main St',
+                        'city': 'Auburn', 'state': 'AL', 'zip': '36830',
+                        'max_capacity': 'lots'}),
+            '{not json',
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn('Imported 0 shelters, rejected 3 rows', out)
+        self.assertIn('Rejected row 1', err)
+        self.assertFalse(Shelter.objects.exists())
+
+
+# Analysis -- shelterme.views.checkin / checkout / api_occupancy
+# Atomically changes a shelter's current capacity
+# Parameters
+# id        integer     maps to a shelter       mandatory
+# count     integer     .GE 1, .LE 10000        optional    default=1
+#
+# Happy Path:
+# check in with room -> current capacity goes up
+# check out with people -> current capacity goes down
+# batch of changes -> each applied or refused on its own
+#
+# Sad Path:
+# check in past max -> 409, unchanged
+# check out below zero -> 409, unchanged
+# bad count / body -> 400
+# nonexistent shelter -> 404
+# GET -> 405
+class OccupancyViewTests(TestCase):
+
+    def setUp(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830", max_capacity=5, current_capacity=2)
+
+    def url(self, name, id=None):
+        return reverse('shelterme:' + name, args=(id or self.shelter.id,))
+
+    def current(self):
+        self.shelter.refresh_from_db()
+        return self.shelter.current_capacity
+
+    # Happy path
+    def test_checkin(self):
+        response = self.client.post(self.url('checkin'), {'count': 3})
+        self.assertEqual(response.json()['current_capacity'], 5)
+        self.assertEqual(self.current(), 5)
+
+    def test_checkout(self):
+        response = self.client.post(self.url('checkout'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.current(), 1)
+
+    def test_batch(self):
+        body = {'changes': [{'id': self.shelter.id, 'delta': 3},
+                            {'id': self.shelter.id, 'delta': 1},
+                            {'id': self.shelter.id, 'delta': -4}]}
+        response = self.client.post(reverse('shelterme:api_occupancy'),
+                                    json.dumps(body),
+                                    content_type='application/json')
+        applied = [r['applied'] for r in response.json()['results']]
+        self.assertEqual(applied, [True, False, True])
+        self.assertEqual(self.current(), 1)
+
+    # Sad path
+    def test_checkin_when_full(self):
+        response = self.client.post(self.url('checkin'), {'count': 4})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.current(), 2)
+
+    def test_checkout_when_empty(self):
+        response = self.client.post(self.url('checkout'), {'count': 3})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.current(), 2)
+
+    def test_bad_count(self):
+        for count in ['0', 'x', '10001']:
+            response = self.client.post(self.url('checkin'), {'count': count})
+            self.assertEqual(response.status_code, 400)
+
+    def test_bad_batch_body(self):
+        for body in ['nope', '{}', '{"changes": []}',
+                     '{"changes": [{"id": 1, "delta": 0}]}']:
+            response = self.client.post(reverse('shelterme:api_occupancy'),
+                                        body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_nonexistent_shelter(self):
+        response = self.client.post(self.url('checkin', 1000))
+        self.assertEqual(response.status_code, 404)
+
+    def test_get(self):
+        response = self.client.get(self.url('checkin'))
+        self.assertEqual(response.status_code, 405)
+
+
+# Many workers checking people in and out of the same shelter at once must
+# leave the count exact and never past max capacity
+class OccupancyConcurrencyTests(TransactionTestCase):
+    databases = {'default', 'readonly'}
+
+    THREADS = 8
+    ATTEMPTS = 50
+
+    def setUp(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830", max_capacity=300, current_capacity=0)
+
+    def hammer(self, delta):
+        applied = []
+
+        def worker():
+            count = 0
+            try:
+                for i in range(self.ATTEMPTS):
+                    if Shelter.objects.adjust_occupancy(self.shelter.id,
+                                                        delta):
+                        count += 1
+            finally:
+                connection.close()
+            applied.append(count)
+
+        threads = [Thread(target=worker) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(applied), self.THREADS)
+        return sum(applied)
+
+    def test_concurrent_checkins_never_overflow(self):
+        checked_in = self.hammer(1)
+        self.shelter.refresh_from_db()
+        # 400 attempts for 300 beds
+        self.assertEqual(checked_in, 300)
+        self.assertEqual(self.shelter.current_capacity, 300)
+
+    def test_concurrent_checkins_and_checkouts_balance(self):
+        Shelter.objects.filter(id=self.shelter.id).update(
+            current_capacity=150)
+        checked_in = self.hammer(1)
+        checked_out = self.hammer(-1)
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.current_capacity,
+                         150 + checked_in - checked_out)
+
+
+# Analysis -- shelterme.capacity_feed / shelterme.views.capacity_stream
+# and api_capacity
+# Pushes capacity changes to everyone watching a shelter
+# Parameters
+# ids       string      comma separated ids     mandatory   .LE 200 ids
+#
+# Happy Path:
+# stream starts with a snapshot of every watched shelter
+# check-in -> change pushed to the stream
+# stream ends after its lifetime and unsubscribes
+# ASGI request -> stream that actually sends, then ends
+# WSGI request -> 204 (no stream holding a worker), capacities polled from
+# api_capacity instead
+# change to a shelter nobody watches -> nothing pushed
+# several changes before the watcher reads -> coalesced to the latest
+#
+# Sad Path:
+# missing / malformed ids -> 400 (stream and api_capacity)
+# POST -> 405 (stream and api_capacity)
+class CapacityStreamTests(TestCase):
+
+    def setUp(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830", max_capacity=5, current_capacity=2)
+        self.url = reverse('shelterme:capacity_stream')
+        self.poll_url = reverse('shelterme:api_capacity')
+
+    # Happy path
+    async def test_stream_snapshot_then_changes(self):
+        events = capacity_events({self.shelter.id}, 60)
+        self.assertTrue((await events.__anext__()).startswith('retry:'))
+        snapshot = await events.__anext__()
+        self.assertIn('"current_capacity": 2', snapshot)
+
+        feed.publish(self.shelter.id, 3, 5)
+        change = await asyncio.wait_for(events.__anext__(), 5)
+        self.assertTrue(change.startswith('event: capacity'))
+        self.assertIn('"current_capacity": 3', change)
+        await events.aclose()
+        self.assertFalse(feed.subscriptions)
+
+    async def test_stream_ends(self):
+        messages = [message async for message in capacity_events(
+            {self.shelter.id}, 0.05)]
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[-1], ': keepalive\n\n')
+        self.assertFalse(feed.subscriptions)
+
+    async def test_asgi_stream_sends_and_ends(self):
+        with mock.patch('shelterme.views.SSE_LIFETIME', 0.05):
+            response = await self.async_client.get(
+                self.url, {'ids': self.shelter.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            body = ''.join([chunk.decode() async for chunk
+                            in response.streaming_content])
+        self.assertIn('"current_capacity": 2', body)
+        self.assertFalse(feed.subscriptions)
+
+    def test_wsgi_polls_instead(self):
+        response = self.client.get(self.url, {'ids': self.shelter.id})
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(feed.subscriptions)
+
+        response = self.client.get(self.poll_url, {'ids': self.shelter.id})
+        self.assertEqual(response.json(), {'shelters': [{
+            'id': self.shelter.id, 'current_capacity': 2,
+            'max_capacity': 5}]})
+
+    async def test_only_watchers_of_the_shelter_are_notified(self):
+        test_feed = CapacityFeed()
+        watching = test_feed.subscribe({1})
+        other = test_feed.subscribe({2})
+        test_feed.publish(1, 3, 5)
+        self.assertEqual(len(await watching.changes(1)), 1)
+        self.assertEqual(await other.changes(0.01), [])
+
+    async def test_changes_are_coalesced(self):
+        test_feed = CapacityFeed()
+        watching = test_feed.subscribe({1})
+        for current in range(5):
+            test_feed.publish(1, current, 5)
+        changes = await watching.changes(1)
+        self.assertEqual(changes, [
+            {'id': 1, 'current_capacity': 4, 'max_capacity': 5}])
+
+    # Sad path
+    def test_bad_ids(self):
+        for url in [self.url, self.poll_url]:
+            for ids in ['', 'a,b', ','.join(str(i) for i in range(201))]:
+                response = self.client.get(url, {'ids': ids})
+                self.assertEqual(response.status_code, 400)
+
+    def test_post(self):
+        for url in [self.url, self.poll_url]:
+            response = self.client.post(url, {'ids': self.shelter.id})
+            self.assertEqual(response.status_code, 405)
+
+
+# Analysis -- shelterme.views.show and the comment views (async)
+# Parameters
+# id            integer     maps to a shelter       mandatory
+# comment_id    integer     maps to a comment       mandatory
+#
+# Happy Path:
+# show -> shelter, location and comments rendered
+# create / update / delete comment -> redirect to show, db changed
+#
+# Sad Path:
+# nonexistent or non-numeric id -> 404
+class ShowAndCommentViewTests(TestCase):
+
+    def setUp(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830", max_capacity=5)
+        self.comment = Comment.objects.create(
+            author="Hunter", content="Pets allowed", shelter=self.shelter)
+        self.show_url = reverse('shelterme:show', args=(self.shelter.id,))
+
+    def comment_url(self, name):
+        return reverse('shelterme:' + name,
+                       args=(self.shelter.id, self.comment.id))
+
+    # Happy path
+    def test_show(self):
+        response = self.client.get(self.show_url)
+        self.assertContains(response, "Test Shelter")
+        self.assertContains(response, "Auburn, AL")
+        self.assertContains(response, "Pets allowed")
+
+    def test_comment_edit(self):
+        response = self.client.get(self.comment_url('comment_edit'))
+        self.assertContains(response, "Pets allowed")
+
+    def test_comment_create(self):
+        url = reverse('shelterme:comment_create', args=(self.shelter.id,))
+        response = self.client.post(url, {'content': 'Bring blankets'})
+        self.assertRedirects(response, self.show_url)
+        self.assertTrue(
+            Comment.objects.filter(content='Bring blankets').exists())
+
+    def test_comment_update(self):
+        response = self.client.post(self.comment_url('comment_update'),
+                                    {'content': 'No pets'})
+        self.assertRedirects(response, self.show_url)
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.content, 'No pets')
+
+    def test_comment_delete(self):
+        response = self.client.post(self.comment_url('comment_delete'))
+        self.assertRedirects(response, self.show_url)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_comments_paged_by_id(self):
+        for i in range(25):
+            Comment.objects.create(author="Hunter", content="Comment %d" % i,
+                                   shelter=self.shelter)
+        response = self.client.get(self.show_url)
+        comments = response.context['comments']
+        self.assertEqual(len(comments), 20)
+        self.assertContains(response, '26 comments')
+
+        response = self.client.get(self.show_url,
+                                   {'after': response.context['next_after']})
+        self.assertEqual(len(response.context['comments']), 6)
+        self.assertIsNone(response.context['next_after'])
+
+    def test_show_query_count(self):
+        with self.assertNumQueries(2):
+            self.client.get(self.show_url)
+
+    def test_comment_count_tracks_create_and_delete(self):
+        url = reverse('shelterme:comment_create', args=(self.shelter.id,))
+        self.client.post(url, {'content': 'Bring blankets'})
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 2)
+        self.client.post(self.comment_url('comment_delete'))
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 1)
+
+    # Sad path
+    def test_stale_comment_delete_keeps_count(self):
+        stale = Comment.objects.get(pk=self.comment.pk)
+        self.comment.delete()
+        stale.delete()
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 0)
+
+    def test_show_nonexistent(self):
+        for id in [1000, 'abc']:
+            url = reverse('shelterme:show', args=(id,))
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+
+# Analysis -- shelterme.comment_queue
+# Write-behind queue for comment creates, edits and deletes
+# Parameters
+# ordering      string      'fifo' / 'coalesce'             default 'fifo'
+# durability    string      'memory' / 'file' / 'fsync'     default 'file'
+#
+# Happy Path:
+# write-behind on -> change queued, redirect, nothing written yet
+# client's own queued changes shown on its show page (new comments marked
+# pending, edits applied, deletes hidden, count adjusted), not on others'
+# flush -> changes written in batches, one transaction each, new comments
+# in the order they were queued
+# fifo and coalesce -> same stored comments, coalesce with fewer queries
+# queued edit written -> shelter touched (both orderings)
+# 'file' / 'fsync' -> changes left by a crash replayed, and stored once
+# even if the crash came after the commit
+# 'fsync' -> journal fsynced before the view answers
+# flush_comment_queue -> writes what a crash left in every journal
+# background worker -> writes the queue on its own
+# second process on the same file -> journal of its own, locked
+#
+# Sad Path:
+# queue full -> queue written first, then the change queued (fifo kept)
+# flush_comment_queue while a server holds a journal -> error
+# 'memory' -> nothing survives a crash
+# torn journal line -> skipped
+# shelter deleted before the write -> its new comments dropped
+# unknown ordering / durability -> ImproperlyConfigured
+class CommentQueueTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'queue.jsonl')
+        self.queue = self.make()
+        patches = [mock.patch.object(comment_queue, 'WRITE_BEHIND', True),
+                   mock.patch.object(comment_queue, 'queue', self.queue)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = self.new_shelter()
+        self.comment = Comment.objects.create(
+            author="Hunter", content="Pets allowed", shelter=self.shelter)
+        self.show_url = reverse('shelterme:show', args=(self.shelter.id,))
+
+    def make(self, **kwargs):
+        options = {'path': self.path, 'background': False}
+        options.update(kwargs)
+        queue = comment_queue.CommentQueue(**options)
+        self.addCleanup(queue.close)
+        return queue
+
+    def new_shelter(self):
+        return Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=self.loc,
+            zip="36830")
+
+    def post(self, name, *args, **data):
+        return self.client.post(
+            reverse('shelterme:' + name, args=(self.shelter.id,) + args),
+            data)
+
+    def create(self, shelter_id, content):
+        return comment_queue.Operation(comment_queue.CREATE, shelter_id,
+                                       author='Hunter', content=content)
+
+    def contents(self, shelter):
+        return list(Comment.objects.filter(shelter=shelter).order_by(
+            'id').values_list('content', flat=True))
+
+    # Happy path
+    def test_create_queued_and_shown_to_its_client(self):
+        response = self.post('comment_create', content='Bring blankets')
+        self.assertRedirects(response, self.show_url)
+        self.assertIn(comment_queue.CLIENT_COOKIE, response.cookies)
+        self.assertFalse(
+            Comment.objects.filter(content='Bring blankets').exists())
+
+        response = self.client.get(self.show_url)
+        self.assertContains(response, 'Bring blankets')
+        self.assertContains(response, 'comment-pending')
+        self.assertContains(response, '2 comments')
+        other = self.client_class().get(self.show_url)
+        self.assertNotContains(other, 'Bring blankets')
+        self.assertContains(other, '1 comment')
+
+        self.assertEqual(self.queue.flush(), 1)
+        comment = Comment.objects.get(content='Bring blankets')
+        self.assertEqual(comment.author, 'Hunter')
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 2)
+        response = self.client.get(self.show_url)
+        self.assertContains(response, 'Bring blankets')
+        self.assertNotContains(response, 'comment-pending')
+
+    def test_update_and_delete_shown_until_written(self):
+        other = Comment.objects.create(author="Hunter", content="No smoking",
+                                       shelter=self.shelter)
+        self.post('comment_update', self.comment.id, content='No pets')
+        self.post('comment_delete', other.id)
+        self.assertEqual(self.contents(self.shelter),
+                         ['Pets allowed', 'No smoking'])
+
+        response = self.client.get(self.show_url)
+        self.assertContains(response, 'No pets')
+        self.assertNotContains(response, 'Pets allowed')
+        self.assertNotContains(response, 'No smoking')
+        self.assertContains(response, '1 comment')
+
+        self.queue.flush()
+        self.assertEqual(self.contents(self.shelter), ['No pets'])
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 1)
+
+    def test_queued_change_beats_cached_page(self):
+        etag = self.client.get(self.show_url)['ETag']
+        self.post('comment_create', content='Bring blankets')
+        response = self.client.get(self.show_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Bring blankets')
+
+    def test_batches(self):
+        for ordering in comment_queue.ORDERINGS:
+            queue = self.make(ordering=ordering, batch_size=20,
+                              durability='memory')
+            shelter = self.new_shelter()
+            contents = ['Comment %d' % i for i in range(50)]
+            for content in contents:
+                queue.put(self.create(shelter.id, content))
+            with mock.patch.object(queue, 'apply',
+                                   wraps=queue.apply) as apply:
+                self.assertEqual(queue.flush(), 50)
+            self.assertEqual(apply.call_count, 3)
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(self.contents(shelter), contents)
+            shelter.refresh_from_db()
+            self.assertEqual(shelter.comment_count, 50)
+
+    def test_orderings_agree(self):
+        results = {}
+        for ordering in comment_queue.ORDERINGS:
+            queue = self.make(ordering=ordering, durability='memory')
+            shelter = self.new_shelter()
+            first, second, third = [
+                Comment.objects.create(author="Hunter", content=content,
+                                       shelter=shelter)
+                for content in ['First', 'Second', 'Third']]
+            for operation in [
+                    self.create(shelter.id, 'Fourth'),
+                    comment_queue.Operation(
+                        comment_queue.UPDATE, shelter.id,
+                        comment_id=first.id, content='First, edited'),
+                    comment_queue.Operation(
+                        comment_queue.UPDATE, shelter.id,
+                        comment_id=first.id, content='First, edited twice'),
+                    comment_queue.Operation(
+                        comment_queue.UPDATE, shelter.id,
+                        comment_id=second.id, content='Second, edited'),
+                    comment_queue.Operation(
+                        comment_queue.DELETE, shelter.id,
+                        comment_id=second.id),
+                    comment_queue.Operation(
+                        comment_queue.DELETE, shelter.id,
+                        comment_id=third.id),
+                    self.create(shelter.id, 'Fifth')]:
+                queue.put(operation)
+            with CaptureQueriesContext(connection) as queries:
+                queue.flush()
+            shelter.refresh_from_db()
+            results[ordering] = (self.contents(shelter),
+                                 shelter.comment_count, len(queries))
+
+        self.assertEqual(results['fifo'][:2], (
+            ['First, edited twice', 'Fourth', 'Fifth'], 3))
+        self.assertEqual(results['coalesce'][:2], results['fifo'][:2])
+        self.assertLess(results['coalesce'][2], results['fifo'][2])
+
+    def test_edit_touches_shelter(self):
+        for ordering in comment_queue.ORDERINGS:
+            queue = self.make(ordering=ordering, durability='memory')
+            before = Shelter.objects.get(id=self.shelter.id).updated_at
+            queue.put(comment_queue.Operation(
+                comment_queue.UPDATE, self.shelter.id,
+                comment_id=self.comment.id, content=ordering))
+            queue.flush()
+            self.assertGreater(
+                Shelter.objects.get(id=self.shelter.id).updated_at, before)
+
+    def test_journal_replayed(self):
+        for durability in ['file', 'fsync']:
+            path = os.path.join(self.tmp.name, durability + '.jsonl')
+            queue = self.make(durability=durability, path=path)
+            queue.put(self.create(self.shelter.id, 'Queued ' + durability))
+
+            # The process dies without writing the queue
+            queue.close()
+            queue = self.make(durability=durability, path=path)
+            self.assertEqual(queue.flush(), 1)
+            self.assertTrue(Comment.objects.filter(
+                content='Queued ' + durability).exists())
+            with open(path) as file:
+                self.assertEqual(file.read(), '')
+
+    def test_replay_stores_comments_once(self):
+        self.queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        self.queue.put(comment_queue.Operation(
+            comment_queue.DELETE, self.shelter.id,
+            comment_id=self.comment.id))
+        # The process dies between the commit and the journal rewrite
+        with mock.patch.object(self.queue, '_rewrite_journal'):
+            self.queue.flush()
+        self.queue.close()
+
+        self.assertEqual(self.make().flush(), 2)
+        self.assertEqual(self.contents(self.shelter), ['Bring blankets'])
+        self.shelter.refresh_from_db()
+        self.assertEqual(self.shelter.comment_count, 1)
+
+    def test_fsync(self):
+        for durability, fsyncs in [('file', False), ('fsync', True)]:
+            queue = self.make(durability=durability, path=os.path.join(
+                self.tmp.name, durability + '.jsonl'))
+            queue.recover()
+            with mock.patch.object(comment_queue.os, 'fsync') as fsync:
+                queue.put(self.create(self.shelter.id, 'Bring blankets'))
+            self.assertEqual(fsync.called, fsyncs)
+
+    def test_flush_command(self):
+        self.queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        other = self.make()
+        other.put(self.create(self.shelter.id, 'No smoking'))
+        self.queue.close()
+        other.close()
+        output = StringIO()
+        with mock.patch.object(comment_queue, 'FILE', self.path):
+            call_command('flush_comment_queue', stdout=output)
+        self.assertIn('Wrote 2 queued', output.getvalue())
+        self.assertEqual(self.contents(self.shelter),
+                         ['Pets allowed', 'Bring blankets', 'No smoking'])
+
+    @skipUnless(comment_queue.fcntl, 'Locking journals needs fcntl')
+    def test_journal_per_process(self):
+        self.queue.recover()
+        other = self.make()
+        other.recover()
+        self.assertEqual(self.queue.journal_path, self.path)
+        self.assertEqual(other.journal_path, self.path + '.1')
+        # The first journal is free again once its process is gone
+        self.queue.close()
+        self.assertEqual(self.make().claim_journal(), self.path)
+        with self.assertRaises(ImproperlyConfigured):
+            self.make(journals=1).claim_journal()
+
+    # Sad path
+    def test_full_queue_written_first(self):
+        self.post('comment_update', self.comment.id, content='No pets')
+        with mock.patch.object(self.queue, 'max_length', 1):
+            response = self.post('comment_update', self.comment.id,
+                                 content='Pets welcome')
+        self.assertRedirects(response, self.show_url)
+        self.assertEqual(self.contents(self.shelter), ['No pets'])
+        self.assertEqual(len(self.queue), 1)
+        self.queue.flush()
+        self.assertEqual(self.contents(self.shelter), ['Pets welcome'])
+
+    @skipUnless(comment_queue.fcntl, 'Locking journals needs fcntl')
+    def test_flush_command_refuses_held_journal(self):
+        self.queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        with mock.patch.object(comment_queue, 'FILE', self.path):
+            with self.assertRaisesRegex(CommandError, 'running server'):
+                call_command('flush_comment_queue', stdout=StringIO())
+
+    def test_memory_lost_on_crash(self):
+        path = os.path.join(self.tmp.name, 'memory.jsonl')
+        queue = self.make(durability='memory', path=path)
+        queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.make(durability='memory', path=path).flush(),
+                         0)
+
+    def test_torn_journal_line(self):
+        self.queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        self.queue.close()
+        with open(self.path, 'a') as file:
+            file.write('{"id": "abc", "kind": "cre')
+        with self.assertLogs('shelterme.comment_queue', 'WARNING'):
+            queue = self.make()
+            queue.recover()
+        self.assertEqual(queue.flush(), 1)
+
+    def test_deleted_shelter(self):
+        shelter = self.new_shelter()
+        self.queue.put(self.create(shelter.id, 'Gone'))
+        self.queue.put(self.create(self.shelter.id, 'Bring blankets'))
+        shelter.delete()
+        with self.assertLogs('shelterme.comment_queue', 'WARNING'):
+            self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.contents(self.shelter),
+                         ['Pets allowed', 'Bring blankets'])
+        self.assertFalse(Comment.objects.filter(content='Gone').exists())
+
+    def test_bad_settings(self):
+        for options in [{'ordering': 'random'}, {'durability': 'disk'}]:
+            with self.assertRaises(ImproperlyConfigured):
+                self.make(**options)
+
+
+class CommentQueueWorkerTests(TransactionTestCase):
+    databases = {'default', 'readonly'}
+
+    def test_background_worker(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830")
+        queue = comment_queue.CommentQueue(durability='memory',
+                                           background=True, delay=0.01)
+        for i in range(5):
+            queue.put(comment_queue.Operation(
+                comment_queue.CREATE, shelter.id, author='Hunter',
+                content='Comment %d' % i))
+        for i in range(500):
+            if not len(queue):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(Comment.objects.filter(shelter=shelter).count(), 5)
+        shelter.refresh_from_db()
+        self.assertEqual(shelter.comment_count, 5)
+
+
+# Analysis -- shelterme.fragments
+# Caches rendered shelter cards / headers per shelter id and version
+#
+# Happy Path:
+# cards rendered twice -> template engine only used the first time
+# cached card -> still shows this search's distance
+#
+# Sad Path:
+# shelter saved -> new version, card re-rendered
+# check-in -> new version, card shows the new capacity
+class FragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830", max_capacity=5)
+        self.shelter.distance = 1.25
+
+    def render(self):
+        with mock.patch('shelterme.fragments.render_to_string',
+                        wraps=fragments.render_to_string) as render:
+            html = fragments.render_cards([self.shelter])
+        return html, render.call_count
+
+    # Happy path
+    def test_second_render_is_cached(self):
+        first, renders = self.render()
+        self.assertEqual(renders, 1)
+        second, renders = self.render()
+        self.assertEqual(renders, 0)
+        self.assertEqual(first, second)
+
+    def test_cached_card_uses_current_distance(self):
+        self.render()
+        self.shelter.distance = 7.0
+        html, renders = self.render()
+        self.assertIn('7.0 mi away', html)
+        self.assertNotIn(fragments.DISTANCE_TOKEN, html)
+
+    # Sad path
+    def test_save_invalidates(self):
+        self.render()
+        self.shelter.name = "Renamed Shelter"
+        self.shelter.save()
+        html, renders = self.render()
+        self.assertEqual(renders, 1)
+        self.assertIn("Renamed Shelter", html)
+
+    def test_checkin_invalidates(self):
+        self.render()
+        Shelter.objects.adjust_occupancy(self.shelter.id, 2)
+        self.shelter.refresh_from_db()
+        self.shelter.distance = 1.25
+        html, renders = self.render()
+        self.assertEqual(renders, 1)
+        self.assertIn('2 / 5', html)
+
+
+# Analysis -- conditional GETs of shelterme.views.index_or_create and show
+# Parameters
+# If-None-Match       ETag of the client's copy        optional
+# If-Modified-Since   Last-Modified of the client's copy  optional
+#
+# Happy Path:
+# unchanged page revalidated -> 304, no template rendered
+# If-Modified-Since at Last-Modified -> 304
+#
+# Sad Path:
+# shelter saved / checked in -> 200 with a new ETag
+# comment added / edited / deleted -> 200 with a new ETag
+# shelter deleted from the search area -> 200 with a new ETag
+# messages waiting to be shown -> 200
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.location = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St",
+            location=self.location, zip="36830", max_capacity=5)
+        self.other = Shelter.objects.create(
+            name="Other Shelter", street_addr="2 Test St",
+            location=self.location, zip="36832", max_capacity=5)
+        self.comment = Comment.objects.create(
+            author="Tester", content="Hello", shelter=self.shelter)
+        self.show_url = reverse('shelterme:show', args=(self.shelter.id,))
+        self.index_url = reverse('shelterme:index')
+        self.search = {'zip': '36830', 'radius': 10}
+
+    def revalidate(self, url, data=None):
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        return self.client.get(url, data,
+                               HTTP_IF_NONE_MATCH=response['ETag'])
+
+    # Happy path
+    def test_show_not_modified(self):
+        response = self.revalidate(self.show_url)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_show_not_modified_skips_rendering(self):
+        etag = self.client.get(self.show_url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.show_url,
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.templates)
+
+    def test_index_not_modified(self):
+        response = self.revalidate(self.index_url, self.search)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.templates)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.show_url)['Last-Modified']
+        response = self.client.get(self.show_url,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    # Sad path
+    def test_shelter_saved(self):
+        etag = self.client.get(self.show_url)['ETag']
+        self.shelter.name = "Renamed Shelter"
+        self.shelter.save()
+        response = self.client.get(self.show_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_checkin(self):
+        show_etag = self.client.get(self.show_url)['ETag']
+        index_etag = self.client.get(self.index_url, self.search)['ETag']
+        Shelter.objects.adjust_occupancy(self.shelter.id, 1)
+        response = self.client.get(self.show_url,
+                                   HTTP_IF_NONE_MATCH=show_etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.index_url, self.search,
+                                   HTTP_IF_NONE_MATCH=index_etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_comments_changed(self):
+        def edit():
+            self.comment.content = "Edited"
+            self.comment.save()
+
+        changes = [
+            lambda: Comment.objects.create(
+                author="Tester", content="Again", shelter=self.shelter),
+            edit,
+            lambda: self.comment.delete(),
+        ]
+        for change in changes:
+            etag = self.client.get(self.show_url)['ETag']
+            change()
+            response = self.client.get(self.show_url,
+                                       HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_shelter_deleted(self):
+        etag = self.client.get(self.index_url, self.search)['ETag']
+        self.other.delete()
+        response = self.client.get(self.index_url, self.search,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "Other Shelter")
+
+    def test_pending_messages(self):
+        etag = self.client.get(self.show_url)['ETag']
+        # A bad search leaves an error message for the next page
+        self.client.get(self.index_url, {'zip': 'abcde'})
+        response = self.client.get(self.show_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+# Analysis -- shelterme.instrumentation and shelterme.views.api_timings
+#
+# Happy Path:
+# any request -> Server-Timing header with sql / zip / render / total
+# query count in the header matches the queries actually run
+# ZIP lookups inside timed('zip') -> counted for the request
+# searches (both sorts, and the API) -> non-zero zip part
+# requests -> recorded per view in the rolling histogram
+# staff user -> timings API returns the histogram as JSON
+#
+# Sad Path:
+# timed() outside of a request -> no-op
+# more requests than the window -> oldest dropped
+# anonymous or non-staff user -> timings API redirects to the admin login
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        instrumentation.histogram.reset()
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830")
+        self.show_url = reverse('shelterme:show', args=(self.shelter.id,))
+        self.api_url = reverse('shelterme:api_timings')
+
+    def server_timing(self, response):
+        parts = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            parts[name] = dict(param.split('=', 1) for param in params)
+        return parts
+
+    # Happy path
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.show_url)
+        parts = self.server_timing(response)
+        self.assertEqual(set(parts), {'sql', 'zip', 'render', 'total'})
+        self.assertEqual(parts['sql']['desc'],
+                         '"%d queries"' % len(queries))
+        self.assertGreater(float(parts['render']['dur']), 0)
+        self.assertGreaterEqual(float(parts['total']['dur']),
+                                float(parts['render']['dur']))
+
+    def test_zip_lookups_timed(self):
+        timings = instrumentation.Timings()
+        token = instrumentation._current.set(timings)
+        try:
+            valid_city_state_zip.cache_clear()
+            valid_city_state_zip('Auburn', 'AL', '36830')
+            get_locations_within_radius('36830', 10)
+        finally:
+            instrumentation._current.reset(token)
+        self.assertGreater(timings.seconds['zip'], 0)
+
+    def test_searches_time_zip(self):
+        searches = [(reverse('shelterme:index'), {}),
+                    (reverse('shelterme:index'), {'sort': 'available'}),
+                    (reverse('shelterme:api_search'), {}),
+                    (reverse('shelterme:api_search'), {'sort': 'available'})]
+        for url, params in searches:
+            # Every perf_counter() call is a second later than the last
+            with mock.patch.object(instrumentation, 'perf_counter',
+                                   side_effect=itertools.count()):
+                response = self.client.get(url, dict(
+                    params, zip='36830', radius=10))
+            self.assertEqual(response.status_code, 200)
+            parts = self.server_timing(response)
+            self.assertGreater(float(parts['zip']['dur']), 0)
+
+    def test_histogram_per_view(self):
+        for i in range(3):
+            self.client.get(self.show_url)
+        views = instrumentation.histogram.snapshot()
+        show = views['shelterme:show']
+        self.assertEqual(show['requests'], 3)
+        self.assertEqual(sum(show['total_ms']['buckets'].values()), 3)
+        self.assertGreater(show['queries']['p50'], 0)
+
+    def test_api_for_staff(self):
+        self.client.get(self.show_url)
+        user = User.objects.create_user('admin', password='secret',
+                                        is_staff=True)
+        self.client.force_login(user)
+        response = self.client.get(self.api_url)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertIn('shelterme:show', body['views'])
+        self.assertEqual(body['window'], instrumentation.TIMING_WINDOW)
+
+    # Sad path
+    def test_timed_outside_request(self):
+        with instrumentation.timed('zip'):
+            pass
+
+    def test_window_drops_oldest(self):
+        histogram = instrumentation.Histogram(window=2)
+        for total in [1.0, 0.001, 0.002]:
+            histogram.record('view', total, instrumentation.Timings())
+        stats = histogram.snapshot()['view']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['total_ms']['max'], 2.0)
+
+    def test_api_needs_staff(self):
+        response = self.client.get(self.api_url)
+        self.assertEqual(response.status_code, 302)
+        user = User.objects.create_user('user', password='secret')
+        self.client.force_login(user)
+        response = self.client.get(self.api_url)
+        self.assertEqual(response.status_code, 302)
+
+
+# Analysis -- shelterme.db.sqlite3 and shelterme.routers
+#
+# Happy Path:
+# new writer connection -> WAL and the configured pragmas set
+# write transaction open -> reads on the read-only connection don't wait
+# two write transactions -> the second waits for the first to commit
+# reads outside a transaction -> read-only alias, writes -> default
+# reads inside a transaction -> default (sees its own writes)
+# served over ASGI -> connections closed after every request
+# served over WSGI or ASGI -> WAL, management commands -> journal untouched
+#
+# Sad Path:
+# write through the read-only connection -> OperationalError
+# writer lock held past the timeout -> OperationalError
+class SQLiteBackendTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.sqlite3')
+        self.opened = []
+        writer = self.open(single_writer=True)
+        with writer.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (n integer)')
+
+    def tearDown(self):
+        for wrapper in self.opened:
+            # Ones opened by other threads are closed there
+            if wrapper.connection is not None:
+                wrapper.close()
+        self.tmp.cleanup()
+
+    def open(self, **options):
+        from shelterme.db.sqlite3.base import DatabaseWrapper
+        options.setdefault('pragmas', {'journal_mode': 'WAL',
+                                       'synchronous': 'NORMAL'})
+        settings_dict = connections.configure_settings({'default': {
+            'ENGINE': 'shelterme.db.sqlite3', 'NAME': self.path,
+            'OPTIONS': options}})['default']
+        wrapper = DatabaseWrapper(settings_dict, 'sqlite_test')
+        self.opened.append(wrapper)
+        return wrapper
+
+    def query(self, wrapper, sql):
+        with wrapper.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+    # Happy path
+    def test_pragmas(self):
+        writer = self.open(single_writer=True)
+        self.assertEqual(self.query(writer, 'PRAGMA journal_mode'),
+                         [('wal',)])
+        self.assertEqual(self.query(writer, 'PRAGMA synchronous'), [(1,)])
+
+    def test_reads_dont_wait_for_writes(self):
+        writer = self.open(single_writer=True)
+        reader = self.open(read_only=True, timeout=0.1)
+        writer.set_autocommit(
+            False, force_begin_transaction_with_broken_autocommit=True)
+        self.query(writer, 'INSERT INTO t VALUES (1)')
+        # Uncommitted, so not seen yet -- but no waiting for the lock
+        self.assertEqual(self.query(reader, 'SELECT COUNT(*) FROM t'),
+                         [(0,)])
+        writer.commit()
+        writer.set_autocommit(True)
+        self.assertEqual(self.query(reader, 'SELECT COUNT(*) FROM t'),
+                         [(1,)])
+
+    def test_writers_take_turns(self):
+        first = self.open(single_writer=True)
+        first.set_autocommit(
+            False, force_begin_transaction_with_broken_autocommit=True)
+        started = Event()
+        order = []
+
+        def second_writer():
+            second = self.open(single_writer=True)
+            started.set()
+            second.set_autocommit(
+                False, force_begin_transaction_with_broken_autocommit=True)
+            order.append('second')
+            self.query(second, 'INSERT INTO t VALUES (2)')
+            second.commit()
+            second.set_autocommit(True)
+            second.close()
+
+        thread = Thread(target=second_writer)
+        thread.start()
+        started.wait()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.query(first, 'INSERT INTO t VALUES (1)')
+        order.append('first')
+        first.commit()
+        first.set_autocommit(True)
+        thread.join()
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(self.query(first, 'SELECT n FROM t ORDER BY rowid'),
+                         [(1,), (2,)])
+
+    def test_router(self):
+        from shelterme.routers import ReadWriteRouter
+        router = ReadWriteRouter()
+        # Tests run inside a transaction
+        self.assertEqual(router.db_for_read(Shelter), 'default')
+        with mock.patch.object(connections['default'], 'in_atomic_block',
+                               False):
+            self.assertEqual(router.db_for_read(Shelter), 'readonly')
+        self.assertEqual(router.db_for_write(Shelter), 'default')
+        self.assertFalse(router.allow_migrate('readonly', 'shelterme'))
+
+    def test_only_servers_use_wal(self):
+        env = dict(os.environ)
+        env.pop('SHELTERME_SQLITE_WAL', None)
+        for module in ['wsgi', 'asgi']:
+            result = subprocess.run([
+                sys.executable, '-c',
+                'import shelter_me_project.%s; '
+                'from django.conf import settings; '
+                'print(settings.SQLITE_PRAGMAS.get("journal_mode"))' % module],
+                check=True, cwd=settings.BASE_DIR, capture_output=True,
+                text=True, env=env)
+            self.assertEqual(result.stdout.strip(), 'WAL')
+        self.assertNotIn('journal_mode', settings.SQLITE_PRAGMAS)
+
+    # Sad path
+    def test_asgi_closes_connections(self):
+        result = subprocess.run([
+            sys.executable, '-c',
+            'import shelter_me_project.asgi; '
+            'from django.conf import settings; '
+            'print(set(database["CONN_MAX_AGE"] '
+            'for database in settings.DATABASES.values()))'],
+            check=True, cwd=settings.BASE_DIR, capture_output=True,
+            text=True, env=dict(os.environ, SHELTERME_ASGI=''))
+        self.assertEqual(result.stdout.strip(), '{0}')
+        self.assertIsNone(settings.DATABASES['default']['CONN_MAX_AGE'])
+
+    def test_read_only_refuses_writes(self):
+        reader = self.open(read_only=True)
+        with self.assertRaises(OperationalError):
+            self.query(reader, 'INSERT INTO t VALUES (1)')
+
+    def test_writer_lock_timeout(self):
+        first = self.open(single_writer=True)
+        first.set_autocommit(
+            False, force_begin_transaction_with_broken_autocommit=True)
+        errors = []
+
+        def second_writer():
+            second = self.open(single_writer=True, timeout=0.1)
+            try:
+                second.set_autocommit(
+                    False,
+                    force_begin_transaction_with_broken_autocommit=True)
+            except OperationalError as error:
+                errors.append(error)
+            second.close()
+
+        thread = Thread(target=second_writer)
+        thread.start()
+        thread.join()
+        first.rollback()
+        first.set_autocommit(True)
+        self.assertEqual(len(errors), 1)
+
+
+# Analysis -- shelterme.routers read replicas and sticky primary
+# Runs outside a test transaction so reads really leave the primary
+#
+# Happy Path:
+# GET show / index / comment edit -> reads from the replica
+# request that wrote -> sticky cookie, next GETs read the primary
+# sticky cookie expired -> replica again
+# sync_replica -> primary's rows copied into the replica file
+#
+# Sad Path:
+# POST to a replica view (create) -> reads and writes on the primary
+# views without replica_reads -> never read the replica
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'readonly', 'replica'}
+
+    def setUp(self):
+        loc = Location.objects.create(city="Auburn", state="AL")
+        self.shelter = Shelter.objects.create(
+            name="Test Shelter", street_addr="1 Test St", location=loc,
+            zip="36830")
+        self.show_url = reverse('shelterme:show', args=(self.shelter.id,))
+
+    def queries_by_alias(self, method, url, data=None):
+        with CaptureQueriesContext(connections['replica']) as replica, \
+                CaptureQueriesContext(connections['readonly']) as primary:
+            response = getattr(self.client, method)(url, data)
+        return response, len(replica), len(primary)
+
+    # Happy path
+    def test_reads_from_replica(self):
+        comment = Comment.objects.create(author="Tester", content="Hi",
+                                         shelter=self.shelter)
+        for url, data in [
+                (self.show_url, None),
+                (reverse('shelterme:index'), {'zip': '36830', 'radius': 5}),
+                (reverse('shelterme:comment_edit',
+                         args=(self.shelter.id, comment.id)), None)]:
+            response, replica, primary = self.queries_by_alias(
+                'get', url, data)
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(replica, 0)
+            self.assertEqual(primary, 0)
+
+    def test_sticks_to_primary_after_write(self):
+        response = self.client.post(
+            reverse('shelterme:comment_create', args=(self.shelter.id,)),
+            {'content': 'New comment'})
+        cookie = response.cookies[routers.STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], routers.REPLICA_LAG)
+
+        response, replica, primary = self.queries_by_alias(
+            'get', self.show_url)
+        self.assertContains(response, 'New comment')
+        self.assertEqual(replica, 0)
+        self.assertGreater(primary, 0)
+
+        # Once the cookie expires the replica is used again
+        del self.client.cookies[routers.STICKY_COOKIE]
+        response, replica, primary = self.queries_by_alias(
+            'get', self.show_url)
+        self.assertGreater(replica, 0)
+
+    def test_sync_replica(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            primary = os.path.join(tmp, 'primary.sqlite3')
+            replica = os.path.join(tmp, 'replica.sqlite3')
+            db = sqlite3.connect(primary)
+            db.execute('CREATE TABLE t (n integer)')
+            db.execute('INSERT INTO t VALUES (1)')
+            db.commit()
+            db.close()
+
+            databases = {'default': {'NAME': primary},
+                         'fake_replica': {'NAME': replica}}
+            with mock.patch.object(settings, 'DATABASES', databases), \
+                    mock.patch('shelterme.management.commands.sync_replica'
+                               '.REPLICA_DATABASES', ['fake_replica']):
+                call_command('sync_replica', stdout=StringIO())
+
+            db = sqlite3.connect(replica)
+            self.assertEqual(db.execute('SELECT n FROM t').fetchall(),
+                             [(1,)])
+            db.close()
+
+    # Sad path
+    def test_post_uses_primary(self):
+        response, replica, primary = self.queries_by_alias(
+            'post', reverse('shelterme:checkin', args=(self.shelter.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+    def test_other_views_skip_replica(self):
+        response, replica, primary = self.queries_by_alias(
+            'get', reverse('shelterme:api_search'),
+            {'zip': '36830', 'radius': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+        self.assertGreater(primary, 0)
+
+
+# Analysis -- shelterme.assets
+# Builds (collectstatic) and serves the static files
+# Parameters
+# path              string      file under STATIC_ROOT          mandatory
+# Accept-Encoding   header      br / gzip, with q values        optional
+#
+# Happy Path:
+# build -> CSS and JS minified, hashed copies and a manifest, .gz (and
+# .br with brotli) copies that decompress to the same bytes
+# {% static %} -> hashed names once built, plain names until then
+# hashed file -> immutable, far-future Cache-Control
+# plain name -> no-cache
+# manifest loaded -> hashed names told apart from a set, not the manifest
+# br / gzip accepted -> matching precompressed copy, Vary: Accept-Encoding
+# not built, DEBUG -> source file
+#
+# Sad Path:
+# encoding refused (q=0) or unknown -> uncompressed file
+# missing file or path outside STATIC_ROOT -> 404
+# not built, DEBUG off -> 404
+# POST -> 405
+class AssetPipelineTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = tempfile.TemporaryDirectory()
+        cls.built = override_settings(STATIC_ROOT=cls.root.name)
+        cls.built.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+        cls.css = assets.staticfiles_storage.stored_name(
+            'shelterme/styles.css')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.built.disable()
+        cls.root.cleanup()
+        super().tearDownClass()
+
+    def get(self, path, encoding=None):
+        headers = {'HTTP_ACCEPT_ENCODING': encoding} if encoding else {}
+        return self.client.get(settings.STATIC_URL + path, **headers)
+
+    def read(self, name):
+        with open(os.path.join(self.root.name, name), 'rb') as file:
+            return file.read()
+
+    # Happy path
+    def test_build(self):
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root.name, 'staticfiles.json')))
+        self.assertRegex(self.css, r'^shelterme/styles\.[0-9a-f]{12}\.css$')
+        source = finders.find('shelterme/styles.css')
+        content = self.read(self.css)
+        if assets.rcssmin is not None:
+            self.assertLess(len(content), os.path.getsize(source))
+            self.assertNotIn(b'\n', content.strip())
+        self.assertEqual(gzip.decompress(self.read(self.css + '.gz')),
+                         content)
+        if assets.brotli is not None:
+            self.assertEqual(
+                assets.brotli.decompress(self.read(self.css + '.br')),
+                content)
+
+    def test_static_tag_uses_hashed_names(self):
+        rendered = Template('{% load static %}'
+                            '{% static "shelterme/styles.css" %}').render(
+            Context())
+        self.assertEqual(rendered, settings.STATIC_URL + self.css)
+
+    def test_hashed_file_is_immutable(self):
+        response = self.get(self.css)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], assets.IMMUTABLE)
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.read(self.css))
+
+        response = self.get('shelterme/styles.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_hashed_names_loaded_once(self):
+        storage = assets.AssetStorage(location=self.root.name)
+        self.assertEqual(storage.hashed_names,
+                         set(storage.hashed_files.values()))
+        storage.hashed_files = {}
+        self.assertTrue(storage.is_hashed(self.css))
+        self.assertFalse(storage.is_hashed('shelterme/styles.css'))
+
+    def test_precompressed(self):
+        response = self.get(self.css, 'gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.read(self.css + '.gz'))
+        if assets.brotli is not None:
+            response = self.get(self.css, 'gzip, deflate, br')
+            self.assertEqual(response['Content-Encoding'], 'br')
+            response = self.get(self.css, 'gzip, br;q=0')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    @override_settings(DEBUG=True)
+    def test_debug_serves_sources_until_built(self):
+        with tempfile.TemporaryDirectory() as empty, \
+                override_settings(STATIC_ROOT=empty):
+            rendered = Template('{% load static %}'
+                                '{% static "shelterme/styles.css" %}'
+                                ).render(Context())
+            self.assertEqual(rendered,
+                             settings.STATIC_URL + 'shelterme/styles.css')
+            response = self.get('shelterme/styles.css')
+            self.assertEqual(response.status_code, 200)
+
+    # Sad path
+    def test_refused_or_unknown_encoding(self):
+        for encoding in ['gzip;q=0', 'compress', 'identity']:
+            response = self.get(self.css, encoding)
+            self.assertNotIn('Content-Encoding', response)
+
+    def test_not_found(self):
+        for path in ['shelterme/missing.css', '../settings.py',
+                     'shelterme/../../manage.py']:
+            self.assertEqual(self.get(path).status_code, 404)
+
+    def test_not_built(self):
+        with tempfile.TemporaryDirectory() as empty, \
+                override_settings(STATIC_ROOT=empty):
+            self.assertEqual(self.get('shelterme/styles.css').status_code,
+                             404)
+
+    def test_post(self):
+        response = self.client.post(settings.STATIC_URL + self.css)
+        self.assertEqual(response.status_code, 405)
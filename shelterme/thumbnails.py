@@ -0,0 +1,249 @@
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from io import BytesIO
+from urllib.parse import urlsplit
+from urllib.request import HTTPDefaultErrorHandler, HTTPErrorProcessor, \
+    HTTPHandler, HTTPRedirectHandler, HTTPSHandler, OpenerDirector, Request
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from shelterme.models import Shelter, new_version
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Thumbnails of shelter photos.
+#
+# Saving a shelter whose photo hasn't been processed yet queues it (once
+# the write commits) on a small background pool. The pool fetches the
+# photo once, makes every size in SIZES as WebP and JPEG, and stores them
+# in THUMBNAIL_ROOT as <content hash>-<size>.<ext>. Then it records the
+# hash on the shelter, which gives the shelter a new version so cached
+# cards and pages pick the thumbnails up. Until then (or if the photo
+# can't be fetched or read) the pages show the logo.
+#
+# Files are named by content, so they never change and are served with
+# far-future cache headers. Photos that fail are retried by
+# make_thumbnails. Needs Pillow; without it nothing is processed.
+#
+# Photo URLs come from users, so photos are only fetched over http(s) from
+# public addresses: every connection, redirects included, checks the
+# addresses the host resolves to and refuses loopback, private, link-local
+# (cloud metadata) and other non-public ones. Proxies are never used.
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_ROOT = getattr(settings, 'SHELTERME_THUMBNAIL_ROOT', os.path.join(
+    settings.BASE_DIR, 'thumbnails'))
+
+# Process photos on the background pool (False: right after the commit, in
+# the request)
+BACKGROUND = getattr(settings, 'SHELTERME_THUMBNAIL_BACKGROUND', True)
+WORKERS = getattr(settings, 'SHELTERME_THUMBNAIL_WORKERS', 2)
+
+# Seconds to wait on a photo's host and the largest photo fetched (bytes)
+FETCH_TIMEOUT = getattr(settings, 'SHELTERME_THUMBNAIL_TIMEOUT', 10)
+MAX_PHOTO_BYTES = getattr(settings, 'SHELTERME_THUMBNAIL_MAX_BYTES',
+                          10 * 1024 * 1024)
+
+# Fetch photos from non-public addresses too. Only for local testing.
+ALLOW_PRIVATE = getattr(settings, 'SHELTERME_THUMBNAIL_ALLOW_PRIVATE', False)
+
+SCHEMES = ('http', 'https')
+
+# (width, height) of every size; photos are scaled and cropped to fill it
+SIZES = {'card': (360, 240), 'header': (1140, 570)}
+
+# Pillow format, quality and content type of every extension
+FORMATS = {'webp': ('WEBP', 80, 'image/webp'),
+           'jpg': ('JPEG', 82, 'image/jpeg')}
+
+HASH_LENGTH = 20
+
+NAME = re.compile(r'^[0-9a-f]{%d}-(%s)\.(%s)$' % (
+    HASH_LENGTH, '|'.join(SIZES), '|'.join(FORMATS)))
+
+_pool = None
+
+
+def available():
+    return Image is not None
+
+
+# Returns whether the shelter's photo still needs thumbnails
+def pending(shelter):
+    return (available() and shelter.thumbnail_source != shelter.photo and
+            shelter.photo.startswith(('http://', 'https://')))
+
+
+# Processes the shelter's photo once the current transaction commits
+def schedule(shelter_id):
+    transaction.on_commit(lambda: _submit(shelter_id))
+
+
+def _submit(shelter_id):
+    global _pool
+    if not BACKGROUND:
+        return process(shelter_id)
+    if _pool is None:
+        _pool = ThreadPoolExecutor(WORKERS, 'thumbnails')
+    _pool.submit(_process_in_background, shelter_id)
+
+
+def _process_in_background(shelter_id):
+    close_old_connections()
+    try:
+        process(shelter_id)
+    except Exception:
+        logger.exception('Thumbnails of shelter %s failed', shelter_id)
+    finally:
+        close_old_connections()
+
+
+# Makes the thumbnails of the shelter's current photo. Returns True if
+# they were made, False if the photo couldn't be fetched or read (the
+# logo stays up) or there was nothing to do.
+def process(shelter_id):
+    shelter = Shelter.objects.filter(pk=shelter_id).only(
+        'photo', 'thumbnail_source').first()
+    if shelter is None or not pending(shelter):
+        return False
+    photo = shelter.photo
+
+    try:
+        data = fetch(photo)
+        digest = sha256(data).hexdigest()[:HASH_LENGTH]
+        # Shelters sharing a photo share its thumbnails
+        if not made(digest):
+            for name, content in render(data, digest).items():
+                store(name, content)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        logger.warning('No thumbnails for shelter %s (%s): %s',
+                       shelter_id, photo, error)
+        return False
+
+    # Unless the photo changed in the meantime
+    Shelter.objects.filter(pk=shelter_id, photo=photo).update(
+        thumbnail=digest, thumbnail_source=photo, version=new_version(),
+        updated_at=timezone.now())
+    return True
+
+
+# Returns the photo's bytes. Raises OSError if it can't be fetched (or
+# isn't on a public address) and ValueError if it's too big.
+def fetch(url):
+    if urlsplit(url).scheme not in SCHEMES:
+        raise ValueError('photo URL is not http(s)')
+    request = Request(url, headers={'User-Agent': 'ShelterMe thumbnails'})
+    with _opener.open(request, timeout=FETCH_TIMEOUT) as response:
+        data = response.read(MAX_PHOTO_BYTES + 1)
+    if len(data) > MAX_PHOTO_BYTES:
+        raise ValueError('photo is over %d bytes' % MAX_PHOTO_BYTES)
+    return data
+
+
+# Whether photos may be fetched from the IP address
+def allowed(address):
+    if ALLOW_PRIVATE:
+        return True
+    address = ipaddress.ip_address(address)
+    return address.is_global and not address.is_multicast
+
+
+# socket.create_connection that refuses hosts resolving to addresses that
+# aren't allowed, and connects to the address it checked (so the host
+# can't resolve to another one in between)
+def _create_connection(address, timeout, source_address=None):
+    host, port = address
+    resolved = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for family, kind, proto, name, sockaddr in resolved:
+        if not allowed(sockaddr[0].split('%')[0]):
+            raise OSError('%s is not a public address' % sockaddr[0])
+    return socket.create_connection(resolved[0][4][:2], timeout,
+                                    source_address)
+
+
+# Wraps an http.client connection class so it connects through
+# _create_connection
+def _checked(connection_class):
+    def connection(*args, **kwargs):
+        conn = connection_class(*args, **kwargs)
+        conn._create_connection = _create_connection
+        return conn
+    return connection
+
+
+class _HTTPHandler(HTTPHandler):
+    def do_open(self, http_class, request, **kwargs):
+        return super().do_open(_checked(http_class), request, **kwargs)
+
+
+class _HTTPSHandler(HTTPSHandler):
+    def do_open(self, http_class, request, **kwargs):
+        return super().do_open(_checked(http_class), request, **kwargs)
+
+
+class _RedirectHandler(HTTPRedirectHandler):
+    def redirect_request(self, request, fp, code, msg, headers, url):
+        if urlsplit(url).scheme not in SCHEMES:
+            raise OSError('photo redirected to a URL that is not http(s)')
+        return super().redirect_request(request, fp, code, msg, headers,
+                                        url)
+
+
+# Only http(s), no proxies
+_opener = OpenerDirector()
+for _handler in [_HTTPHandler(), _HTTPSHandler(), _RedirectHandler(),
+                 HTTPDefaultErrorHandler(), HTTPErrorProcessor()]:
+    _opener.add_handler(_handler)
+
+
+# Returns {file name: bytes} of every thumbnail of the photo. Raises
+# OSError if Pillow can't read it.
+def render(data, digest):
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    files = {}
+    for size, dimensions in SIZES.items():
+        thumbnail = ImageOps.fit(image, dimensions, Image.LANCZOS)
+        for ext, (kind, quality, content_type) in FORMATS.items():
+            output = BytesIO()
+            thumbnail.save(output, kind, quality=quality, optimize=True)
+            files['%s-%s.%s' % (digest, size, ext)] = output.getvalue()
+    return files
+
+
+def made(digest):
+    return all(os.path.exists(os.path.join(
+        THUMBNAIL_ROOT, '%s-%s.%s' % (digest, size, ext)))
+        for size in SIZES for ext in FORMATS)
+
+
+# Writes a thumbnail atomically, so it's never served half written
+def store(name, content):
+    os.makedirs(THUMBNAIL_ROOT, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=THUMBNAIL_ROOT, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.replace(tmp, os.path.join(THUMBNAIL_ROOT, name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# Returns the path and content type of a thumbnail file name, or None if
+# it isn't one
+def path(name):
+    match = NAME.match(name)
+    if match is None:
+        return None
+    return os.path.join(THUMBNAIL_ROOT, name), FORMATS[match.group(2)][2]
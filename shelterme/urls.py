@@ -10,6 +10,12 @@ urlpatterns = [
     # Index page URL
     path('shelters', views.index_or_create, name='index'),
 
+    # Search API URL
+    path('api/shelters', views.api_search, name='api_search'),
+
+    # Full-text search API URL
+    path('api/search', views.api_text_search, name='api_text_search'),
+
     # New page URL
     path('shelters/new', views.new, name='new'),
 
@@ -28,6 +34,28 @@ urlpatterns = [
     # Delete page URL
     path('shelters/<id>/delete', views.delete, name='delete'),
 
+    # Check-in URL
+    path('shelters/<id>/checkin', views.checkin, name='checkin'),
+
+    # Check-out URL
+    path('shelters/<id>/checkout', views.checkout, name='checkout'),
+
+    # Batch occupancy API URL
+    path('api/occupancy', views.api_occupancy, name='api_occupancy'),
+
+    # Timings API URL
+    path('api/timings', views.api_timings, name='api_timings'),
+
+    # Thumbnail URL
+    path('thumbnails/<name>', views.thumbnail, name='thumbnail'),
+
+    # Capacity API URL
+    path('api/capacity', views.api_capacity, name='api_capacity'),
+
+    # Capacity stream URL
+    path('api/capacity/stream', views.capacity_stream,
+         name='capacity_stream'),
+
     # New comment page URL
     path('shelters/<id>/comments/new', views.comment_new, name='comment_new'),
 
@@ -1,13 +1,61 @@
+import binascii
+import json
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
+from hashlib import md5
 from shelterme.models import Location, Shelter, Comment
-from ast import literal_eval
-from pyzipcode import ZipCodeDatabase
-from zipcodes import matching, is_real
+from shelterme import comment_queue, fragments, fulltext, search_cache, \
+    thumbnails
+from shelterme.capacity_feed import feed
+from shelterme.geo import get_zip_index, lookup_zip
+from shelterme.instrumentation import TIMING_WINDOW, histogram, timed
+from shelterme.routers import replica_reads, stick_to_primary
+from zipcodes import is_real
+from asgiref.sync import sync_to_async
 from django.shortcuts import get_object_or_404, redirect, render
-from django.http import Http404
+from django.http import FileResponse, Http404, HttpResponse, \
+    JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET, require_POST
+from django.db import transaction
+from django.db.models import Count, Max
+from django.urls import reverse
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 
 # TODO: write new view tests
 
+# Page sizes of the search API
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Shelters on the index page when sorted by free beds
+AVAILABLE_LIMIT = 100
+
+# Search orders: nearest first or most free beds first
+SORTS = ['distance', 'available']
+
+# Comments per page on the show page
+COMMENT_PAGE_SIZE = 20
+
+# Most changes accepted by one batch occupancy request
+MAX_OCCUPANCY_CHANGES = 500
+
+# Capacity streams: most shelters per stream, seconds between keepalives
+# and how long browsers wait before reconnecting (ms)
+MAX_STREAM_SHELTERS = 200
+SSE_KEEPALIVE = 15
+SSE_RETRY_MS = 3000
+
+# Seconds a capacity stream stays open. The browser reconnects by itself
+# and gets a fresh snapshot, so ending streams loses nothing and frees the
+# feed subscription Django would otherwise keep after the client went away.
+SSE_LIFETIME = getattr(settings, 'SHELTERME_SSE_LIFETIME', 60)
+
 
 # Create your views here.
 def splash(request):
@@ -15,125 +63,263 @@ def splash(request):
 
 
 # Shelter -- index (GET) & create (POST)
-def index_or_create(request):
+@replica_reads
+async def index_or_create(request):
     # Shelter - index view
     # Shows an index of all shelters
     if request.method == 'GET':
 
-        # Get data from the get request
-        try:
-            zip_code = request.GET['zip'][:5]
-        except KeyError:
-            zip_code = '36830'  # temporary, eventually we will use the user's last queried zip
+        # Get and scrub data from the get request
         try:
-            radius = request.GET['radius']
-        except KeyError:
-            radius = 10
-
-        # Scrub data
-        # Scrub zip
-        # If the zip code is empty, return the splash page with an error
-        # message
-        if not zip_code:
-            messages.error(request, 'Invalid ZIP. Please try again.')
+            zip_code, radius = clean_search_params(request.GET)
+            min_beds, sort = clean_availability_params(request.GET)
+        except ValueError as error:
+            messages.error(request, str(error))
             return redirect('shelterme:splash')
 
-        # If the zip code is not in a valid form or real, return the splash
-        # page with an error message
-        try:
-            if not is_real(zip_code):
-                messages.error(request, 'Invalid ZIP. Please try again.')
-                return redirect('shelterme:splash')
-        except ValueError:
-            messages.error(request, 'Invalid ZIP. Please try again.')
-            return redirect('shelterme:splash')
-
-        # Scrub radius
-        if not radius:
-            radius = 10
+        # Answer with a 304 if the client's copy is still current. Every
+        # shelter the search can return is inside the search's bounding
+        # box, so their count and newest change validate the page.
+        validators = None
+        with timed('zip'):
+            center = get_zip_index().centroid(zip_code)
+        if center is not None:
+            stamp = await Shelter.objects.in_bounding_box(
+                center[0], center[1], radius).aaggregate(
+                count=Count('id'), updated_at=Max('updated_at'))
+            if stamp['count']:
+                validators = await sync_to_async(page_validators)(
+                    request, stamp['count'], stamp['updated_at'])
+                response = await sync_to_async(not_modified)(
+                    request, *validators)
+                if response is not None:
+                    return response
+
+        # Retrieve shelters within radius of zip with enough free beds,
+        # nearest or most available first
+        if sort == 'available':
+            shelters = await sync_to_async(load_most_available)(
+                zip_code, radius, AVAILABLE_LIMIT, min_beds)
         else:
-            try:
-                radius = int(radius)
-            except ValueError:
-                messages.error(request, 'Invalid radius. Please try again.')
-                return redirect('shelterme:splash')
-            if radius < 1 or radius > 50:
-                messages.error(
-                    request, 'Radius can\'t be less than 1 or greater than 50. \
-                              Please try again.')
-                return redirect('shelterme:splash')
-
-        # Retrieve list of locations within radius of zip
-        locs = get_locations_within_radius(zip_code, radius)
-
-        # Retrieve locations from the db
-        locations = []
-        for loc in locs:
-            tmp_loc = Location.objects.filter(
-                city=loc['city'], state=loc['state'])
-            if tmp_loc:
-                locations.append(tmp_loc[0])
-        if not locations:
+            shelters = await search_cache.anear_zip(zip_code, radius)
+            if min_beds:
+                shelters = [shelter for shelter in shelters
+                            if shelter.free_beds >= min_beds]
+        if not shelters and min_beds:
+            messages.error(request, 'No shelters with %d or more free beds \
+                                     within %d miles.' % (min_beds, radius))
+            return redirect('shelterme:splash')
+        if not shelters:
             messages.error(
                 request, 'We don\'t have your location in our database. \
                           Sorry!')
             return redirect('shelterme:splash')
 
-        # Render template with all of the location's shelter data
-        return render(request, 'shelterme/index.html',
-                      {'locations': locations})
+        # Locations the shelters are in, in order of their nearest shelter
+        locations = []
+        for shelter in shelters:
+            if shelter.location not in locations:
+                locations.append(shelter.location)
+
+        # Map markers, inlined into the page as JSON
+        markers = []
+        for shelter in shelters:
+            markers.append({
+                'name': shelter.name,
+                'address': '%s, %s, %s %s' % (
+                    shelter.street_addr, shelter.location.city,
+                    shelter.location.state, shelter.zip),
+                'lat': shelter.latitude,
+                'lng': shelter.longitude,
+                'url': reverse('shelterme:show', args=(shelter.id,)),
+            })
+
+        # Shelter cards, from the fragment cache where possible
+        cards = await sync_to_async(fragments.render_cards)(shelters)
+
+        # Render template with the shelter data
+        response = await sync_to_async(render)(
+            request, 'shelterme/index.html',
+            {'shelters': shelters, 'locations': locations,
+             'markers': markers, 'cards': cards, 'zip': zip_code,
+             'radius': radius, 'min_beds': min_beds, 'sort': sort})
+        if validators is not None:
+            set_validators(response, *validators)
+        return response
 
     # Shelter -- create view
-    # Creates a new shelter with data from the new view form
     elif request.method == 'POST':  # NEXT
+        return await sync_to_async(create)(request)
 
-        # TODO Authentication
+    # Neither GET nor POST -- return error
+    else:
+        messages.error('This URL only responds to GET and PUT requests.')
+        return redirect('splash')
 
-        # Get data from post form to create a new shelter
-        name = request.POST['shelter_name']
-        street_addr = request.POST['street_address']
-        city = request.POST['city']
-        city = city[0].upper() + city[1:len(city)].lower()
-        state = request.POST['state']
-        state = state.upper()
-        zip = request.POST['zip_code']
-        max_cap = request.POST['max_capacity']
-        photourl = request.POST['photourl']
 
-        # Retrieve location from the db
-        try:
-            loc = get_object_or_404(Location, city=city, state=state)
+# Shelter -- create view
+# Creates a new shelter with data from the new view form
+def create(request):
 
-        # If the location doesn't exist:
-        except Http404:
+    # TODO Authentication
 
-            # If the location is valid: add it to the db
-            if valid_city_state_zip(city, state, zip):
-                loc = Location(city=city, state=state)
-                loc.save()
+    # Get data from post form to create a new shelter
+    name = request.POST['shelter_name']
+    street_addr = request.POST['street_address']
+    city = request.POST['city']
+    city = city[0].upper() + city[1:len(city)].lower()
+    state = request.POST['state']
+    state = state.upper()
+    zip = request.POST['zip_code']
+    max_cap = request.POST['max_capacity']
+    photourl = request.POST['photourl']
 
-            # Else -- the location isn't valid -- return an error message
-            # and redirect to index page
-            else:
-                messages.error(request, 'Unable to locate the location. \
-                                         What a shame!')
-                return redirect('splash')
-                # TODO eventually we want to redirect to the index page
-                # of the user's last zip query
-
-        # Create new shelter
-        shelter = Shelter(name=name, street_addr=street_addr, location=loc,
-                          zip=zip, max_capacity=max_cap, current_capacity=0,
-                          photo=photourl, owner='User')
-        shelter.save()
-
-        # Redirect to show page
-        return redirect('shelterme:show', id=shelter.id)
+    # Retrieve location from the db
+    loc = Location.objects.get_by_city_state(city, state)
 
-    # Neither GET nor POST -- return error
+    # If the location doesn't exist:
+    if loc is None:
+
+        # If the location is valid: add it to the db
+        if valid_city_state_zip(city, state, zip):
+            loc, created = Location.objects.get_or_create_by_city_state(
+                city, state)
+
+        # Else -- the location isn't valid -- return an error message
+        # and redirect to index page
+        else:
+            messages.error(request, 'Unable to locate the location. \
+                                     What a shame!')
+            return redirect('shelterme:splash')
+            # TODO eventually we want to redirect to the index page
+            # of the user's last zip query
+
+    # Create new shelter
+    shelter = Shelter(name=name, street_addr=street_addr, location=loc,
+                      zip=zip, max_capacity=max_cap, current_capacity=0,
+                      photo=photourl, owner='User')
+    shelter.save()
+
+    # Redirect to show page
+    return redirect('shelterme:show', id=shelter.id)
+
+
+# Shelter -- search API (GET)
+# Returns one page of the shelters within radius of zip as JSON, nearest
+# first (sort=distance) or most free beds first (sort=available), skipping
+# those with fewer than min_beds free beds. Pages are chained with the
+# opaque 'next' cursor.
+@require_GET
+def api_search(request):
+
+    # Scrub data
+    try:
+        zip_code, radius = clean_search_params(request.GET)
+        min_beds, sort = clean_availability_params(request.GET)
+        limit = clean_limit(request.GET.get('limit'))
+        after = decode_cursor(request.GET.get('cursor'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    # Keyset pagination over the (free beds, id) ordered shelters, read
+    # in order from the database one page (plus one) at a time
+    if sort == 'available':
+        if after is not None:
+            after = (int(after[0]), after[1])
+        entry = available_near_zip(zip_code, radius, limit + 1, min_beds,
+                                   after)
+        keys = [(free_beds, shelter_id)
+                for shelter_id, free_beds, distance in entry[:limit]]
+        entry = [(shelter_id, distance)
+                 for shelter_id, free_beds, distance in entry]
+
+    # Keyset pagination over the (distance, id) ordered search results
     else:
-        messages.error('This URL only responds to GET and PUT requests.')
-        return redirect('splash')
+        entry = search_cache.near_zip_ids(zip_code, radius)
+        if after is not None:
+            entry = [(shelter_id, distance) for shelter_id, distance in entry
+                     if (distance, shelter_id) > after]
+        if min_beds:
+            eligible = ids_with_free_beds(zip_code, radius, min_beds)
+            entry = [(shelter_id, distance) for shelter_id, distance in entry
+                     if shelter_id in eligible]
+        keys = [(distance, shelter_id)
+                for shelter_id, distance in entry[:limit]]
+    page = entry[:limit]
+
+    # Only load the rows (and columns) on this page
+    shelters = search_cache.load(page, Shelter.objects.only(
+        'id', 'name', 'current_capacity', 'max_capacity', 'free_beds',
+        'photo', 'thumbnail', 'thumbnail_source'))
+
+    results = []
+    for shelter in shelters:
+        results.append({
+            'id': shelter.id,
+            'name': shelter.name,
+            'capacity': {'current': shelter.current_capacity,
+                         'max': shelter.max_capacity},
+            'free_beds': shelter.free_beds,
+            'distance': round(shelter.distance, 2),
+            'photo': shelter.photo,
+            'thumbnails': shelter.card_thumbnails,
+        })
+
+    next_cursor = None
+    if len(entry) > limit:
+        next_cursor = encode_cursor(*keys[-1])
+
+    return JsonResponse({'results': results, 'next': next_cursor})
+
+
+# Shelter -- full-text search API (GET)
+# Returns the shelters whose name or street address, and the comments
+# whose content, match the q parameter as JSON, best match first
+@require_GET
+@replica_reads
+def api_text_search(request):
+
+    # Scrub data
+    try:
+        query = clean_text_query(request.GET.get('q'))
+        limit = clean_limit(request.GET.get('limit'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    shelters = [{
+        'id': shelter.id,
+        'name': shelter.name,
+        'street_addr': shelter.street_addr,
+        'city': shelter.location.city,
+        'state': shelter.location.state,
+        'zip': shelter.zip,
+    } for shelter in fulltext.search_shelters(query, limit)]
+    comments = [{
+        'id': comment.id,
+        'shelter': comment.shelter_id,
+        'author': comment.author,
+        'content': comment.content,
+    } for comment in fulltext.search_comments(query, limit)]
+
+    return JsonResponse({'shelters': shelters, 'comments': comments})
+
+
+# Thumbnail view (GET)
+# Thumbnails are named by content hash, so a name always means the same
+# bytes and clients may keep them forever. Behind a web server, serve
+# THUMBNAIL_ROOT at this URL directly with the same headers instead.
+@require_GET
+def thumbnail(request, name):
+    found = thumbnails.path(name)
+    if found is None:
+        raise Http404
+    path, content_type = found
+    try:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    except FileNotFoundError:
+        raise Http404
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 # Shelter -- New view
@@ -142,9 +328,54 @@ def new(request):
 
 
 # Shelter -- Show view
-def show(request, id):
-    shelter = get_object_or_404(Shelter, id=id)
-    return render(request, 'shelterme/show.html', {'shelter': shelter})
+# Comments are paged by id: ?after=<id of the last comment shown>
+@replica_reads
+async def show(request, id):
+    shelter = await aget_object_or_404(
+        Shelter.objects.select_related('location'), id=id)
+
+    # The client's own comment changes still in the write-behind queue are
+    # shown on top of the stored comments, which are read from the primary
+    # until the changes are written
+    pending = comment_queue.queue.pending(
+        request.COOKIES.get(comment_queue.CLIENT_COOKIE), shelter.id)
+    if pending:
+        stick_to_primary()
+
+    # Answer with a 304 if the client's copy is still current. Every
+    # comment change touches the shelter.
+    validators = await sync_to_async(page_validators)(
+        request, shelter.version, shelter.comment_count, shelter.updated_at,
+        [operation.id for operation in pending])
+    response = await sync_to_async(not_modified)(request, *validators)
+    if response is not None:
+        return response
+
+    # Scrub the comment cursor
+    try:
+        after = int(request.GET.get('after') or 0)
+    except ValueError:
+        after = 0
+
+    # Fetch one extra comment to know if there's another page
+    comments = [comment async for comment in shelter.comment_set.filter(
+        id__gt=after).order_by('id')[:COMMENT_PAGE_SIZE + 1]]
+    next_after = None
+    if len(comments) > COMMENT_PAGE_SIZE:
+        comments = comments[:COMMENT_PAGE_SIZE]
+        next_after = comments[-1].id
+    if pending:
+        comments, added = comment_queue.overlay(comments, pending,
+                                                next_after is None)
+        shelter.comment_count += added
+
+    header = await sync_to_async(fragments.render_header)(shelter)
+    response = await sync_to_async(render)(
+        request, 'shelterme/show.html',
+        {'shelter': shelter, 'header': header, 'comments': comments,
+         'next_after': next_after})
+    set_validators(response, *validators)
+    return response
 
 
 # Shelter -- Edit view
@@ -218,17 +449,16 @@ def update(request, id):
             return redirect('shelterme:edit', id=id)
 
         # Scrub location
-        try:
-            loc = get_object_or_404(Location, city=city, state=state)
-        except Http404:
+        loc = Location.objects.get_by_city_state(city, state)
+        if loc is None:
             if not valid_city_state_zip(city, state, zip):
                 messages.error(request, 'City, State, and ZIP do not match. \
                                          Please try again.')
                 return redirect('shelterme:edit', id=id)
 
             else:
-                loc = Location(city=city, state=state)
-                loc.save()
+                loc, created = Location.objects.get_or_create_by_city_state(
+                    city, state)
 
         # Scrub photo url
         if not photo:
@@ -245,8 +475,12 @@ def update(request, id):
         shelter.max_capacity = max_capacity
         shelter.photo = photo
 
-        # Save shelter to the db
-        shelter.save()
+        # Save shelter to the db. current_capacity is left out so check-ins
+        # that happened since it was read aren't overwritten.
+        shelter.save(update_fields=[
+            'name', 'street_addr', 'location', 'zip', 'max_capacity',
+            'photo', 'latitude', 'longitude', 'version', 'updated_at',
+            'free_beds'])
 
         # Render the show page for the shelter
         return redirect('shelterme:show', id=shelter.id)
@@ -271,42 +505,476 @@ def delete(request, id):
     return redirect('shelterme:index')
 
 
-def comment_new(request, id):
-    shelter = get_object_or_404(Shelter, id=id)
-    return render(request, 'shelterme/comment_new.html', {'shelter': shelter})
+# Shelter -- check-in / check-out views
+# Add or remove 'count' people (default 1) from the shelter's occupancy.
+# Responds 409 if the shelter is full (check-in) or empty (check-out).
+@require_POST
+def checkin(request, id):
+    return change_occupancy(request, id, 1)
+
+
+@require_POST
+def checkout(request, id):
+    return change_occupancy(request, id, -1)
+
+
+def change_occupancy(request, id, direction):
+
+    # Scrub id and count
+    try:
+        int(id)
+    except ValueError:
+        raise Http404
+    try:
+        count = clean_count(request.POST.get('count', 1))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    applied = Shelter.objects.adjust_occupancy(id, direction * count)
+    shelter = get_object_or_404(
+        Shelter.objects.only('id', 'current_capacity', 'max_capacity'), id=id)
+    response = occupancy_json(shelter)
+    if applied:
+        feed.publish(shelter.id, shelter.current_capacity,
+                     shelter.max_capacity)
+    else:
+        response['error'] = ('Shelter is full.' if direction > 0
+                             else 'Shelter is empty.')
+        return JsonResponse(response, status=409)
+    return JsonResponse(response)
+
 
+# Occupancy API -- batch check-in / check-out (POST)
+# Takes a JSON body of {"changes": [{"id": <shelter id>, "delta": <n>}, ...]}
+# where a positive delta checks people in and a negative one checks them
+# out. Each change is applied (or refused) on its own; the response lists
+# whether each one was applied plus every shelter's resulting occupancy.
+@require_POST
+def api_occupancy(request):
+
+    # Scrub data
+    try:
+        changes = clean_occupancy_changes(request.body)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    # One transaction for the whole batch, one conditional UPDATE per change
+    with transaction.atomic():
+        applied = [Shelter.objects.adjust_occupancy(shelter_id, delta)
+                   for shelter_id, delta in changes]
+
+    shelters = Shelter.objects.only(
+        'id', 'current_capacity', 'max_capacity').in_bulk(
+            set(shelter_id for shelter_id, delta in changes))
+    for shelter_id in set(shelter_id for (shelter_id, delta), ok
+                          in zip(changes, applied) if ok):
+        shelter = shelters[shelter_id]
+        feed.publish(shelter.id, shelter.current_capacity,
+                     shelter.max_capacity)
+
+    results = []
+    for (shelter_id, delta), ok in zip(changes, applied):
+        result = {'id': shelter_id, 'delta': delta, 'applied': ok}
+        if shelter_id in shelters:
+            result.update(occupancy_json(shelters[shelter_id]))
+        results.append(result)
+    return JsonResponse({'results': results})
+
+
+# Timings API (GET, staff only)
+# Returns the rolling per-view request timings collected by
+# shelterme.instrumentation: percentiles and histograms of total, SQL, ZIP
+# lookup and render time, plus queries per request.
+@require_GET
+@staff_member_required
+def api_timings(request):
+    return JsonResponse({'window': TIMING_WINDOW,
+                         'views': histogram.snapshot()})
+
+
+# Capacity stream (GET, Server-Sent Events)
+# Streams the current and max capacity of the shelters in 'ids' (comma
+# separated): one 'capacity' event per shelter straight away, then one per
+# change as shelters are written, for SSE_LIFETIME seconds.
+# Only served under ASGI. Under WSGI every stream would hold a worker
+# thread for its whole life, so it answers 204, which tells the browser
+# not to reconnect; capacity.js polls api_capacity instead.
+@require_GET
+def capacity_stream(request):
+    try:
+        shelter_ids = clean_shelter_ids(request.GET.get('ids', ''))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    response = StreamingHttpResponse(
+        capacity_events(shelter_ids, SSE_LIFETIME),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Yields the SSE messages of a capacity stream for lifetime seconds
+async def capacity_events(shelter_ids, lifetime):
+
+    # Subscribe before the snapshot so no change can slip in between
+    subscription = feed.subscribe(shelter_ids)
+    try:
+        yield 'retry: %d\n\n' % SSE_RETRY_MS
+        async for shelter in stream_snapshot(shelter_ids):
+            yield sse_event('capacity', occupancy_json(shelter))
+
+        deadline = time.monotonic() + lifetime
+        while time.monotonic() < deadline:
+            changes = await subscription.changes(
+                min(SSE_KEEPALIVE, deadline - time.monotonic()))
+            for message in sse_changes(changes):
+                yield message
+    finally:
+        feed.unsubscribe(subscription)
+
+
+# Capacity API (GET)
+# Returns the current and max capacity of the shelters in 'ids' (comma
+# separated), for clients that can't stream
+@require_GET
+def api_capacity(request):
+    try:
+        shelter_ids = clean_shelter_ids(request.GET.get('ids', ''))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    response = JsonResponse({'shelters': [
+        occupancy_json(shelter) for shelter in stream_snapshot(shelter_ids)]})
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-def comment_create(request, id):
+
+def stream_snapshot(shelter_ids):
+    return Shelter.objects.filter(id__in=shelter_ids).only(
+        'id', 'current_capacity', 'max_capacity')
+
+
+def sse_changes(changes):
+    if not changes:
+        # Comment line, keeps proxies from closing an idle stream
+        return [': keepalive\n\n']
+    return [sse_event('capacity', change) for change in changes]
+
+
+def sse_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+def occupancy_json(shelter):
+    return {'id': shelter.id,
+            'current_capacity': shelter.current_capacity,
+            'max_capacity': shelter.max_capacity}
+
+
+async def comment_new(request, id):
+    shelter = await aget_object_or_404(Shelter, id=id)
+    return await sync_to_async(render)(
+        request, 'shelterme/comment_new.html', {'shelter': shelter})
+
+
+async def comment_create(request, id):
     content = request.POST['content']
-    shelter = get_object_or_404(Shelter, id=id)
+    shelter = await aget_object_or_404(Shelter, id=id)
+    response = await queue_comment_change(request, id, comment_queue.Operation(
+        comment_queue.CREATE, shelter.id, author='Hunter', content=content))
+    if response is not None:
+        return response
     comment = Comment(author='Hunter', content=content, shelter=shelter)
-    comment.save()
+    await comment.asave()
     return redirect('shelterme:show', id=id)
 
 
-def comment_edit(request, id, comment_id):
-    shelter = get_object_or_404(Shelter, id=id)
-    comment = get_object_or_404(Comment, id=comment_id)
-    return render(request, 'shelterme/comment_edit.html',
-                  {'shelter': shelter, 'comment': comment})
+@replica_reads
+async def comment_edit(request, id, comment_id):
+    shelter = await aget_object_or_404(Shelter, id=id)
+    comment = await aget_object_or_404(Comment, id=comment_id)
+    return await sync_to_async(render)(
+        request, 'shelterme/comment_edit.html',
+        {'shelter': shelter, 'comment': comment})
 
 
-def comment_update(request, id, comment_id):
-    comment = get_object_or_404(Comment, id=comment_id)
+async def comment_update(request, id, comment_id):
+    comment = await aget_object_or_404(Comment, id=comment_id)
     content = request.POST['content']
+    response = await queue_comment_change(request, id, comment_queue.Operation(
+        comment_queue.UPDATE, comment.shelter_id, comment_id=comment.id,
+        content=content))
+    if response is not None:
+        return response
     comment.content = content
-    comment.save()
+    await comment.asave()
     return redirect('shelterme:show', id=id)
 
 
-def comment_delete(request, id, comment_id):
-    comment = get_object_or_404(Comment, id=comment_id)
-    comment.delete()
+async def comment_delete(request, id, comment_id):
+    comment = await aget_object_or_404(Comment, id=comment_id)
+    response = await queue_comment_change(request, id, comment_queue.Operation(
+        comment_queue.DELETE, comment.shelter_id, comment_id=comment.id))
+    if response is not None:
+        return response
+    await comment.adelete()
     return redirect('shelterme:show', id=id)
 
 
+# Queues a comment change instead of writing it, when write-behind is on
+# (see shelterme.comment_queue). Returns the redirect to the show page, or
+# None if write-behind is off and the change has to be written now.
+async def queue_comment_change(request, id, operation):
+    if not comment_queue.WRITE_BEHIND:
+        return None
+    client = (request.COOKIES.get(comment_queue.CLIENT_COOKIE) or
+              comment_queue.new_client())
+    operation.client = client
+    await sync_to_async(comment_queue.queue.put)(operation)
+    # Once written, the change may take a while to reach the replicas
+    stick_to_primary()
+    response = redirect('shelterme:show', id=id)
+    response.set_cookie(comment_queue.CLIENT_COOKIE, client, httponly=True,
+                        samesite='Lax')
+    return response
+
+
+# Returns the (ETag, Last-Modified) of a page built from data described by
+# the given values, the last of which are the data's change times. Pages
+# show who's logged in, so the user is part of the ETag.
+def page_validators(request, *parts):
+    user = request.user.pk if request.user.is_authenticated else None
+    digest = md5(repr((user,) + parts).encode()).hexdigest()
+    last_modified = max(part for part in parts
+                        if hasattr(part, 'timestamp'))
+    return '"%s"' % digest, int(last_modified.timestamp())
+
+
+# Returns a 304 response if the client's cached copy of the page is still
+# current, None if the page needs rendering. Pages with messages waiting to
+# be shown are always rendered.
+def not_modified(request, etag, last_modified):
+    if len(messages.get_messages(request)):
+        return None
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+# Caches may keep the page but have to revalidate it on every use
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, no_cache=True)
+
+
+# Async get_object_or_404. Ids that aren't numbers are a 404 too.
+async def aget_object_or_404(klass, **kwargs):
+    queryset = klass._default_manager.all() if hasattr(
+        klass, '_default_manager') else klass
+    try:
+        return await queryset.aget(**kwargs)
+    except (queryset.model.DoesNotExist, ValueError):
+        raise Http404
+
+
+# Returns the (minimum free beds, sort) of a shelter search from the given
+# query parameters, applying the defaults. Raises ValueError with a user
+# facing message if either is invalid.
+def clean_availability_params(params):
+    min_beds = params.get('min_beds') or 0
+    try:
+        min_beds = int(min_beds)
+    except ValueError:
+        raise ValueError('Invalid number of free beds. Please try again.')
+    if min_beds < 0 or min_beds > 10000:
+        raise ValueError('Free beds must be between 0 and 10,000.')
+
+    sort = params.get('sort') or SORTS[0]
+    if sort not in SORTS:
+        raise ValueError('Invalid sort. Please try again.')
+    return min_beds, sort
+
+
+# Returns up to limit (id, free beds, distance) of the shelters within
+# radius of zip with at least min_beds free beds, most free beds first,
+# after the (free beds, id) key in after
+def available_near_zip(zip_code, radius, limit, min_beds=0, after=None):
+    with timed('zip'):
+        center = get_zip_index().centroid(zip_code)
+    if center is None:
+        return []
+    return Shelter.objects.most_available(center[0], center[1], radius,
+                                          limit, min_beds, after)
+
+
+# Loads the limit shelters within radius of zip with the most free beds
+# (and at least min_beds), with location and distance set
+def load_most_available(zip_code, radius, limit, min_beds=0):
+    entry = available_near_zip(zip_code, radius, limit, min_beds)
+    return search_cache.load([(shelter_id, distance)
+                              for shelter_id, free_beds, distance in entry])
+
+
+# Returns the set of ids of the shelters in the bounding box of the search
+# that have at least min_beds free beds. Only reads the lat/long/free_beds
+# index.
+def ids_with_free_beds(zip_code, radius, min_beds):
+    with timed('zip'):
+        center = get_zip_index().centroid(zip_code)
+    if center is None:
+        return set()
+    return set(Shelter.objects.in_bounding_box(
+        center[0], center[1], radius).filter(
+        free_beds__gte=min_beds).values_list('id', flat=True))
+
+
+# Returns the (zip, radius) of a shelter search from the given query
+# parameters, applying the defaults. Raises ValueError with a user facing
+# message if either is invalid.
+def clean_search_params(params):
+
+    # Get data
+    # Default zip is temporary, eventually we will use the user's last
+    # queried zip
+    zip_code = params.get('zip', '36830')[:5]
+    radius = params.get('radius', 10)
+
+    # Scrub zip
+    # If the zip code is empty, not in a valid form or not real, error out
+    if not zip_code:
+        raise ValueError('Invalid ZIP. Please try again.')
+    try:
+        real = is_real(zip_code)
+    except ValueError:
+        real = False
+    if not real:
+        raise ValueError('Invalid ZIP. Please try again.')
+
+    # Scrub radius
+    if not radius:
+        radius = 10
+    else:
+        try:
+            radius = int(radius)
+        except ValueError:
+            raise ValueError('Invalid radius. Please try again.')
+        if radius < 1 or radius > 50:
+            raise ValueError('Radius can\'t be less than 1 or greater than 50. \
+                              Please try again.')
+
+    return zip_code, radius
+
+
+# Returns the page size of an API request, DEFAULT_PAGE_SIZE if not given.
+# Raises ValueError if it isn't between 1 and MAX_PAGE_SIZE.
+def clean_limit(limit):
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('Invalid limit.')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError('Limit must be between 1 and %d.' % MAX_PAGE_SIZE)
+    return limit
+
+
+# Returns the query of a full-text search. Raises ValueError if it has no
+# words or is too long.
+def clean_text_query(query):
+    if not query or not fulltext.match_expression(query):
+        raise ValueError('Enter something to search for.')
+    if len(query) > fulltext.MAX_QUERY_LENGTH:
+        raise ValueError('Searches can be at most %d characters.'
+                         % fulltext.MAX_QUERY_LENGTH)
+    return query
+
+
+# Cursors are the sort key (distance or free beds) and id of the last
+# shelter on the previous page, base64 encoded so clients treat them as
+# opaque
+def encode_cursor(key, shelter_id):
+    raw = json.dumps([key, shelter_id]).encode()
+    return urlsafe_b64encode(raw).decode()
+
+
+# Returns the (sort key, id) in the cursor, or None if there isn't one.
+# Raises ValueError if it's malformed.
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        key, shelter_id = json.loads(urlsafe_b64decode(cursor.encode()))
+        return (float(key), int(shelter_id))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor.')
+
+
+# Returns the number of people in a check-in / check-out. Raises
+# ValueError unless it's between 1 and 10,000.
+def clean_count(count):
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid count.')
+    if count < 1 or count > 10000:
+        raise ValueError('Count must be between 1 and 10,000.')
+    return count
+
+
+# Returns the (shelter id, delta) pairs of a batch occupancy request body.
+# Raises ValueError if it's malformed.
+def clean_occupancy_changes(body):
+    try:
+        changes = json.loads(body)['changes']
+    except (ValueError, TypeError, KeyError):
+        raise ValueError('Body must be JSON with a "changes" list.')
+    if not isinstance(changes, list) or not changes:
+        raise ValueError('"changes" must be a non-empty list.')
+    if len(changes) > MAX_OCCUPANCY_CHANGES:
+        raise ValueError('At most %d changes per request.'
+                         % MAX_OCCUPANCY_CHANGES)
+
+    cleaned = []
+    for change in changes:
+        try:
+            shelter_id = int(change['id'])
+            delta = int(change['delta'])
+        except (ValueError, TypeError, KeyError):
+            raise ValueError('Each change needs an integer id and delta.')
+        if delta == 0 or abs(delta) > 10000:
+            raise ValueError('Delta must be between 1 and 10,000 people '
+                             'either way.')
+        cleaned.append((shelter_id, delta))
+    return cleaned
+
+
+# Returns the shelter ids of a comma separated list. Raises ValueError if
+# it's empty, malformed or too long.
+def clean_shelter_ids(ids):
+    try:
+        shelter_ids = set(int(i) for i in ids.split(',') if i.strip())
+    except ValueError:
+        raise ValueError('ids must be a comma separated list of shelter ids.')
+    if not shelter_ids:
+        raise ValueError('No shelter ids given.')
+    if len(shelter_ids) > MAX_STREAM_SHELTERS:
+        raise ValueError('At most %d shelters per stream.'
+                         % MAX_STREAM_SHELTERS)
+    return shelter_ids
+
+
 # Returns True if the given city and state match the given zip code
 # Returns False otherwise
+#
+# Results (including False for bad input like '00000') are memoized in a
+# bounded LRU; valid_city_state_zip.cache_info() has the hit/miss stats.
+@lru_cache(maxsize=getattr(settings, 'SHELTERME_ZIP_CACHE_SIZE', 4096))
 def valid_city_state_zip(city, state, zip):
 
     # Ensure none of the fields are blank
@@ -315,14 +983,13 @@ def valid_city_state_zip(city, state, zip):
 
     # Look up the zip and extract the city and state
     try:
-        zip_info = matching(str(zip))
+        with timed('zip'):
+            zip_info = lookup_zip(zip)
     except ValueError:
         return False
     if not zip_info:
         return False
-    zip_info = zip_info[0]
-    zip_city = zip_info['city']
-    zip_state = zip_info['state']
+    zip_city, zip_state = zip_info
 
     # Check validity
     if city.lower() == zip_city.lower() and state.lower() == zip_state.lower():
@@ -331,23 +998,18 @@ def valid_city_state_zip(city, state, zip):
 
 
 def get_locations_within_radius(zip_code, radius):
-    zips = []
-    for z in ZipCodeDatabase().get_zipcodes_around_radius(zip_code, radius):
-        zips.append(z.zip)
-
-    tmp_locations = []
-    for z in zips:
-        zip_info = matching(z)
-        zip_info = zip_info[0]
-        city = ''
-        tmp_city = str(zip_info['city'])
-        for word in tmp_city.split(' '):
-            city += word[0].upper() + word[1:len(word)].lower() + ' '
-        state = str(zip_info['state']).upper()
-        tmp_locations.append(
-            '{"city": "' + city.strip() + '", "state": "' + state + '"}')
-    tmp_locations = set(tmp_locations)
+    with timed('zip'):
+        zips = []
+        for z, distance in get_zip_index().zips_within_radius(zip_code,
+                                                               radius):
+            zips.append(z)
+
+        places = set()
+        for z in zips:
+            place = lookup_zip(z)
+            if place:
+                places.add(place)
     locations = []
-    for location in tmp_locations:
-        locations.append(literal_eval(location))
+    for city, state in places:
+        locations.append({'city': city, 'state': state})
     return locations